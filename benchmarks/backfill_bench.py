@@ -0,0 +1,141 @@
+#
+# Migrating a library labelled before schemaVersion 2 with scripts/backfill_labels.py, against the
+# S3 and DynamoDB stand-ins with latency and Scan pages of --page-items items. After the run every
+# image with an original must be listed by listImages (newest first, by the original's LastModified)
+# and found by searchByLabel, getLabels must return the same names as before, images without an
+# original must be reported and left alone, and running it again must find nothing left to migrate
+#
+# Usage: python benchmarks/backfill_bench.py [--images 2000] [--workers 16] [--s3-latency 0.02]
+#
+
+import argparse
+import datetime
+import importlib.util
+import os
+import random
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..')
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(ROOT, 'rekognitionLambda'))
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+os.environ.setdefault('TABLE', 'labels')
+os.environ.setdefault('LABELINDEXTABLE', 'labelindex')
+os.environ.setdefault('BUCKET', 'images')
+os.environ.setdefault('RESIZEDBUCKET', 'resized')
+
+VOCABULARY = ['Person', 'Outdoors', 'Plant', 'Dog', 'Cat', 'Car', 'Beach', 'Food', 'Building', 'Sky', 'Snow']
+
+
+def loadModule(name, path):
+
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, *path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def listAll(service, identityId):
+
+    images = []
+    token = None
+    while True:
+        response = service.handler({'action': 'listImages', 'identityId': identityId, 'limit': 100,
+                                    'nextToken': token}, None)
+        images.extend(response['images'])
+        token = response['nextToken']
+        if token is None:
+            return images
+
+
+def searchAll(service, identityId, labels):
+
+    images = []
+    token = None
+    while True:
+        response = service.handler({'action': 'searchByLabel', 'identityId': identityId, 'labels': labels,
+                                    'nextToken': token}, None)
+        images.extend(image['image'] for image in response['images'])
+        token = response['nextToken']
+        if token is None:
+            return sorted(images)
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', type=int, default=2000)
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--latency', type=float, default=0.005, help='DynamoDB round-trip (s)')
+    parser.add_argument('--s3-latency', type=float, default=0.02, help='S3 HeadObject round-trip (s)')
+    parser.add_argument('--page-items', type=int, default=100, help='items per Scan page')
+    args = parser.parse_args()
+
+    import fakes
+    import index
+
+    service = loadModule('servicelambda', ('servicelambda', 'index.py'))
+    backfill = loadModule('backfill_labels', ('scripts', 'backfill_labels.py'))
+    dynamodb = fakes.FakeDynamoDB(keys={os.environ['LABELINDEXTABLE']: ('ownerLabel', 'image')},
+                                  indexes={os.environ['TABLE']: {'byOwner': ('owner', 'uploaded')}})
+    index.dynamodb = fakes.FakeDynamoDBClient(dynamodb, pageSize=args.page_items)
+    index.s3_client = s3 = fakes.FakeS3()
+    service.dynamodb = dynamodb
+    service.s3 = s3
+    service.readCacheSize = 0
+
+    # The library as the original handler stored it: at most 10 names per image, no confidences.
+    # The last few originals are gone
+    identityId = 'us-west-2:legacy'
+    rng = random.Random(1)
+    table = dynamodb.Table(os.environ['TABLE'])
+    uploaded = datetime.datetime(2021, 3, 1, tzinfo=datetime.timezone.utc)
+    keys = []
+    for i in range(args.images):
+        key = f'private/{identityId}/photo{i:05d}.jpg'
+        names = rng.sample(VOCABULARY, rng.randint(0, 10))
+        table.store(dict({'image': key}, **{f'object{n}': name for n, name in enumerate(names, 1)}))
+        if i < args.images - 5:
+            modified = uploaded + datetime.timedelta(minutes=rng.randrange(1000) * args.images + i)
+            s3.put(os.environ['BUCKET'], key, b'original', modified=modified)
+        keys.append(key)
+    missing = keys[-5:]
+    current = {'image': f'private/{identityId}/current.jpg', 'schemaVersion': 2, 'labels': '[["Dog",97.5,[],[]]]',
+               'version': 'v1', 'owner': identityId, 'uploaded': '2030-01-01T00:00:00Z'}
+    assert not index.writeLabels([current])
+    before = {key: service.handler({'action': 'getLabels', 'key': key}, None) for key in keys}
+
+    s3.latency = args.s3_latency
+    for name in (os.environ['TABLE'], os.environ['LABELINDEXTABLE']):
+        dynamodb.Table(name).latency = args.latency
+    start = time.perf_counter()
+    results = backfill.backfill(os.environ['BUCKET'], workers=args.workers)
+    elapsed = time.perf_counter() - start
+    again = backfill.backfill(os.environ['BUCKET'], workers=args.workers)
+    for name in (os.environ['TABLE'], os.environ['LABELINDEXTABLE']):
+        dynamodb.Table(name).latency = 0.0
+
+    after = {key: service.handler({'action': 'getLabels', 'key': key}, None) for key in keys}
+    listed = [image['image'] for image in listAll(service, identityId)]
+    newestFirst = sorted(keys[:-5], key=lambda key: s3.modified[(os.environ['BUCKET'], key)], reverse=True)
+    ok = sorted(results['migrated']) == sorted(keys[:-5]) and results['missing'] == missing and \
+        not results['failed'] and not again['migrated'] and again['missing'] == missing and \
+        after == before and listed == [current['image']] + newestFirst and table.items[current['image']] == current
+    for label in ('dog', 'snow'):
+        expected = sorted(key for key in keys[:-5] if label.title() in before[key].values())
+        expected += [current['image']] if label == 'dog' else []
+        ok = ok and searchAll(service, identityId, label) == sorted(expected)
+
+    print(f'{len(results["migrated"])} legacy items migrated in {elapsed * 1000:7.1f} ms '
+          f'({args.workers} HeadObject calls in flight), {len(results["missing"])} without an original left alone, '
+          f'{len(again["migrated"])} migrated again on a second run')
+    print(f'getLabels unchanged, listed newest first and found by label: {"ok" if ok else "WRONG"}')
+    if not ok:
+        sys.exit('the backfill lost or changed images')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+#
+# Clearing an album through servicelambda: one deleteImage request per image (with as many in
+# flight as a browser keeps connections to the API) against a single deleteImages. Albums are
+# labelled through rekognitionLambda's writeLabels (which maintains the label index), with two
+# thumbnail renditions per image in the resized bucket. After each run every original, thumbnail,
+# label item and index entry of the album must be gone and the rest of the library untouched. Then
+# S3 and DynamoDB are made to hand back half of every call, so some images still fail after the
+# retries, and deleteImages is asked again for what it reports unprocessed until it is all gone
+#
+# Usage: python benchmarks/delete_bench.py [--images 300] [--connections 6] [--s3-latency 0.02]
+#
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..')
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(ROOT, 'rekognitionLambda'))
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+os.environ.setdefault('TABLE', 'labels')
+os.environ.setdefault('LABELINDEXTABLE', 'labelindex')
+os.environ.setdefault('BUCKET', 'images')
+os.environ.setdefault('RESIZEDBUCKET', 'resized')
+
+
+def loadServiceLambda():
+
+    spec = importlib.util.spec_from_file_location('servicelambda', os.path.join(ROOT, 'servicelambda', 'index.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def makeAlbum(index, s3, dynamodb, identityId, count):
+
+    # Labelled straight into the tables, without latency
+    items = []
+    for i in range(count):
+        key = f'private/{identityId}/photo{i:05d}.jpg'
+        thumbnails = {'': key, 'small': key + '.small.webp'}
+        labels = [[f'Label{(i + j) % 40}', 99.0 - j * 4, [], []] for j in range(10)]
+        items.append({'image': key, 'schemaVersion': 2, 'labels': json.dumps(labels),
+                      'thumbnails': json.dumps(thumbnails)})
+        s3.put(os.environ['BUCKET'], key, b'original')
+        for thumbKey in thumbnails.values():
+            s3.put(os.environ['RESIZEDBUCKET'], thumbKey, b'thumbnail')
+    latencies = s3.latency, dynamodb.latency
+    s3.latency = dynamodb.latency = 0.0
+    for table in dynamodb.tables.values():
+        table.latency = 0.0
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(0, count, 500):
+            assert not index.writeLabels(items[i:i + 500])
+    s3.latency, dynamodb.latency = latencies
+    for table in dynamodb.tables.values():
+        table.latency = dynamodb.latency
+    return [item['image'] for item in items]
+
+
+def leftOf(s3, dynamodb, identityId):
+
+    # Objects, label items and index entries of the user still stored
+    prefix = f'private/{identityId}/'
+    objects = sum(key.startswith(prefix) for bucket, key in s3.objects)
+    items = sum(key.startswith(prefix) for key in dynamodb.Table(os.environ['TABLE']).items)
+    entries = sum(owner.startswith(identityId + '#') for owner, key in dynamodb.Table(os.environ['LABELINDEXTABLE']).items)
+    return objects, items, entries
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', type=int, default=300)
+    parser.add_argument('--connections', type=int, default=6, help='requests a browser has in flight')
+    parser.add_argument('--api-latency', type=float, default=0.03, help='API Gateway + Lambda round-trip (s)')
+    parser.add_argument('--latency', type=float, default=0.008, help='DynamoDB round-trip (s)')
+    parser.add_argument('--s3-latency', type=float, default=0.02, help='S3 round-trip (s)')
+    args = parser.parse_args()
+
+    import fakes
+    import index
+
+    service = loadServiceLambda()
+    dynamodb = fakes.FakeDynamoDB(args.latency, keys={os.environ['LABELINDEXTABLE']: ('ownerLabel', 'image')})
+    s3 = fakes.FakeS3(args.s3_latency)
+    index.dynamodb = fakes.FakeDynamoDBClient(dynamodb)
+    service.dynamodb = dynamodb
+    service.s3 = s3
+
+    makeAlbum(index, s3, dynamodb, 'us-west-2:keep', 50)
+    kept = leftOf(s3, dynamodb, 'us-west-2:keep')
+
+    def request(event):
+        time.sleep(args.api_latency)
+        return service.handler(event, None)
+
+    keys = makeAlbum(index, s3, dynamodb, 'us-west-2:single', args.images)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.connections) as executor:
+        list(executor.map(lambda key: request({'action': 'deleteImage', 'key': key}), keys))
+    singleTime = time.perf_counter() - start
+    singleLeft = leftOf(s3, dynamodb, 'us-west-2:single')
+
+    keys = makeAlbum(index, s3, dynamodb, 'us-west-2:batch', args.images)
+    s3.deleteCalls = dynamodb.batchCalls = 0
+    start = time.perf_counter()
+    result = request({'action': 'deleteImages', 'keys': keys + keys[:10] + ['private/us-west-2:batch/missing.jpg']})
+    batchTime = time.perf_counter() - start
+    batchLeft = leftOf(s3, dynamodb, 'us-west-2:batch')
+
+    ok = singleLeft == batchLeft == (0, 0, 0) and not result['unprocessed'] and \
+        set(result['images'].values()) == {'Deleted'}
+    print(f'deleteImage x{args.images} ({args.connections} in flight): {singleTime * 1000:8.1f} ms  '
+          f'left {singleLeft}')
+    print(f'deleteImages:                     {batchTime * 1000:8.1f} ms  {s3.deleteCalls} DeleteObjects and '
+          f'{dynamodb.batchCalls} BatchGetItem/BatchWriteItem calls  left {batchLeft}  {"ok" if ok else "WRONG"}')
+    if not ok:
+        sys.exit('deleteImages left part of the album behind')
+
+    keys = makeAlbum(index, s3, dynamodb, 'us-west-2:flaky', args.images)
+    s3.errorRate = dynamodb.unprocessedRate = 0.5
+    requests = []
+    pending = keys
+    with contextlib.redirect_stderr(io.StringIO()):
+        while pending and len(requests) < 20:
+            result = request({'action': 'deleteImages', 'keys': pending})
+            pending = result['unprocessed']
+            requests.append(len(pending))
+    s3.errorRate = dynamodb.unprocessedRate = 0.0
+    flakyLeft = leftOf(s3, dynamodb, 'us-west-2:flaky')
+    ok = not pending and flakyLeft == (0, 0, 0) and leftOf(s3, dynamodb, 'us-west-2:keep') == kept
+    print(f'with half of every call failing: {len(requests)} requests, unprocessed after each {requests}  '
+          f'left {flakyLeft}  other albums untouched: {"ok" if ok else "WRONG"}')
+    if not ok:
+        sys.exit('asking again for the unprocessed images does not finish the delete')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#
+# Compare sending the original (S3Object) and the largest thumbnail (inline Bytes) to detectLabels,
+# end to end through the rekognition handler, against a Rekognition stand-in whose latency grows
+# with the size of the image it has to move and decode
+#
+# Usage: python benchmarks/detect_source_bench.py [--batch 5] [--size 4000x3000] [--sources s3,bytes]
+#
+
+import argparse
+import contextlib
+import io
+import os
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, '..', 'rekognitionLambda'))
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+os.environ.setdefault('RESIZEDBUCKET', 'resized')
+os.environ.setdefault('TABLE', 'labels')
+
+BUCKET = 'images'
+
+
+def runSource(source, args):
+
+    os.environ['DETECT_SOURCE'] = source
+    import fakes
+    import index
+
+    size = tuple(int(x) for x in args.size.split('x'))
+    index.s3_client = s3 = fakes.FakeS3(args.latency)
+    index.rekognition_client = rekognition = fakes.FakeRekognition(
+        args.rek_latency, s3=s3, perMegabyte=args.per_megabyte, perMegapixel=args.per_megapixel)
+    index.dynamodb = fakes.FakeDynamoDBClient(fakes.FakeDynamoDB(args.latency))
+
+    timings = []
+    for round in range(args.rounds):
+        # Fresh content every round, so neither label cache tier answers for Rekognition
+        keys = [f'private/user/photo{round}-{i}.jpg' for i in range(args.batch)]
+        for i, key in enumerate(keys):
+            s3.put(BUCKET, key, fakes.makeJpeg(size[0], size[1], seed=round * args.batch + i))
+        event = fakes.makeSqsEvent(BUCKET, keys, s3=s3, prefix=f'round{round}')
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            index.handler(event, None)
+        timings.append(time.perf_counter() - start)
+
+    timings.sort()
+    print(f'{source:>5}: batch p50 {timings[len(timings) // 2] * 1000:8.1f} ms  best {timings[0] * 1000:8.1f} ms  '
+          f'sources {index.detectSources}  calls {rekognition.calls}')
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch', type=int, default=5)
+    parser.add_argument('--size', default='4000x3000')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.02, help='S3 and DynamoDB round-trip (s)')
+    parser.add_argument('--rek-latency', type=float, default=0.15, help='detectLabels base latency (s)')
+    parser.add_argument('--per-megabyte', type=float, default=0.02, help='image transfer cost (s/MB)')
+    parser.add_argument('--per-megapixel', type=float, default=0.03, help='image decode cost (s/MP)')
+    parser.add_argument('--sources', default='s3,bytes')
+    args = parser.parse_args()
+
+    if ',' not in args.sources:
+        return runSource(args.sources, args)
+
+    # DETECT_SOURCE is read at import time, so each setting gets a fresh interpreter
+    for source in args.sources.split(','):
+        subprocess.run([sys.executable, __file__, '--sources', source, '--batch', str(args.batch),
+                        '--size', args.size, '--rounds', str(args.rounds), '--latency', str(args.latency),
+                        '--rek-latency', str(args.rek_latency), '--per-megabyte', str(args.per_megabyte),
+                        '--per-megapixel', str(args.per_megapixel)],
+                       check=True)
+
+
+if __name__ == '__main__':
+    main()
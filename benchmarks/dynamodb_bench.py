@@ -0,0 +1,52 @@
+#
+# Compare one put_item per label item against batched BatchWriteItem flushes,
+# against an in-process DynamoDB stand-in with injected latency and unprocessed items
+#
+# Usage: python benchmarks/dynamodb_bench.py [--items 100] [--latency 0.01] [--unprocessed 0.05]
+#
+
+import argparse
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, '..', 'rekognitionLambda'))
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+os.environ.setdefault('RESIZEDBUCKET', 'resized')
+os.environ.setdefault('TABLE', 'labels')
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--items', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.01)
+    parser.add_argument('--unprocessed', type=float, default=0.05)
+    args = parser.parse_args()
+
+    import fakes
+    import index
+
+    items = [{'image': f'private/user/photo{i}.jpg', 'object1': 'Dog', 'object2': 'Grass'}
+             for i in range(args.items)]
+
+    index.dynamodb = fakes.FakeDynamoDBClient(fakes.FakeDynamoDB(args.latency, args.unprocessed))
+    start = time.perf_counter()
+    for item in items:
+        index.dynamodb.put_item(TableName=index.imageLabelsTable, Item=index.toAttributes(item))
+    elapsed = time.perf_counter() - start
+    print(f'put_item   : {elapsed * 1000:8.1f} ms  {args.items / elapsed:8.1f} items/s  {args.items} requests')
+
+    index.dynamodb = fakes.FakeDynamoDBClient(fakes.FakeDynamoDB(args.latency, args.unprocessed))
+    start = time.perf_counter()
+    failed = index.writeLabels(items)
+    elapsed = time.perf_counter() - start
+    print(f'batch write: {elapsed * 1000:8.1f} ms  {args.items / elapsed:8.1f} items/s  '
+          f'{index.dynamodb.resource.batchCalls} requests  {len(failed)} failed')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#
+# Turn the Embedded Metric Format lines logged by the rekognition handler into percentile tables per
+# stage, optionally split by a property (format, route). Reads CloudWatch log exports (or anything
+# with one JSON document per line), or with --run captures the logs of batches processed locally
+# against the in-process AWS stand-ins
+#
+# Usage: python benchmarks/emf_report.py [logs ...] [--by route] [--run 20 --size 1600x1200]
+#
+
+import argparse
+import collections
+import contextlib
+import io
+import json
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, '..', 'rekognitionLambda'))
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+os.environ.setdefault('RESIZEDBUCKET', 'resized')
+os.environ.setdefault('TABLE', 'labels')
+
+
+def percentile(values, fraction):
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+def parseDocuments(lines):
+
+    # Log exports prefix each line with a timestamp and request id; the document starts at the first brace
+    for line in lines:
+        start = line.find('{')
+        if start < 0 or '"_aws"' not in line:
+            continue
+        try:
+            document = json.loads(line[start:])
+        except ValueError:
+            continue
+        if isinstance(document, dict) and '_aws' in document:
+            yield document
+
+
+def runLocally(images, size, latency):
+
+    os.environ['TRACE_SAMPLE_RATE'] = '1'
+    import fakes
+    import index
+
+    index.s3_client = s3 = fakes.FakeS3(latency)
+    index.rekognition_client = fakes.FakeRekognition(latency)
+    index.dynamodb = fakes.FakeDynamoDBClient(fakes.FakeDynamoDB(latency))
+
+    width, height = size
+    keys = [f'private/user/photo{i}.jpg' for i in range(images)]
+    for i, key in enumerate(keys):
+        s3.put('images', key, fakes.makeJpeg(width, height, seed=i))
+
+    output = io.StringIO()
+    for i in range(0, images, 10):
+        event = fakes.makeSqsEvent('images', keys[i:i + 10], s3=s3, prefix=f'batch{i}')
+        with contextlib.redirect_stdout(output):
+            index.handler(event, fakes.FakeContext())
+    return output.getvalue().splitlines()
+
+
+def report(documents, by=None):
+
+    # metric name -> group -> values
+    metrics = collections.defaultdict(lambda: collections.defaultdict(list))
+    for document in documents:
+        group = str(document.get(by, '-')) if by else '-'
+        for definition in document['_aws']['CloudWatchMetrics']:
+            for metric in definition['Metrics']:
+                values = document.get(metric['Name'], [])
+                metrics[metric['Name']][group].extend(values if isinstance(values, list) else [values])
+
+    print(f'{"metric":<22} {by or "":>10} {"count":>6} {"p50":>10} {"p90":>10} {"p99":>10} {"max":>10}')
+    for name in sorted(metrics):
+        for group, values in sorted(metrics[name].items()):
+            print(f'{name:<22} {group if by else "":>10} {len(values):6d} {percentile(values, 0.5):10.1f} '
+                  f'{percentile(values, 0.9):10.1f} {percentile(values, 0.99):10.1f} {max(values):10.1f}')
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('logs', nargs='*', help='log files, or - for stdin')
+    parser.add_argument('--by', help='property to split the tables by, e.g. format or route')
+    parser.add_argument('--run', type=int, default=0, help='process this many images locally instead')
+    parser.add_argument('--size', default='1600x1200')
+    parser.add_argument('--latency', type=float, default=0.02)
+    args = parser.parse_args()
+
+    if args.run:
+        lines = runLocally(args.run, tuple(int(x) for x in args.size.split('x')), args.latency)
+    else:
+        lines = []
+        for path in args.logs or ['-']:
+            with (contextlib.nullcontext(sys.stdin) if path == '-' else open(path)) as f:
+                lines.extend(f)
+
+    report(parseDocuments(lines), args.by)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#
+# Compare thumbnail size and encode time of the original encoding (source format, Pillow defaults)
+# with the encoder policy, with and without a byte budget, for photos, screenshots and photos
+# with transparency
+#
+# Usage: python benchmarks/encoder_bench.py [--images 10] [--edge 800] [--max-bytes 60000]
+#
+
+import argparse
+import io
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, '..', 'rekognitionLambda'))
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+os.environ.setdefault('RESIZEDBUCKET', 'resized')
+os.environ.setdefault('TABLE', 'labels')
+
+
+def makeImages(kind, count, edge):
+
+    import fakes
+    from PIL import Image
+
+    images = []
+    for seed in range(count):
+        if kind == 'screenshot':
+            data = fakes.makeScreenshot(2 * edge, edge * 5 // 4, seed)
+        else:
+            data = fakes.makeJpeg(2 * edge, edge * 3 // 2, seed)
+        image = Image.open(io.BytesIO(data))
+        sourceFormat = image.format
+        image.thumbnail((edge, edge))
+        if kind == 'alpha':
+            # A photo cut out on a transparent background
+            mask = Image.new('L', image.size, 0)
+            from PIL import ImageDraw
+            ImageDraw.Draw(mask).ellipse((0, 0) + image.size, fill=255)
+            image = image.convert('RGBA')
+            image.putalpha(mask)
+            sourceFormat = 'PNG'
+        images.append((image, sourceFormat))
+    return images
+
+
+def measure(images, encode):
+
+    sizes, seconds, formats = [], [], set()
+    for image, sourceFormat in images:
+        start = time.perf_counter()
+        buffer, imageFormat = encode(image, sourceFormat)
+        seconds.append(time.perf_counter() - start)
+        sizes.append(buffer.getbuffer().nbytes)
+        formats.add(imageFormat)
+    return sum(sizes) / len(sizes), sum(seconds) / len(seconds), formats
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', type=int, default=10)
+    parser.add_argument('--edge', type=int, default=800)
+    parser.add_argument('--max-bytes', type=int, default=60000)
+    args = parser.parse_args()
+
+    import index
+    index.loadPIL()
+
+    def original(image, sourceFormat):
+        buffer = io.BytesIO()
+        image.save(buffer, format=sourceFormat)
+        return buffer, sourceFormat
+
+    policies = {
+        'original': original,
+        'auto': lambda image, sourceFormat: index.encodeThumbnail(image, {'format': 'auto'}, sourceFormat),
+        'budget': lambda image, sourceFormat: index.encodeThumbnail(
+            image, {'format': 'auto', 'maxBytes': args.max_bytes}, sourceFormat),
+    }
+
+    for kind in ('photo', 'screenshot', 'alpha'):
+        images = makeImages(kind, args.images, args.edge)
+        for name, encode in policies.items():
+            size, seconds, formats = measure(images, encode)
+            print(f'{kind:>10} {name:>8}: {size / 1024:8.1f} KB  {seconds * 1000:7.1f} ms  {",".join(sorted(formats))}')
+
+
+if __name__ == '__main__':
+    main()
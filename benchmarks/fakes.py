@@ -0,0 +1,673 @@
+#
+# In-process stand-ins for the AWS services used by our Lambda functions, for local benchmarking
+#
+
+import bisect
+import collections
+import datetime
+import contextlib
+import io
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+
+def throttled(operation, code='ThrottlingException'):
+
+    return ClientError({'Error': {'Code': code, 'Message': 'Rate exceeded'}}, operation)
+
+
+class FakeS3:
+
+    def __init__(self, latency=0.0, errorRate=0.0):
+        self.latency = latency
+        self.errorRate = errorRate
+        self.objects = {}
+        self.modified = {}
+        self.deleteCalls = 0
+        self.lock = threading.Lock()
+
+    def _sleep(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def put(self, bucket, key, body, modified=None):
+        with self.lock:
+            self.objects[(bucket, key)] = bytes(body)
+            self.modified[(bucket, key)] = modified or datetime.datetime.now(datetime.timezone.utc)
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        self._sleep()
+        body = self.objects[(Bucket, Key)]
+        modified = self.modified[(Bucket, Key)]
+        if Range is None:
+            return {'Body': io.BytesIO(body), 'ContentLength': len(body), 'LastModified': modified}
+
+        # Only "bytes=<first>-<last>" ranges, which S3 refuses for an empty object
+        first, last = (int(x) for x in Range.split('=')[1].split('-'))
+        if first >= len(body):
+            raise ClientError({'Error': {'Code': 'InvalidRange', 'Message': 'The requested range is not satisfiable'},
+                               'ResponseMetadata': {'HTTPStatusCode': 416}}, 'GetObject')
+        part = body[first:last + 1]
+        return {
+            'Body': io.BytesIO(part),
+            'ContentLength': len(part),
+            'ContentRange': f'bytes {first}-{first + len(part) - 1}/{len(body)}',
+            'LastModified': modified,
+        }
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self._sleep()
+        self.put(Bucket, Key, Body)
+        return {}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self._sleep()
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({'Error': {'Code': '404', 'Message': 'Not Found'},
+                               'ResponseMetadata': {'HTTPStatusCode': 404}}, 'HeadObject')
+        return {'ContentLength': len(self.objects[(Bucket, Key)]), 'LastModified': self.modified[(Bucket, Key)]}
+
+    def download_file(self, Bucket, Key, Filename):
+        self._sleep()
+        with open(Filename, 'wb') as f:
+            f.write(self.objects[(Bucket, Key)])
+
+    def upload_file(self, Filename, Bucket, Key):
+        self._sleep()
+        with open(Filename, 'rb') as f:
+            self.put(Bucket, Key, f.read())
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self._sleep()
+        with self.lock:
+            self.objects.pop((Bucket, Key), None)
+            self.modified.pop((Bucket, Key), None)
+        return {}
+
+    def Object(self, bucket, key):
+        # Enough of the resource API for servicelambda's deleteImage
+        fake = self
+
+        class FakeObject:
+            def delete(self):
+                return fake.delete_object(Bucket=bucket, Key=key)
+
+        return FakeObject()
+
+    def Bucket(self, bucket):
+        # DeleteObjects through the resource API, for servicelambda's deleteImages
+        fake = self
+
+        class FakeBucket:
+            def delete_objects(self, Delete, **kwargs):
+                return fake.delete_objects(Bucket=bucket, Delete=Delete)
+
+        return FakeBucket()
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        self._sleep()
+        if len(Delete['Objects']) > 1000:
+            raise ValueError('Too many keys for the DeleteObjects call')
+        errors = []
+        with self.lock:
+            self.deleteCalls += 1
+            for entry in Delete['Objects']:
+                # Simulate S3 shedding load by failing some of the keys
+                if self.errorRate and random.random() < self.errorRate:
+                    errors.append({'Key': entry['Key'], 'Code': 'SlowDown', 'Message': 'Please reduce your request rate.'})
+                    continue
+                self.objects.pop((Bucket, entry['Key']), None)
+                self.modified.pop((Bucket, entry['Key']), None)
+        return {'Errors': errors} if errors else {}
+
+
+def makeJpeg(width, height, seed=0, thumbnail=None, orientation=1):
+
+    # Noisy gradient so the encoder does real work, like a phone photo would, with a few
+    # random shapes so every seed gives a visually different image. Like a camera JPEG it may
+    # carry an EXIF orientation and a thumbnail of the given size
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(seed)
+    image = Image.linear_gradient('L').rotate(rng.uniform(0, 360)).resize((width, height)).convert('RGB')
+    draw = ImageDraw.Draw(image)
+    for _ in range(6):
+        x, y = rng.randrange(width), rng.randrange(height)
+        radius = rng.randint(width // 10, width // 3)
+        colour = tuple(rng.randrange(256) for _ in range(3))
+        draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill=colour)
+    noise = Image.effect_noise((width, height), 40 + rng.randint(0, 20)).convert('RGB')
+    image = Image.blend(image, noise, 0.3)
+    options = {'exif': makeExif(image, thumbnail, orientation)} if thumbnail or orientation != 1 else {}
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=90, **options)
+    return buffer.getvalue()
+
+
+def makeExif(image, thumbnail=None, orientation=1):
+
+    # Little-endian TIFF structure with IFD0 holding the orientation, and IFD1 pointing at a JPEG
+    # thumbnail stored right after it
+    import struct
+
+    ifd0 = struct.pack('<H', 1) + struct.pack('<HHLHH', 0x0112, 3, 1, orientation, 0)
+    tiff = b'II*\x00' + struct.pack('<L', 8) + ifd0
+    if not thumbnail:
+        return b'Exif\x00\x00' + tiff + struct.pack('<L', 0)
+
+    small = image.copy()
+    small.thumbnail(thumbnail)
+    buffer = io.BytesIO()
+    small.save(buffer, format='JPEG', quality=80)
+    ifd1Offset = len(tiff) + 4
+    dataOffset = ifd1Offset + 2 + 2 * 12 + 4
+    ifd1 = (struct.pack('<H', 2) + struct.pack('<HHLL', 0x0201, 4, 1, dataOffset)
+            + struct.pack('<HHLL', 0x0202, 4, 1, buffer.tell()) + struct.pack('<L', 0))
+    return b'Exif\x00\x00' + tiff + struct.pack('<L', ifd1Offset) + ifd1 + buffer.getvalue()
+
+
+def makeScreenshot(width, height, seed=0):
+
+    # Flat UI panels with lines of text, the kind of PNG a screenshot upload is
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(seed)
+    image = Image.new('RGB', (width, height), (245, 245, 245))
+    draw = ImageDraw.Draw(image)
+    for _ in range(8):
+        x0, x1 = sorted(rng.randrange(width) for _ in range(2))
+        y0, y1 = sorted(rng.randrange(height) for _ in range(2))
+        draw.rectangle((x0, y0, x1, y1), fill=tuple(rng.randrange(128, 256) for _ in range(3)), outline=(90, 90, 90))
+    for y in range(20, height - 20, 24):
+        words = ' '.join(''.join(rng.choice('abcdefghij') for _ in range(rng.randint(2, 9))) for _ in range(12))
+        draw.text((20, y), words, fill=(20, 20, 20))
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+class FakeRekognition:
+
+    LABELS = ['Person', 'Dog', 'Cat', 'Tree', 'Car', 'Building', 'Sky', 'Food', 'Beach', 'Flower',
+              'Mountain', 'Water', 'Bicycle', 'Phone', 'Book', 'Chair', 'Table', 'Cup', 'Grass', 'Road']
+
+    def __init__(self, latency=0.0, jitter=0.0, throttleRate=0.0, s3=None, perMegabyte=0.0, perMegapixel=0.0,
+                 tpsLimit=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.throttleRate = throttleRate
+        # Account limit: calls beyond tpsLimit in any one second window are throttled
+        self.tpsLimit = tpsLimit
+        self.window = collections.deque()
+        # Latency model: moving the image (reading it from s3, or receiving it inline) costs
+        # perMegabyte seconds per MB, decoding it perMegapixel seconds per megapixel
+        self.s3 = s3
+        self.perMegabyte = perMegabyte
+        self.perMegapixel = perMegapixel
+        self.calls = 0
+        self.throttles = 0
+        self.lock = threading.Lock()
+
+    def imageCost(self, Image):
+        if 'Bytes' in Image:
+            data = Image['Bytes']
+        elif self.s3 is not None:
+            data = self.s3.objects[(Image['S3Object']['Bucket'], Image['S3Object']['Name'])]
+        else:
+            return 0.0
+        from PIL import Image as pilImage
+
+        with pilImage.open(io.BytesIO(data)) as image:
+            megapixels = image.width * image.height / 1e6
+        return self.perMegabyte * len(data) / 1e6 + self.perMegapixel * megapixels
+
+    def detect_labels(self, Image, MaxLabels=10, MinConfidence=50, **kwargs):
+        cost = self.imageCost(Image) if self.perMegabyte or self.perMegapixel else 0.0
+        if self.latency or self.jitter or cost:
+            time.sleep(self.latency + random.uniform(0, self.jitter) + cost)
+        with self.lock:
+            if self.throttleRate and random.random() < self.throttleRate:
+                self.throttles += 1
+                raise throttled('DetectLabels')
+            if self.tpsLimit:
+                now = time.monotonic()
+                while self.window and self.window[0] <= now - 1.0:
+                    self.window.popleft()
+                if len(self.window) >= self.tpsLimit:
+                    self.throttles += 1
+                    raise throttled('DetectLabels')
+                self.window.append(now)
+            self.calls += 1
+        name = Image.get('S3Object', {}).get('Name', '') or str(len(Image.get('Bytes', b'')))
+        rng = random.Random(name)
+        labels = []
+        for label in rng.sample(self.LABELS, min(MaxLabels, len(self.LABELS))):
+            confidence = rng.uniform(50, 99.9)
+            if confidence >= MinConfidence:
+                labels.append({'Name': label, 'Confidence': confidence, 'Instances': [], 'Parents': []})
+        labels.sort(key=lambda label: -label['Confidence'])
+        return {'Labels': labels}
+
+
+class FakeTable:
+
+    # keyName is the partition key, or a (partition key, sort key) tuple; so are the keys of the
+    # global secondary indexes, by index name
+
+    def __init__(self, latency=0.0, keyName='image', indexes=None):
+        self.latency = latency
+        self.keyName = keyName
+        self.indexes = indexes or {}
+        self.items = {}
+        self.writes = 0
+        self.reads = 0
+        self.queries = 0
+        self.partitions = None
+
+    def key(self, item):
+        if isinstance(self.keyName, tuple):
+            return tuple(item[name] for name in self.keyName)
+        return item[self.keyName]
+
+    def put_item(self, Item, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        self.store(Item)
+        return {}
+
+    def store(self, item):
+        self.writes += 1
+        self.items[self.key(item)] = dict(item)
+        self.partitions = None
+
+    def get_item(self, Key, ProjectionExpression=None, ExpressionAttributeNames=None, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        self.reads += 1
+        item = self.items.get(self.key(Key))
+        if item is None:
+            return {}
+        if ProjectionExpression:
+            names = ExpressionAttributeNames or {}
+            projected = [names.get(name.strip(), name.strip()) for name in ProjectionExpression.split(',')]
+            item = {name: item[name] for name in projected if name in item}
+        return {'Item': dict(item)}
+
+    def delete_item(self, Key, ReturnValues=None, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        item = self.items.get(self.key(Key))
+        self.discard(Key)
+        return {'Attributes': dict(item)} if ReturnValues == 'ALL_OLD' and item is not None else {}
+
+    @contextlib.contextmanager
+    def batch_writer(self):
+        # Writes go out 25 at a time, like boto3's batch writer
+        table = self
+        pending = []
+
+        class Writer:
+            def put_item(self, Item):
+                pending.append(('put', Item))
+                flush(25)
+
+            def delete_item(self, Key):
+                pending.append(('delete', Key))
+                flush(25)
+
+        def flush(size):
+            while len(pending) >= size and pending:
+                if table.latency:
+                    time.sleep(table.latency)
+                for operation, value in pending[:25]:
+                    if operation == 'put':
+                        table.store(value)
+                    else:
+                        table.discard(value)
+                del pending[:25]
+
+        yield Writer()
+        flush(1)
+
+    def discard(self, key):
+        self.writes += 1
+        self.items.pop(self.key(key), None)
+        self.partitions = None
+
+    def query(self, KeyConditionExpression, ExpressionAttributeValues, ExpressionAttributeNames=None,
+              FilterExpression=None, ExclusiveStartKey=None, Limit=None, IndexName=None, ScanIndexForward=True,
+              ProjectionExpression=None, **kwargs):
+        # Only "<partition key> = :v [AND <sort key> >= :w]" key conditions and "<attribute> >= :x"
+        # filters, with "#name" placeholders; Limit counts the items read before filtering, as in DynamoDB
+        if self.latency:
+            time.sleep(self.latency)
+        self.queries += 1
+        names = ExpressionAttributeNames or {}
+        conditions = []
+        for expression in KeyConditionExpression.split(' AND ') + ([FilterExpression] if FilterExpression else []):
+            name, operator, placeholder = expression.split()
+            conditions.append((names.get(name, name), operator, ExpressionAttributeValues[placeholder]))
+
+        # Partitions are sorted on the sort key, then the table key, which tells items apart in an index
+        tableKeys = self.keyName if isinstance(self.keyName, tuple) else (self.keyName,)
+        keys = self.indexes[IndexName] if IndexName else tableKeys
+        partitionKey, sortKey = (keys + (None,))[:2]
+
+        def position(item):
+            return (item[sortKey] if sortKey else '',) + tuple(item[name] for name in tableKeys)
+
+        if self.partitions is None:
+            self.partitions = {}
+        if IndexName not in self.partitions:
+            partitions = self.partitions[IndexName] = collections.defaultdict(list)
+            for item in self.items.values():
+                if all(name in item for name in keys):
+                    partitions[item[partitionKey]].append(item)
+            for partition in partitions.values():
+                partition.sort(key=position)
+        partition = self.partitions[IndexName].get(conditions[0][2], [])
+        if not ScanIndexForward:
+            partition = partition[::-1]
+
+        start = 0
+        if ExclusiveStartKey is not None:
+            positions = [position(item) for item in partition]
+            if ScanIndexForward:
+                start = bisect.bisect_right(positions, position(ExclusiveStartKey))
+            else:
+                start = len(positions) - bisect.bisect_left(positions[::-1], position(ExclusiveStartKey))
+        read = []
+        for item in partition[start:]:
+            if any(item[name] < value for name, operator, value in conditions[1:] if name == sortKey):
+                continue
+            read.append(item)
+            if Limit and len(read) == Limit:
+                break
+        items = [dict(item) for item in read
+                 if all(item.get(name) is not None and item[name] >= value
+                        for name, operator, value in conditions[1:] if name != sortKey)]
+        if ProjectionExpression:
+            projected = [names.get(name.strip(), name.strip()) for name in ProjectionExpression.split(',')]
+            items = [{name: item[name] for name in projected if name in item} for item in items]
+
+        response = {'Items': items, 'Count': len(items)}
+        if Limit and len(read) == Limit and read[-1] is not partition[-1]:
+            response['LastEvaluatedKey'] = {name: read[-1][name] for name in set(keys + tableKeys) if name}
+        return response
+
+
+class FakeDynamoDB:
+
+    def __init__(self, latency=0.0, unprocessedRate=0.0, keys=None, indexes=None):
+        self.latency = latency
+        self.unprocessedRate = unprocessedRate
+        self.keys = keys or {}
+        self.indexes = indexes or {}
+        self.tables = {}
+        self.batchCalls = 0
+
+    def Table(self, name):
+        # Tables are created on first use, keyed on "image" unless told otherwise
+        if name not in self.tables:
+            self.tables[name] = FakeTable(self.latency, self.keys.get(name, 'image'), self.indexes.get(name))
+        return self.tables[name]
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        self.batchCalls += 1
+        unprocessed = {}
+        if sum(len(requests) for requests in RequestItems.values()) > 25:
+            raise ValueError('Too many items requested for the BatchWriteItem call')
+        for name, requests in RequestItems.items():
+            table = self.Table(name)
+            for request in requests:
+                # Simulate write-capacity pressure by handing some items back
+                if self.unprocessedRate and random.random() < self.unprocessedRate:
+                    unprocessed.setdefault(name, []).append(request)
+                    continue
+                if 'PutRequest' in request:
+                    table.store(request['PutRequest']['Item'])
+                else:
+                    table.discard(request['DeleteRequest']['Key'])
+        return {'UnprocessedItems': unprocessed}
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        self.batchCalls += 1
+        responses = {}
+        unprocessed = {}
+        for name, request in RequestItems.items():
+            table = self.Table(name)
+            if len(request['Keys']) > 100:
+                raise ValueError('Too many items requested for the BatchGetItem call')
+            for key in request['Keys']:
+                # Simulate read-capacity pressure by handing some keys back
+                if self.unprocessedRate and random.random() < self.unprocessedRate:
+                    unprocessed.setdefault(name, {'Keys': []})['Keys'].append(key)
+                    continue
+                item = table.items.get(table.key(key))
+                if item is not None:
+                    responses.setdefault(name, []).append(dict(item))
+        return {'Responses': responses, 'UnprocessedKeys': unprocessed}
+
+
+class FakeDynamoDBClient:
+
+    # The low-level client API over the same tables as a FakeDynamoDB resource, so one side can
+    # write with the client and the other read with the resource
+
+    def __init__(self, resource, pageSize=None):
+        self.resource = resource
+        self.pageSize = pageSize
+        self.queries = 0
+
+    @staticmethod
+    def fromAttributes(item):
+        return {
+            name: (float(value['N']) if '.' in value['N'] else int(value['N'])) if 'N' in value else value['S']
+            for name, value in item.items()
+        }
+
+    @staticmethod
+    def toAttributes(item):
+        return {
+            name: {'N': str(value)} if isinstance(value, (int, float)) else {'S': value}
+            for name, value in item.items()
+        }
+
+    def put_item(self, TableName, Item, **kwargs):
+        return self.resource.Table(TableName).put_item(Item=self.fromAttributes(Item))
+
+    def get_item(self, TableName, Key, ProjectionExpression=None, **kwargs):
+        response = self.resource.Table(TableName).get_item(Key=self.fromAttributes(Key),
+                                                           ProjectionExpression=ProjectionExpression)
+        return {'Item': self.toAttributes(response['Item'])} if 'Item' in response else {}
+
+    def delete_item(self, TableName, Key, **kwargs):
+        return self.resource.Table(TableName).delete_item(Key=self.fromAttributes(Key))
+
+    def query(self, TableName, KeyConditionExpression, ExpressionAttributeValues, ExclusiveStartKey=None,
+              ProjectionExpression=None, **kwargs):
+        # Only "<attribute> = :<value>" conditions; pages of pageSize items stand in for DynamoDB's 1 MB
+        table = self.resource.Table(TableName)
+        if table.latency:
+            time.sleep(table.latency)
+        self.queries += 1
+        name, placeholder = (part.strip() for part in KeyConditionExpression.split('='))
+        value = self.fromAttributes({'v': ExpressionAttributeValues[placeholder]})['v']
+        items = sorted((item for item in list(table.items.values()) if item.get(name) == value), key=table.key)
+        if ExclusiveStartKey is not None:
+            start = table.key(self.fromAttributes(ExclusiveStartKey))
+            items = [item for item in items if table.key(item) > start]
+        response = {}
+        if self.pageSize is not None and len(items) > self.pageSize:
+            items = items[:self.pageSize]
+            keyNames = table.keyName if isinstance(table.keyName, tuple) else (table.keyName,)
+            response['LastEvaluatedKey'] = self.toAttributes({name: items[-1][name] for name in keyNames})
+        if ProjectionExpression:
+            projected = [name.strip() for name in ProjectionExpression.split(',')]
+            items = [{name: item[name] for name in projected if name in item} for item in items]
+        response.update(Items=[self.toAttributes(item) for item in items], Count=len(items))
+        return response
+
+    def scan(self, TableName, FilterExpression=None, ExclusiveStartKey=None, **kwargs):
+        # Only "attribute_not_exists(<attribute>)" filters, applied after the page is cut, as by DynamoDB
+        table = self.resource.Table(TableName)
+        if table.latency:
+            time.sleep(table.latency)
+        items = sorted(list(table.items.values()), key=table.key)
+        if ExclusiveStartKey is not None:
+            start = table.key(self.fromAttributes(ExclusiveStartKey))
+            items = [item for item in items if table.key(item) > start]
+        response = {}
+        if self.pageSize is not None and len(items) > self.pageSize:
+            items = items[:self.pageSize]
+            keyNames = table.keyName if isinstance(table.keyName, tuple) else (table.keyName,)
+            response['LastEvaluatedKey'] = self.toAttributes({name: items[-1][name] for name in keyNames})
+        if FilterExpression:
+            missing = FilterExpression.strip()[len('attribute_not_exists('):-1].strip()
+            items = [item for item in items if missing not in item]
+        response.update(Items=[self.toAttributes(item) for item in items], Count=len(items))
+        return response
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        response = self.resource.batch_get_item(RequestItems={
+            name: {'Keys': [self.fromAttributes(key) for key in request['Keys']]}
+            for name, request in RequestItems.items()
+        })
+        return {
+            'Responses': {
+                name: [self.toAttributes(item) for item in items] for name, items in response['Responses'].items()
+            },
+            'UnprocessedKeys': {
+                name: {'Keys': [self.toAttributes(key) for key in request['Keys']]}
+                for name, request in response['UnprocessedKeys'].items()
+            },
+        }
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        requests = {
+            name: [
+                {'PutRequest': {'Item': self.fromAttributes(request['PutRequest']['Item'])}} if 'PutRequest' in request
+                else {'DeleteRequest': {'Key': self.fromAttributes(request['DeleteRequest']['Key'])}}
+                for request in tableRequests
+            ]
+            for name, tableRequests in RequestItems.items()
+        }
+        unprocessed = self.resource.batch_write_item(RequestItems=requests)['UnprocessedItems']
+        return {'UnprocessedItems': {
+            name: [
+                {'PutRequest': {'Item': self.toAttributes(request['PutRequest']['Item'])}} if 'PutRequest' in request
+                else {'DeleteRequest': {'Key': self.toAttributes(request['DeleteRequest']['Key'])}}
+                for request in tableRequests
+            ]
+            for name, tableRequests in unprocessed.items()
+        }}
+
+
+class FakeCognitoIdentity:
+
+    # GetId of an identity pool, for the ID tokens it is given (token -> identity id)
+
+    def __init__(self, identities):
+        self.identities = identities
+        self.calls = 0
+
+    def get_id(self, IdentityPoolId, Logins, **kwargs):
+        self.calls += 1
+        for token in Logins.values():
+            if token in self.identities:
+                return {'IdentityId': self.identities[token]}
+        raise ClientError({'Error': {'Code': 'NotAuthorizedException', 'Message': 'Invalid login token.'}}, 'GetId')
+
+
+class FakeContext:
+
+    # Lambda context with a running clock, for the handler's deadline
+    def __init__(self, timeout=30.0):
+        self.end = time.monotonic() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.end - time.monotonic()) * 1000))
+
+
+def makeSqsEvent(bucket, keys, perMessage=1, s3=None, prefix='msg'):
+
+    # Same shape as the S3 -> SQS notifications wired up in backend_stack.py; with an S3
+    # stand-in the records carry the real size and an MD5 eTag of the stored objects
+    import hashlib
+    import json
+
+    def s3Object(key):
+        if s3 is None:
+            return {'key': key, 'size': 0}
+        body = s3.objects[(bucket, key)]
+        return {'key': key, 'size': len(body), 'eTag': hashlib.md5(body).hexdigest()}
+
+    records = []
+    for i in range(0, len(keys), perMessage):
+        s3Records = [{'s3': {'bucket': {'name': bucket}, 'object': s3Object(key)}}
+                     for key in keys[i:i + perMessage]]
+        records.append({
+            'messageId': f'{prefix}-{i}',
+            'receiptHandle': f'{prefix}-{i}-handle',
+            'body': json.dumps({'Records': s3Records}),
+            'eventSource': 'aws:sqs',
+            'eventSourceARN': 'arn:aws:sqs:us-west-2:123456789012:ImageQueue',
+        })
+    return {'Records': records}
+
+
+class FakeSQS:
+
+    # A queue of SQS records that hands out batches, and redelivers the messages reported in
+    # batchItemFailures (or the whole batch when the handler raised), like the Lambda poller does.
+    # Messages go to the dead-letter queue after maxReceiveCount receives, as in backend_stack.py
+
+    def __init__(self, maxReceiveCount=5):
+        self.maxReceiveCount = maxReceiveCount
+        self.messages = collections.deque()
+        self.receives = collections.Counter()
+        self.deadLetters = []
+        self.released = 0
+        self.lock = threading.Lock()
+
+    def send(self, records):
+        with self.lock:
+            self.messages.extend(records)
+
+    def receive(self, batchSize=10):
+        with self.lock:
+            batch = [self.messages.popleft() for _ in range(min(batchSize, len(self.messages)))]
+            for record in batch:
+                self.receives[record['messageId']] += 1
+        return {'Records': batch}
+
+    def complete(self, batch, response=None, error=None):
+        if error is not None:
+            failed = {record['messageId'] for record in batch['Records']}
+        else:
+            failed = {failure['itemIdentifier'] for failure in (response or {}).get('batchItemFailures', [])}
+        with self.lock:
+            for record in batch['Records']:
+                if record['messageId'] not in failed:
+                    continue
+                if self.receives[record['messageId']] >= self.maxReceiveCount:
+                    self.deadLetters.append(record)
+                else:
+                    self.messages.append(record)
+
+    def change_message_visibility_batch(self, QueueUrl, Entries, **kwargs):
+        # Failed messages are redelivered straight away here anyway, so only count them
+        with self.lock:
+            self.released += len(Entries)
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+    def __len__(self):
+        with self.lock:
+            return len(self.messages)
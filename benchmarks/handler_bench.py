@@ -0,0 +1,75 @@
+#
+# Compare sequential and thread-pool processing of an SQS batch by the rekognition handler,
+# against in-process S3, Rekognition and DynamoDB stand-ins with injected latency
+#
+# Usage: python benchmarks/handler_bench.py [--batch 10] [--latency 0.05] [--workers 1,4,8,16]
+#
+
+import argparse
+import contextlib
+import io
+import os
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, '..', 'rekognitionLambda'))
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+os.environ.setdefault('RESIZEDBUCKET', 'resized')
+os.environ.setdefault('TABLE', 'labels')
+
+BUCKET = 'images'
+
+
+def runWorkers(workers, batch, latency, size, rounds):
+
+    os.environ['MAX_WORKERS'] = str(workers)
+    import fakes
+    import index
+
+    index.s3_client = s3 = fakes.FakeS3(latency)
+    index.rekognition_client = fakes.FakeRekognition(latency)
+    index.dynamodb = fakes.FakeDynamoDBClient(fakes.FakeDynamoDB(latency))
+
+    keys = [f'private/user/photo{i}.jpg' for i in range(batch)]
+    for i, key in enumerate(keys):
+        s3.put(BUCKET, key, fakes.makeJpeg(size[0], size[1], seed=i))
+    event = fakes.makeSqsEvent(BUCKET, keys, s3=s3)
+
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            index.handler(event, None)
+        timings.append(time.perf_counter() - start)
+
+    best = min(timings)
+    print(f'workers {workers:>3}: batch {best * 1000:8.1f} ms  {batch / best:7.1f} images/s')
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--size', default='1600x1200')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--workers', default='1,4,8,16')
+    args = parser.parse_args()
+
+    if ',' not in args.workers:
+        size = tuple(int(x) for x in args.size.split('x'))
+        return runWorkers(int(args.workers), args.batch, args.latency, size, args.rounds)
+
+    # MAX_WORKERS is read at import time, so each setting gets a fresh interpreter
+    for workers in args.workers.split(','):
+        subprocess.run([sys.executable, __file__, '--workers', workers, '--batch', str(args.batch),
+                        '--latency', str(args.latency), '--size', args.size, '--rounds', str(args.rounds)],
+                       check=True)
+
+
+if __name__ == '__main__':
+    main()
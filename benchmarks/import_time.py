@@ -0,0 +1,66 @@
+#
+# Import-time profile of rekognitionLambda's cold start, from python -X importtime
+#
+# Reports the cumulative import time of index.py (what a cold start pays before the handler
+# runs), the deferred cost of loadPIL() on the first resize, and what a full Image.init() would
+# cost instead, with the slowest top-level imports of each.
+#
+# Usage: python benchmarks/import_time.py [--top 15] [--runs 5]
+#
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LAMBDA = os.path.join(HERE, '..', 'rekognitionLambda')
+
+SCENARIOS = [
+    ('import index', 'import index'),
+    ('import index + loadPIL()', 'import index; index.loadPIL()'),
+    ('PIL Image.init() (all plugins)', 'from PIL import Image; Image.init()'),
+]
+
+LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)')
+
+
+def profile(code):
+
+    env = dict(os.environ, AWS_DEFAULT_REGION='us-west-2', RESIZEDBUCKET='resized', TABLE='labels')
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=LAMBDA, env=env,
+                            stderr=subprocess.PIPE, universal_newlines=True, check=True)
+
+    # Top-level imports are the ones without indentation in the tree; their cumulative times
+    # add up to the whole import cost. Their direct imports show where that time goes
+    total = 0
+    modules = []
+    for line in result.stderr.splitlines():
+        match = LINE.match(line)
+        if match is None:
+            continue
+        if not match.group(3):
+            total += int(match.group(2))
+        if len(match.group(3)) <= 2:
+            modules.append((int(match.group(2)), match.group(4)))
+    return total, modules
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--top', type=int, default=15)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    for label, code in SCENARIOS:
+        # Best of several runs, since the first one also pays for filesystem caches
+        total, modules = min((profile(code) for _ in range(args.runs)), key=lambda run: run[0])
+        print(f'{label}: {total / 1000:8.1f} ms')
+        for cumulative, name in sorted(modules, reverse=True)[:args.top]:
+            print(f'    {cumulative / 1000:8.1f} ms  {name}')
+
+
+if __name__ == '__main__':
+    main()
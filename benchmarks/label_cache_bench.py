@@ -0,0 +1,81 @@
+#
+# Measure Rekognition calls saved by the content-hash label cache on a corpus with duplicates,
+# against in-process Rekognition and DynamoDB stand-ins with injected latency
+#
+# Usage: python benchmarks/label_cache_bench.py [--images 500] [--duplicates 0.3] [--latency 0.02]
+#
+
+import argparse
+import hashlib
+import os
+import random
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, '..', 'rekognitionLambda'))
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+os.environ.setdefault('RESIZEDBUCKET', 'resized')
+os.environ.setdefault('TABLE', 'labels')
+
+
+def runCache(images, duplicates, latency, label):
+
+    import contextlib
+    import io
+    import fakes
+    import index
+
+    index.rekognition_client = rekognition = fakes.FakeRekognition(latency)
+    index.dynamodb = fakes.FakeDynamoDBClient(fakes.FakeDynamoDB(latency / 4, keys={'labelcache': 'contentHash'}))
+
+    # Each upload either repeats an earlier photo (same bytes, new key) or is a new one
+    rng = random.Random(0)
+    contents = []
+    uploads = []
+    for i in range(images):
+        if contents and rng.random() < duplicates:
+            body = rng.choice(contents)
+        else:
+            body = f'photo-{i}'.encode() * 64
+            contents.append(body)
+        uploads.append((f'private/user/upload{i}.jpg', f'{hashlib.md5(body).hexdigest()}-{len(body)}'))
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for key, contentKey in uploads:
+            index.detectLabels('images', key, contentKey)
+    elapsed = time.perf_counter() - start
+
+    print(f'{label:>12}: {elapsed * 1000:8.1f} ms  {rekognition.calls:5d} detect_labels calls  {index.labelCacheStats}')
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', type=int, default=500)
+    parser.add_argument('--duplicates', type=float, default=0.3)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--label')
+    args = parser.parse_args()
+
+    if args.label:
+        return runCache(args.images, args.duplicates, args.latency, args.label)
+
+    # The cache is configured at import time, so each setting gets a fresh interpreter
+    settings = [
+        ('no cache', {'LABEL_CACHE_SIZE': '0'}),
+        ('memory', {'LABEL_CACHE_SIZE': '1024'}),
+        ('memory+table', {'LABEL_CACHE_SIZE': '16', 'CACHETABLE': 'labelcache'}),
+    ]
+    for label, env in settings:
+        subprocess.run([sys.executable, __file__, '--label', label, '--images', str(args.images),
+                        '--duplicates', str(args.duplicates), '--latency', str(args.latency)],
+                       env=dict(os.environ, **env), check=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#
+# Loading the labels of a gallery through servicelambda: one getLabels request per image (with as
+# many in flight as a browser keeps connections to the API) against a single getLabelsBatch. Each
+# request pays an API Gateway + Lambda round-trip on top of the DynamoDB stand-in's latency
+#
+# Usage: python benchmarks/labels_batch_bench.py [--images 200] [--connections 6] [--unprocessed 0.1]
+#
+
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..')
+sys.path.insert(0, HERE)
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+os.environ.setdefault('TABLE', 'labels')
+os.environ.setdefault('BUCKET', 'images')
+os.environ.setdefault('RESIZEDBUCKET', 'resized')
+
+
+def loadServiceLambda():
+
+    spec = importlib.util.spec_from_file_location('servicelambda', os.path.join(ROOT, 'servicelambda', 'index.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def shown(result):
+
+    # What the gallery shows of an image: its key and the object1..objectN names
+    if not isinstance(result, dict):
+        return result
+    return {name: value for name, value in result.items() if name == 'image' or name.startswith('object')}
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', type=int, default=200)
+    parser.add_argument('--connections', type=int, default=6, help='requests a browser has in flight')
+    parser.add_argument('--api-latency', type=float, default=0.03, help='API Gateway + Lambda round-trip (s)')
+    parser.add_argument('--latency', type=float, default=0.008, help='DynamoDB round-trip (s)')
+    parser.add_argument('--unprocessed', type=float, default=0.1, help='share of keys BatchGetItem hands back')
+    args = parser.parse_args()
+
+    import fakes
+
+    service = loadServiceLambda()
+    service.dynamodb = dynamodb = fakes.FakeDynamoDB(args.latency, args.unprocessed)
+
+    # Both ways read from DynamoDB; read_cache_bench.py covers the read cache
+    service.readCacheSize = 0
+    table = dynamodb.Table(os.environ['TABLE'])
+    keys = [f'private/user/photo{i}.jpg' for i in range(args.images)]
+    for i, key in enumerate(keys[:-5]):
+        labels = [[f'Label{j}', 99.0 - j * 7 - i % 5, ['Parent'], []] for j in range(12)]
+        table.put_item(Item={'image': key, 'labels': json.dumps(labels), 'schemaVersion': 2, 'owner': 'user',
+                             'uploaded': '2024-05-01T00:00:00Z', 'thumbnails': json.dumps({'': key})})
+
+    def request(event):
+        time.sleep(args.api_latency)
+        return service.handler(event, None)
+
+    # getLabels fails for images without labels, so the front end only asks for labelled ones
+    labelled = keys[:-5]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.connections) as executor:
+        single = list(executor.map(lambda key: request({'action': 'getLabels', 'key': key}), labelled))
+    singleTime = time.perf_counter() - start
+
+    dynamodb.batchCalls = 0
+    start = time.perf_counter()
+    batch = request({'action': 'getLabelsBatch', 'keys': keys + keys[:10]})
+    batchTime = time.perf_counter() - start
+
+    same = all(shown(batch['images'].get(key)) == shown(result) for key, result in zip(labelled, single)) and \
+        all(batch['images'].get(key, 'No Results') == 'No Results' for key in keys[-5:])
+    # The front end joins every value of a getLabels item into its label list
+    plain = all(isinstance(value, str) and (name == 'image' or name.startswith('object'))
+                for result in single for name, value in result.items())
+    print(f'getLabels x{len(labelled)} ({args.connections} in flight): {singleTime * 1000:8.1f} ms')
+    print(f'getLabelsBatch:                      {batchTime * 1000:8.1f} ms  {dynamodb.batchCalls} BatchGetItem calls  '
+          f'unprocessed {len(batch["unprocessed"])}  results {"match" if same else "DIFFER"}')
+    print(f'getLabels items hold only the key and the label names: {"ok" if plain else "WRONG"}')
+    if not same:
+        sys.exit('getLabelsBatch and getLabels disagree')
+    if not plain:
+        sys.exit('getLabels returns values the front end can\'t show as labels')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+#
+# Listing a user's gallery: the front end's ListObjectsV2 of the user's prefix followed by one
+# getLabels request per image, against servicelambda's listImages pages. A few uploads are first
+# processed end to end by the rekognition handler, to check the items carry what listImages needs
+# (uploads in formats Rekognition can't read included); then a larger library is written directly
+# and paged through, and listing or searching someone else's images through the API is checked to
+# be refused. Every request pays an API Gateway + Lambda round-trip on top of the DynamoDB
+# stand-in's latency. Reading or deleting someone else's images by key must be refused too
+#
+# Usage: python benchmarks/list_bench.py [--images 1000] [--page 50] [--connections 6]
+#
+
+import argparse
+import contextlib
+import datetime
+import importlib.util
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..')
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(ROOT, 'rekognitionLambda'))
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+os.environ.setdefault('TABLE', 'labels')
+os.environ.setdefault('BUCKET', 'images')
+os.environ.setdefault('RESIZEDBUCKET', 'resized')
+os.environ.setdefault('NEAR_DUP_DISTANCE', '0')
+
+
+def loadServiceLambda():
+
+    spec = importlib.util.spec_from_file_location('servicelambda', os.path.join(ROOT, 'servicelambda', 'index.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def listAll(service, identityId, page, latency=0.0):
+
+    images = []
+    requests = 0
+    token = None
+    while True:
+        time.sleep(latency)
+        response = service.handler({'action': 'listImages', 'identityId': identityId, 'limit': page,
+                                    'nextToken': token}, None)
+        requests += 1
+        images.extend(response['images'])
+        token = response['nextToken']
+        if token is None:
+            return images, requests
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ingest', type=int, default=30, help='uploads processed end to end first')
+    parser.add_argument('--images', type=int, default=1000)
+    parser.add_argument('--page', type=int, default=50)
+    parser.add_argument('--connections', type=int, default=6, help='requests a browser has in flight')
+    parser.add_argument('--api-latency', type=float, default=0.03, help='API Gateway + Lambda round-trip (s)')
+    parser.add_argument('--latency', type=float, default=0.008, help='DynamoDB round-trip (s)')
+    args = parser.parse_args()
+
+    import fakes
+    import index
+
+    service = loadServiceLambda()
+    dynamodb = fakes.FakeDynamoDB(indexes={os.environ['TABLE']: {'byOwner': ('owner', 'uploaded')}})
+    index.s3_client = s3 = fakes.FakeS3()
+    index.rekognition_client = fakes.FakeRekognition()
+    index.dynamodb = fakes.FakeDynamoDBClient(dynamodb)
+    index.sqs_client = fakes.FakeSQS()
+    service.dynamodb = dynamodb
+
+    # End to end: the handler stores owner, upload time and thumbnail keys with the labels
+    identityId = 'us-west-2:ingested'
+    keys = [f'private/{identityId}/photo{i}.jpg' for i in range(args.ingest)]
+    uploaded = datetime.datetime(2024, 5, 1, tzinfo=datetime.timezone.utc)
+    for i, key in enumerate(keys):
+        s3.put('images', key, fakes.makeJpeg(320, 240, seed=i), modified=uploaded + datetime.timedelta(minutes=i))
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(0, len(keys), 10):
+            index.handler(fakes.makeSqsEvent('images', keys[i:i + 10], s3=s3, prefix=f'b{i}'), None)
+    listed, requests = listAll(service, identityId, 7)
+    ok = [image['image'] for image in listed] == keys[::-1] and all(
+        image['thumbnails'] == {'': image['image']} and image['labels'] and image['uploaded'] for image in listed)
+    print(f'{args.ingest} processed uploads listed newest first in {requests} pages, with thumbnails and labels: '
+          f'{"ok" if ok else "WRONG"}')
+    if not ok:
+        sys.exit('listImages does not return what the handler wrote')
+
+    # Formats Rekognition can't read are listed too, with their thumbnail and no labels, and can be
+    # deleted with it; an object that isn't an image is left out
+    from PIL import Image
+
+    identityId = 'us-west-2:formats'
+    uploads = {}
+    for imageFormat in ('GIF', 'WEBP'):
+        buffer = io.BytesIO()
+        Image.effect_noise((320, 240), 40).convert('RGB').save(buffer, format=imageFormat)
+        uploads[f'private/{identityId}/photo.{imageFormat.lower()}'] = buffer.getvalue()
+    uploads[f'private/{identityId}/photo.heic'] = b'\x00\x00\x00\x18ftypheic\x00\x00\x00\x00mif1heic' + bytes(2000)
+    uploads[f'private/{identityId}/notes.txt'] = b'not an image at all\n' * 50
+    for i, (key, body) in enumerate(uploads.items()):
+        s3.put('images', key, body, modified=uploaded + datetime.timedelta(minutes=i))
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        response = index.handler(fakes.makeSqsEvent('images', list(uploads), s3=s3, prefix='formats'), None)
+    listed = {image['image']: image for image in listAll(service, identityId, 10)[0]}
+    images = [key for key in uploads if not key.endswith('.txt')]
+    ok = not response['batchItemFailures'] and sorted(listed) == sorted(images) and \
+        all(listed[key]['labels'] == [] and listed[key]['thumbnails'] for key in images)
+    service.s3 = s3
+    service.handler({'action': 'deleteImages', 'keys': images}, None)
+    orphans = [key for bucket, key in s3.objects if bucket == 'resized' and key.startswith(f'private/{identityId}/')]
+    ok = ok and not orphans
+    print(f'GIF, WebP and HEIF uploads listed without labels, and deleted with their thumbnails: '
+          f'{"ok" if ok else "WRONG"}')
+    if not ok:
+        sys.exit('uploads Rekognition can\'t read are missing from the listing')
+
+    # A larger library, written straight to the table
+    identityId = 'us-west-2:library'
+    items = []
+    for i in range(args.images):
+        key = f'private/{identityId}/photo{i:05d}.jpg'
+        labels = [[f'Label{j}', 99.0 - j * 4, [], []] for j in range(15)]
+        items.append({'image': key, 'schemaVersion': 2, 'labels': json.dumps(labels), 'owner': identityId,
+                      'uploaded': (uploaded + datetime.timedelta(minutes=i)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                      'thumbnails': json.dumps({'': key})})
+    with contextlib.redirect_stdout(io.StringIO()):
+        assert not index.writeLabels(items)
+    for table in dynamodb.tables.values():
+        table.latency = args.latency
+
+    def getLabels(key):
+        time.sleep(args.api_latency)
+        return service.handler({'action': 'getLabels', 'key': key}, None)
+
+    # One ListObjectsV2 page (1000 keys) before the labels of the first screen can be asked for
+    start = time.perf_counter()
+    time.sleep(args.api_latency)
+    with ThreadPoolExecutor(max_workers=args.connections) as executor:
+        list(executor.map(getLabels, [item['image'] for item in items[::-1][:args.page]]))
+    firstOld = time.perf_counter() - start
+    with ThreadPoolExecutor(max_workers=args.connections) as executor:
+        list(executor.map(getLabels, [item['image'] for item in items[::-1][args.page:]]))
+    allOld = time.perf_counter() - start + (-(-args.images // 1000) - 1) * args.api_latency
+
+    start = time.perf_counter()
+    time.sleep(args.api_latency)
+    first = service.handler({'action': 'listImages', 'identityId': identityId, 'limit': args.page}, None)
+    firstNew = time.perf_counter() - start
+    start = time.perf_counter()
+    listed, requests = listAll(service, identityId, args.page, args.api_latency)
+    allNew = time.perf_counter() - start
+
+    # Through the API, only the caller's own images are listed or searched
+    service.identityPoolId = 'us-west-2:pool'
+    service.identityProvider = 'cognito-idp.us-west-2.amazonaws.com/us-west-2_pool'
+    service.cognito_identity = cognito = fakes.FakeCognitoIdentity({'token-library': identityId})
+    caller = {'sub': 'sub-library', 'idToken': 'token-library'}
+    own = service.handler(dict(caller, action='listImages', limit=5), None)
+    ownBatch = service.handler(dict(caller, action='getLabelsBatch', keys=[items[-1]['image']]), None)
+    stored = len(s3.objects)
+    refused = 0
+    for event in (dict(caller, action='listImages', identityId='us-west-2:ingested'),
+                  dict(caller, action='searchByLabel', identityId='us-west-2:ingested', labels='label1'),
+                  {'action': 'listImages', 'identityId': identityId},
+                  {'action': 'listImages', 'sub': 'sub-other', 'idToken': 'forged'},
+                  dict(caller, action='getLabelsBatch', keys=keys[:3]),
+                  dict(caller, action='deleteImages', keys=[items[0]['image']] + keys[:1]),
+                  dict(caller, action='deleteImage', key=keys[0]),
+                  {'action': 'deleteImages', 'keys': [items[0]['image']]}):
+        try:
+            service.handler(event, None)
+        except Exception as e:
+            refused += str(e).startswith('Forbidden')
+    service.handler(dict(caller, action='listImages', identityId=identityId, limit=5), None)
+    checked = len(own['images']) == 5 and own['images'][0]['image'] == items[-1]['image'] and refused == 8 and \
+        cognito.calls == 2 and isinstance(ownBatch['images'][items[-1]['image']], dict) and len(s3.objects) == stored
+    service.identityPoolId = None
+
+    ok = [image['image'] for image in listed] == [item['image'] for item in items[::-1]]
+    print(f'ListObjectsV2 + getLabels: first {args.page} images {firstOld * 1000:7.1f} ms  '
+          f'all {args.images} {allOld * 1000:8.1f} ms in {-(-args.images // 1000) + args.images} requests')
+    print(f'listImages:                first {len(first["images"])} images {firstNew * 1000:7.1f} ms  '
+          f'all {len(listed)} {allNew * 1000:8.1f} ms in {requests} requests  {"ok" if ok else "WRONG"}')
+    print(f'other users\' images refused to list, search, read and delete, {cognito.calls} identity lookups: '
+          f'{"ok" if checked else "WRONG"}')
+    if not ok:
+        sys.exit('listImages pages miss or repeat images')
+    if not checked:
+        sys.exit('images are served to or deleted by someone other than their owner')
+
+
+if __name__ == '__main__':
+    main()
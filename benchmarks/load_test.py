@@ -0,0 +1,204 @@
+#
+# End-to-end load test of the ingest pipeline with in-process AWS stand-ins
+#
+# Synthetic uploads are queued as S3 -> SQS notifications (the shape backend_stack.py wires up),
+# polled in batches of 10 by N concurrent "invocations" of rekognitionLambda's handler, and then
+# read back through servicelambda's getLabels. Reports per-batch and per-request latency
+# percentiles, images/s, peak RSS and peak /tmp usage for each concurrency level.
+#
+# Usage: python benchmarks/load_test.py [--images 200] [--concurrency 1,2,4] [--latency 0.05]
+#                                       [--jitter 0.05] [--throttle 0.02] [--size 2048x1536]
+#
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import logging
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..')
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(ROOT, 'rekognitionLambda'))
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+os.environ.setdefault('TABLE', 'labels')
+os.environ.setdefault('BUCKET', 'images')
+os.environ.setdefault('RESIZEDBUCKET', 'resized')
+
+
+class Sampler(threading.Thread):
+
+    # Samples RSS and the bytes held in /tmp while the load runs
+
+    def __init__(self, interval=0.02):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peakRss = 0
+        self.baseTmp = tmpUsage()
+        self.peakTmp = 0
+        self.done = threading.Event()
+
+    def run(self):
+        pageSize = os.sysconf('SC_PAGE_SIZE')
+        while not self.done.is_set():
+            with open('/proc/self/statm') as statm:
+                self.peakRss = max(self.peakRss, int(statm.read().split()[1]) * pageSize)
+            self.peakTmp = max(self.peakTmp, tmpUsage() - self.baseTmp)
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.done.set()
+        self.join()
+
+
+def tmpUsage():
+
+    total = 0
+    with os.scandir('/tmp') as entries:
+        for entry in entries:
+            try:
+                if entry.is_file(follow_symlinks=False):
+                    total += entry.stat().st_size
+            except OSError:
+                pass
+    return total
+
+
+def percentile(values, fraction):
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+def loadServiceLambda():
+
+    spec = importlib.util.spec_from_file_location('servicelambda', os.path.join(ROOT, 'servicelambda', 'index.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def runLevel(args, concurrency):
+
+    import fakes
+    import index
+
+    # Throttles and failed records are expected under load; they show up in the summary instead
+    logging.disable(logging.ERROR)
+
+    service = loadServiceLambda()
+    s3 = fakes.FakeS3(args.latency / 2)
+    rekognition = fakes.FakeRekognition(args.latency, args.jitter, args.throttle)
+    dynamodb = fakes.FakeDynamoDB(args.latency / 4, keys={'labelcache': 'contentHash'})
+    index.s3_client = s3
+    index.rekognition_client = rekognition
+    index.dynamodb = fakes.FakeDynamoDBClient(dynamodb)
+    index.labelCacheTable = index.hashTable = None
+    service.dynamodb = dynamodb
+    service.s3 = s3
+
+    width, height = (int(x) for x in args.size.split('x'))
+    keys = [f'private/user{i % 7}/photo{i}.jpg' for i in range(args.images)]
+    for i, key in enumerate(keys):
+        s3.put('images', key, fakes.makeJpeg(width, height, seed=i))
+
+    queue = fakes.FakeSQS()
+    index.sqs_client = queue
+    queue.send(fakes.makeSqsEvent('images', keys, s3=s3, prefix=f'c{concurrency}')['Records'])
+
+    batchTimings = []
+    lock = threading.Lock()
+
+    def poller():
+        while True:
+            batch = queue.receive(10)
+            if not batch['Records']:
+                return
+            start = time.perf_counter()
+            response = error = None
+            try:
+                response = index.handler(batch, None)
+            except Exception as e:
+                error = e
+            elapsed = time.perf_counter() - start
+            queue.complete(batch, response, error)
+            with lock:
+                batchTimings.append(elapsed)
+
+    sampler = Sampler()
+    sampler.start()
+    start = time.perf_counter()
+    pollers = [threading.Thread(target=poller) for _ in range(concurrency)]
+    with contextlib.redirect_stdout(io.StringIO()):
+        for thread in pollers:
+            thread.start()
+        for thread in pollers:
+            thread.join()
+    ingest = time.perf_counter() - start
+
+    # Read the labels back through the front end microservice, with the same concurrency
+    readTimings = []
+    readErrors = []
+    pending = list(keys)
+
+    def reader():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                key = pending.pop()
+            start = time.perf_counter()
+            try:
+                service.handler({'action': 'getLabels', 'key': key}, None)
+            except Exception as e:
+                readErrors.append(e)
+            with lock:
+                readTimings.append(time.perf_counter() - start)
+
+    readers = [threading.Thread(target=reader) for _ in range(concurrency)]
+    for thread in readers:
+        thread.start()
+    for thread in readers:
+        thread.join()
+    sampler.stop()
+
+    print(f'concurrency {concurrency:>3}: {args.images / ingest:7.1f} images/s  '
+          f'batch p50 {percentile(batchTimings, 0.5) * 1000:7.1f} ms  p99 {percentile(batchTimings, 0.99) * 1000:7.1f} ms  '
+          f'getLabels p50 {percentile(readTimings, 0.5) * 1000:6.1f} ms  p99 {percentile(readTimings, 0.99) * 1000:6.1f} ms  '
+          f'peak RSS {max(sampler.peakRss, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024) / 2 ** 20:7.1f} MB  '
+          f'peak /tmp {sampler.peakTmp / 2 ** 20:6.1f} MB  '
+          f'labelled {len(dynamodb.Table(index.imageLabelsTable).items)}/{args.images}  '
+          f'throttled {rekognition.throttles}  DLQ {len(queue.deadLetters)}  read errors {len(readErrors)}')
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', type=int, default=200)
+    parser.add_argument('--concurrency', default='1,2,4')
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--jitter', type=float, default=0.05)
+    parser.add_argument('--throttle', type=float, default=0.02)
+    parser.add_argument('--size', default='2048x1536')
+    args = parser.parse_args()
+
+    if ',' not in args.concurrency:
+        return runLevel(args, int(args.concurrency))
+
+    # Every level runs in a fresh interpreter, so peak memory isn't carried over between them
+    for concurrency in args.concurrency.split(','):
+        command = [sys.executable, __file__, '--concurrency', concurrency]
+        for option in ('images', 'latency', 'jitter', 'throttle', 'size'):
+            command += ['--' + option, str(getattr(args, option))]
+        subprocess.run(command, check=True)
+
+
+if __name__ == '__main__':
+    main()
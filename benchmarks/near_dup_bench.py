@@ -0,0 +1,158 @@
+#
+# Measure lookup latency of the in-process perceptual hash index as it grows. Then look up hashes
+# in the HASHTABLE stand-in, where half the stored images share one band value (flat rows of
+# pixels) and the DynamoDB stand-in returns Query pages of --page-items entries: near-duplicates
+# only findable through that crowded band must still be found by paging, deleted images must be
+# passed over, and the labels of a match must come back as they were detected. The band items of
+# the first images are written with a tenth of them handed back unprocessed, and must all be
+# stored. Finally images without detail to hash (solid colours, skies) must get no hash, so they
+# never share labels
+#
+# Usage: python benchmarks/near_dup_bench.py [--entries 1000000] [--lookups 10000] [--stored 3000]
+#
+
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, '..', 'rekognitionLambda'))
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+os.environ.setdefault('RESIZEDBUCKET', 'resized')
+os.environ.setdefault('TABLE', 'labels')
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entries', type=int, default=1000000)
+    parser.add_argument('--lookups', type=int, default=10000)
+    parser.add_argument('--distance', type=int, default=3)
+    parser.add_argument('--stored', type=int, default=3000, help='images in the hash table stand-in')
+    parser.add_argument('--page-items', type=int, default=500, help='band items per Query page')
+    args = parser.parse_args()
+
+    import index
+
+    rng = random.Random(0)
+    hashes = [rng.getrandbits(64) for _ in range(args.entries)]
+    nearDupIndex = index.HammingIndex(args.entries)
+    start = time.perf_counter()
+    for phash in hashes:
+        nearDupIndex.add(phash, None)
+    print(f'build : {args.entries} entries in {time.perf_counter() - start:6.1f} s')
+
+    # Half of the lookups are near-duplicates of indexed hashes, half are new images
+    queries = []
+    for i in range(args.lookups):
+        if i % 2:
+            phash = rng.choice(hashes)
+            for bit in rng.sample(range(64), args.distance):
+                phash ^= 1 << bit
+        else:
+            phash = rng.getrandbits(64)
+        queries.append(phash)
+
+    timings = []
+    found = 0
+    for phash in queries:
+        start = time.perf_counter()
+        found += nearDupIndex.nearest(phash, args.distance) is not None
+        timings.append(time.perf_counter() - start)
+
+    timings.sort()
+    print(f'lookup: p50 {timings[len(timings) // 2] * 1e6:7.1f} us  p99 {timings[int(len(timings) * 0.99)] * 1e6:7.1f} us  '
+          f'{found} of {len(queries)} matched')
+
+    storedLookups(index, args, rng)
+    flatImages(index)
+
+
+def storedLookups(index, args, rng):
+
+    import fakes
+
+    dynamodb = fakes.FakeDynamoDB(keys={'hashes': ('band', 'phash')})
+    index.dynamodb = client = fakes.FakeDynamoDBClient(dynamodb, pageSize=args.page_items)
+    index.hashTable = 'hashes'
+    index.imageLabelsTable = 'labels'
+    labelTable = dynamodb.Table('labels')
+
+    # Half the images have a blank lowest band
+    stored = {}
+    for i in range(args.stored):
+        dynamodb.unprocessedRate = 0.1 if i < 200 else 0.0
+        phash = rng.getrandbits(64)
+        if i % 2:
+            phash &= ~0xffff
+        key = f'private/user/photo{i}.jpg'
+        labels = [{'Name': f'Label{i % 7}', 'Confidence': 91.5, 'Parents': [{'Name': 'Thing'}],
+                   'Instances': [{'BoundingBox': {'Left': 0.1, 'Top': 0.2, 'Width': 0.3, 'Height': 0.4},
+                                  'Confidence': 88.0}]}]
+        index.indexHash(phash, {'Labels': labels}, key)
+        labelTable.store({'image': key, 'labels': json.dumps(index.compactLabels(labels))})
+        stored[phash] = (key, labels)
+    bandItems = dynamodb.Table('hashes').items.values()
+    if len(bandItems) != index.hashBands * len(stored):
+        sys.exit(f'{index.hashBands * len(stored) - len(bandItems)} band items left unprocessed')
+    itemBytes = sum(len(json.dumps(item)) for item in bandItems) / len(stored)
+
+    # Near-duplicates of crowded-band images differing in every other band: only the crowded band
+    # leads to them
+    targets = [phash for phash in stored if not phash & 0xffff][:50]
+    deleted = targets[-5:]
+    for phash in deleted:
+        labelTable.discard({'image': stored[phash][0]})
+    found = passedOver = 0
+    client.queries = 0
+    start = time.perf_counter()
+    for phash in targets:
+        query = phash ^ (1 << 20) ^ (1 << 36) ^ (1 << 52)
+        match = index.nearestStoredHash(query)
+        if phash in deleted:
+            passedOver += match is None or match[0] != phash
+        else:
+            found += match is not None and match[0] == phash and match[1]['Labels'] == stored[phash][1]
+    elapsed = (time.perf_counter() - start) / len(targets)
+    crowded = sum(1 for phash in stored if not phash & 0xffff)
+    ok = found == len(targets) - len(deleted) and passedOver == len(deleted)
+    print(f'stored: crowded band of {crowded} entries ({-(-crowded // args.page_items)} pages)  '
+          f'{found} of {len(targets) - len(deleted)} found, {passedOver} of {len(deleted)} deleted passed over  '
+          f'{client.queries / len(targets):.1f} Queries and {elapsed * 1e3:.2f} ms per lookup  '
+          f'{itemBytes:.0f} bytes of band items per image  {"ok" if ok else "WRONG"}')
+    if not ok:
+        sys.exit('stored near-duplicates not found through a crowded band')
+
+
+def flatImages(index):
+
+    import fakes
+    from PIL import Image
+
+    index.loadPIL()
+    flat = {
+        'black': Image.new('RGB', (640, 480)),
+        'white': Image.new('RGB', (640, 480), 'white'),
+        'sky': Image.linear_gradient('L').resize((640, 480)).convert('RGB'),
+        'sunset': Image.merge('RGB', [Image.linear_gradient('L').resize((640, 480)).point(lambda v: 255 - v // k)
+                                      for k in (1, 2, 4)]),
+    }
+    hashed = [name for name, image in flat.items() if index.dhash(image) is not None]
+    photo = Image.open(io.BytesIO(fakes.makeJpeg(640, 480, seed=1)))
+    copy = photo.resize((320, 240), Image.BICUBIC)
+    phash, copyHash = index.dhash(photo), index.dhash(copy)
+    ok = not hashed and phash is not None and copyHash is not None and bin(phash ^ copyHash).count('1') <= 3
+    print(f'flat images hashed: {hashed or "none"}  photo and its half-size copy '
+          f'{bin(phash ^ copyHash).count("1") if phash and copyHash else "-"} bits apart: {"ok" if ok else "WRONG"}')
+    if not ok:
+        sys.exit('images without detail share a hash')
+
+
+if __name__ == '__main__':
+    main()
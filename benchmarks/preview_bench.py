@@ -0,0 +1,113 @@
+#
+# Compare thumbnailing camera JPEGs from their embedded EXIF thumbnail with decoding the picture,
+# in latency and bytes read from S3. With previews on, JPEGs whose EXIF thumbnail claims to be huge
+# (past MAX_IMAGE_PIXELS, and past Pillow's decompression bomb warning and error limits) must still
+# be thumbnailed, from the picture
+#
+# Usage: python benchmarks/preview_bench.py [--images 20] [--size 4032x3024] [--thumbnail 320x240] [--edge 320]
+#
+
+import argparse
+import io
+import logging
+import os
+import struct
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, '..', 'rekognitionLambda'))
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+os.environ.setdefault('RESIZEDBUCKET', 'resized')
+os.environ.setdefault('TABLE', 'labels')
+
+BUCKET = 'images'
+
+
+def runMode(mode, args):
+
+    os.environ['EMBEDDED_PREVIEWS'] = mode
+    os.environ['RENDITIONS'] = f'[{{"name": "", "maxEdge": {args.edge}}}]'
+    import fakes
+    import index
+
+    class CountingS3(fakes.FakeS3):
+        def get_object(self, Bucket, Key, Range=None, **kwargs):
+            response = super().get_object(Bucket, Key, Range, **kwargs)
+            self.read += response['ContentLength']
+            return response
+
+    index.s3_client = s3 = CountingS3(args.latency)
+    s3.read = 0
+
+    width, height = (int(x) for x in args.size.split('x'))
+    thumbnail = tuple(int(x) for x in args.thumbnail.split('x'))
+    keys = [f'private/user/photo{i}.jpg' for i in range(args.images)]
+    for i, key in enumerate(keys):
+        s3.put(BUCKET, key, fakes.makeJpeg(width, height, seed=i, thumbnail=thumbnail, orientation=6))
+
+    timings = []
+    for key in keys:
+        start = time.perf_counter()
+        index.generateThumb(BUCKET, key)
+        timings.append(time.perf_counter() - start)
+
+    timings.sort()
+    print(f'previews {mode:>3}: p50 {timings[len(timings) // 2] * 1000:8.1f} ms  '
+          f'p99 {timings[int(len(timings) * 0.99)] * 1000:8.1f} ms  read {s3.read / len(keys) / 1024:8.1f} KB/image')
+    if mode == 'on':
+        hugePreviews(index, s3, fakes)
+
+
+def hugePreviews(index, s3, fakes):
+
+    from PIL import Image
+
+    # The EXIF thumbnail comes before the picture, so the first frame header is the thumbnail's:
+    # its height and width are rewritten with 4:3 sizes over each limit
+    thumbnailed = 0
+    sizes = [(9600, 7200), (20160, 15120), (40320, 30240)]
+    logging.disable(logging.WARNING)
+    for i, (width, height) in enumerate(sizes):
+        data = bytearray(fakes.makeJpeg(1600, 1200, seed=i, thumbnail=(400, 300)))
+        frame = data.index(b'\xff\xc0')
+        data[frame + 5:frame + 9] = struct.pack('>HH', height, width)
+        key = f'private/user/huge{i}.jpg'
+        s3.put(BUCKET, key, bytes(data))
+        result = index.generateThumb(BUCKET, key)
+        thumbnail = Image.open(io.BytesIO(s3.objects[(index.thumbBucket, result['thumbnails'][''])]))
+        thumbnailed += thumbnail.size == (320, 240)
+    logging.disable(logging.NOTSET)
+    ok = thumbnailed == len(sizes)
+    print(f'previews claiming {", ".join(f"{w * h / 1e6:.0f}" for w, h in sizes)} megapixels passed over, '
+          f'pictures thumbnailed: {"ok" if ok else "WRONG"}')
+    if not ok:
+        sys.exit('an oversized preview stops the thumbnail')
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', type=int, default=20)
+    parser.add_argument('--size', default='4032x3024')
+    parser.add_argument('--thumbnail', default='320x240', help='size of the embedded EXIF thumbnail')
+    parser.add_argument('--edge', type=int, default=320, help='longest edge of the rendition')
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--mode')
+    args = parser.parse_args()
+
+    if args.mode:
+        return runMode(args.mode, args)
+
+    # EMBEDDED_PREVIEWS is read at import time, so each setting gets a fresh interpreter
+    for mode in ('off', 'on'):
+        subprocess.run([sys.executable, __file__, '--mode', mode, '--images', str(args.images), '--size', args.size,
+                        '--thumbnail', args.thumbnail, '--edge', str(args.edge), '--latency', str(args.latency)],
+                       check=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+#
+# getLabels through servicelambda's read cache, against the DynamoDB stand-in with latency. A
+# stream of requests with a skewed popularity (galleries are opened again and again, a few images
+# far more than the rest) is served by one warm container with the cache off and on; each run
+# reports the time per request, the hit rate and the GetItem calls made. Then, with a short TTL,
+# images are re-labelled and deleted behind the cache's back, and must be served as they are now
+# once the TTL is up; unchanged images must be revalidated from their version alone. Finally the
+# cache must stay within its byte bound. The stats are only returned with stats=1
+#
+# Usage: python benchmarks/read_cache_bench.py [--images 2000] [--requests 5000] [--latency 0.008]
+#
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import random
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..')
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(ROOT, 'rekognitionLambda'))
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+os.environ.setdefault('TABLE', 'labels')
+os.environ.setdefault('BUCKET', 'images')
+os.environ.setdefault('RESIZEDBUCKET', 'resized')
+
+
+def loadServiceLambda():
+
+    spec = importlib.util.spec_from_file_location('servicelambda', os.path.join(ROOT, 'servicelambda', 'index.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def labelItem(key, version, names):
+
+    labels = [[name, 99.0 - j * 3, ['Parent'], []] for j, name in enumerate(names)]
+    return {'image': key, 'schemaVersion': 2, 'labels': json.dumps(labels), 'version': version}
+
+
+def resetCache(service, size, ttl, maxBytes=32 * 2 ** 20):
+
+    service.readCacheSize = size
+    service.readCacheTtl = ttl
+    service.readCacheBytes = maxBytes
+    service.forgetItems(list(service.readCache))
+    service.readCacheStats.update(hits=0, revalidated=0, misses=0, evictions=0)
+
+
+def getLabels(service, key):
+
+    return service.handler({'action': 'getLabels', 'key': key}, None)
+
+
+def labelNames(result):
+
+    if not isinstance(result, dict):
+        return result
+    return [result[f'object{n}'] for n in range(1, len(result)) if f'object{n}' in result]
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', type=int, default=2000)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--latency', type=float, default=0.008, help='DynamoDB GetItem round-trip (s)')
+    parser.add_argument('--skew', type=float, default=1.1, help='Zipf exponent of image popularity')
+    args = parser.parse_args()
+
+    import fakes
+    import index
+
+    service = loadServiceLambda()
+    dynamodb = fakes.FakeDynamoDB()
+    index.dynamodb = fakes.FakeDynamoDBClient(dynamodb)
+    service.dynamodb = dynamodb
+    table = dynamodb.Table(os.environ['TABLE'])
+
+    keys = [f'private/user/photo{i:05d}.jpg' for i in range(args.images)]
+    with contextlib.redirect_stdout(io.StringIO()):
+        assert not index.writeLabels([labelItem(key, 'v1', [f'Label{j}' for j in range(12)]) for key in keys])
+    table.latency = args.latency
+
+    rng = random.Random(1)
+    weights = [1 / (rank + 1) ** args.skew for rank in range(args.images)]
+    stream = rng.choices(keys, weights, k=args.requests)
+
+    results = {}
+    for name, size in (('off', 0), ('on', 2048)):
+        resetCache(service, size, 60)
+        table.reads = 0
+        start = time.perf_counter()
+        results[name] = [labelNames(getLabels(service, key)) for key in stream]
+        elapsed = time.perf_counter() - start
+        report = service.readCacheReport()
+        print(f'cache {name:>3}: {elapsed / args.requests * 1000:6.2f} ms per request  hit rate '
+              f'{report["hitRate"]:5.3f}  {table.reads:5d} GetItem calls  {report["entries"]} entries '
+              f'{report["bytes"] // 1024} KB')
+    if results['on'] != results['off']:
+        sys.exit('the cache changed what getLabels returns')
+
+    # The stats are only added to the item when asked for, as the front end reads every value of it
+    plain = getLabels(service, keys[0])
+    withStats = service.handler({'action': 'getLabels', 'key': keys[0], 'stats': '1'}, None)
+    ok = 'cache' not in plain and withStats['cache']['hits'] > 0
+    print(f'stats only with stats=1: {"ok" if ok else "WRONG"}')
+    if not ok:
+        sys.exit('getLabels adds the cache stats to the item unasked')
+
+    # Behind the cache's back: one image labelled again, one deleted, one unchanged
+    table.latency = 0.0
+    resetCache(service, 2048, 0.2)
+    relabelled, deleted, unchanged = keys[:3]
+    before = [labelNames(getLabels(service, key)) for key in (relabelled, deleted, unchanged)]
+    with contextlib.redirect_stdout(io.StringIO()):
+        assert not index.writeLabels([labelItem(relabelled, 'v2', ['Zebra'])])
+    table.delete_item(Key={'image': deleted})
+    within = [labelNames(getLabels(service, key)) for key in (relabelled, deleted, unchanged)]
+    time.sleep(0.25)
+    table.reads = 0
+    after = [labelNames(getLabels(service, key)) for key in (relabelled, deleted, unchanged)]
+    report = service.readCacheReport()
+    ok = within == before and after == [['Zebra'], 'No Results', before[2]] and report['revalidated'] == 1
+    print(f'within the TTL served as cached: {"yes" if within == before else "no"}; after it '
+          f're-labelled {after[0]}, deleted {after[1]!r}, unchanged revalidated {report["revalidated"]}: '
+          f'{"ok" if ok else "WRONG"}')
+    if not ok:
+        sys.exit('the cache serves changed images past its TTL')
+
+    # Bounded by bytes before entries
+    resetCache(service, 2048, 60, maxBytes=64 * 1024)
+    for key in keys[3:1000]:
+        getLabels(service, key)
+    report = service.readCacheReport()
+    ok = report['bytes'] <= 64 * 1024 and report['evictions'] > 0 and \
+        report['bytes'] == sum(entry[1] for entry in service.readCache.values())
+    print(f'64 KB bound: {report["entries"]} entries, {report["bytes"]} bytes, {report["evictions"]} evictions: '
+          f'{"ok" if ok else "WRONG"}')
+    if not ok:
+        sys.exit('the cache outgrows its byte bound')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+#
+# Searching a user's images by label through servicelambda's searchByLabel, as the library grows.
+# Libraries are labelled through rekognitionLambda's writeLabels (which maintains the label index)
+# into the DynamoDB stand-ins; each search pages through all results with nextToken and is checked
+# against a brute-force pass over the label items. Reports the Queries and time of the first page
+# and of the whole result, next to the 1 MB pages a Scan of the label table would need
+#
+# Usage: python benchmarks/search_bench.py [--sizes 1000,10000,40000] [--latency 0.005]
+#
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import random
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..')
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(ROOT, 'rekognitionLambda'))
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+os.environ.setdefault('TABLE', 'labels')
+os.environ.setdefault('LABELINDEXTABLE', 'labelindex')
+os.environ.setdefault('BUCKET', 'images')
+os.environ.setdefault('RESIZEDBUCKET', 'resized')
+
+# Label vocabulary with how often each label shows up in a photo
+VOCABULARY = [('Person', 0.6), ('Outdoors', 0.4), ('Plant', 0.3), ('Dog', 0.08), ('Cat', 0.06), ('Car', 0.1),
+              ('Beach', 0.04), ('Food', 0.15), ('Building', 0.2), ('Sky', 0.35), ('Bicycle', 0.02), ('Snow', 0.03)]
+SEARCHES = [('dog', 'and'), ('dog,outdoors', 'and'), ('bicycle,snow', 'and'), ('dog,cat', 'or')]
+
+
+def loadServiceLambda():
+
+    spec = importlib.util.spec_from_file_location('servicelambda', os.path.join(ROOT, 'servicelambda', 'index.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def labelItem(key, rng):
+
+    labels = [[name, round(rng.uniform(55, 99.9), 1), [], []] for name, share in VOCABULARY if rng.random() < share]
+    labels.sort(key=lambda label: -label[1])
+    return {'image': key, 'schemaVersion': 2, 'labels': json.dumps(labels)}
+
+
+def bruteForce(items, labels, match):
+
+    wanted = [label.lower() for label in labels.split(',')]
+    found = []
+    for item in items:
+        names = {label[0].lower() for label in json.loads(item['labels'])}
+        if (all if match == 'and' else any)(label in names for label in wanted):
+            found.append(item['image'])
+    return sorted(found)
+
+
+def search(service, identityId, labels, match, latency):
+
+    pages = []
+    token = None
+    while True:
+        before = service.dynamodb.Table(os.environ['LABELINDEXTABLE']).queries
+        start = time.perf_counter()
+        response = service.handler({'action': 'searchByLabel', 'identityId': identityId, 'labels': labels,
+                                    'match': match, 'nextToken': token}, None)
+        elapsed = time.perf_counter() - start
+        pages.append((response, service.dynamodb.Table(os.environ['LABELINDEXTABLE']).queries - before, elapsed))
+        token = response['nextToken']
+        if token is None:
+            return pages
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='1000,10000,40000')
+    parser.add_argument('--latency', type=float, default=0.005, help='DynamoDB Query round-trip (s)')
+    parser.add_argument('--item-bytes', type=int, default=1500, help='average label item size, for the Scan estimate')
+    args = parser.parse_args()
+
+    import fakes
+    import index
+
+    service = loadServiceLambda()
+    dynamodb = fakes.FakeDynamoDB(keys={os.environ['LABELINDEXTABLE']: ('ownerLabel', 'image')})
+    index.dynamodb = fakes.FakeDynamoDBClient(dynamodb)
+    service.dynamodb = dynamodb
+    service.s3 = fakes.FakeS3()
+
+    for size in (int(x) for x in args.sizes.split(',')):
+        identityId = f'us-west-2:user{size}'
+        rng = random.Random(size)
+        items = [labelItem(f'private/{identityId}/photo{i:06d}.jpg', rng) for i in range(size)]
+        dynamodb.latency = 0.0
+        for table in dynamodb.tables.values():
+            table.latency = 0.0
+        with contextlib.redirect_stdout(io.StringIO()):
+            for i in range(0, size, 500):
+                assert not index.writeLabels(items[i:i + 500])
+        for table in dynamodb.tables.values():
+            table.latency = args.latency
+
+        scanPages = -(-size * args.item_bytes // 2 ** 20)
+        print(f'library of {size} images (a Scan would read {scanPages} pages, {scanPages * args.latency * 1000:.0f} ms '
+              f'back to back)')
+        for labels, match in SEARCHES:
+            pages = search(service, identityId, labels, match, args.latency)
+            found = [image['image'] for response, queries, elapsed in pages for image in response['images']]
+            expected = bruteForce(items, labels, match)
+            first = pages[0]
+            print(f'  {labels:>14} ({match:>3}): {len(found):6d} images in {len(pages):3d} pages  '
+                  f'first page {len(first[0]["images"]):3d} images {first[1]:3d} queries {first[2] * 1000:6.1f} ms  '
+                  f'all {sum(page[1] for page in pages):5d} queries {sum(page[2] for page in pages) * 1000:7.1f} ms  '
+                  f'{"ok" if found == expected else "WRONG"}')
+            if found != expected:
+                sys.exit(f'searchByLabel {labels} ({match}) disagrees with a brute-force pass')
+
+    # Uploading again under the same key drops the labels the image lost; deleting drops them all
+    key = f'private/{identityId}/photo000000.jpg'
+    item = {'image': key, 'schemaVersion': 2, 'labels': json.dumps([['Zebra', 90.0, [], []], ['Dog', 80.0, [], []]])}
+    with contextlib.redirect_stdout(io.StringIO()):
+        assert not index.writeLabels([item])
+        item['labels'] = json.dumps([['Dog', 85.0, [], []]])
+        assert not index.writeLabels([item])
+    stale = search(service, identityId, 'zebra', 'or', 0)[0][0]['images']
+    service.handler({'action': 'deleteImage', 'key': key}, None)
+    deleted = search(service, identityId, 'dog', 'or', 0)
+    ok = not stale and all(image['image'] != key for response, queries, elapsed in deleted for image in response['images'])
+    print(f'stale labels and deleted images leave the index: {"ok" if ok else "WRONG"}')
+    if not ok:
+        sys.exit('label index not cleaned up')
+
+
+if __name__ == '__main__':
+    main()
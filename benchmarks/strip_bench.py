@@ -0,0 +1,138 @@
+#
+# Strip-wise PNG downscaling of the rekognition handler. First checks that reducing band by band
+# gives exactly the pixels of Image.reduce on the whole image, for every PNG colour type it accepts
+# and awkward sizes, factors and band heights; then thumbnails a large PNG with STRIPWISE on and off,
+# each in a fresh interpreter, and reports the time and peak RSS
+#
+# Usage: python benchmarks/strip_bench.py [--size 8000x6000] [--modes on,off] [--skip-check]
+#
+
+import argparse
+import io
+import os
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, '..', 'rekognitionLambda'))
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+os.environ.setdefault('RESIZEDBUCKET', 'resized')
+os.environ.setdefault('TABLE', 'labels')
+
+
+def makePng(size, mode, seed=0):
+
+    from PIL import Image
+
+    # Gradients and noise, so the encoder picks every scanline filter somewhere in the image
+    width, height = size
+    noise = Image.effect_noise(size, 30 + seed)
+    bands = [
+        Image.linear_gradient('L').resize(size),
+        noise,
+        Image.radial_gradient('L').resize(size),
+        Image.linear_gradient('L').rotate(90).resize(size),
+    ]
+    image = Image.merge('RGBA', bands)
+    if mode == 'P':
+        image = image.convert('RGB').quantize(200)
+    elif mode == 'PA':
+        image = image.convert('RGB').quantize(200)
+        image.info['transparency'] = bytes(range(0, 250, 2)) + b'\xff' * 75
+        mode = 'P'
+    else:
+        image = image.convert(mode)
+
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG', transparency=image.info.get('transparency'))
+    return buffer.getvalue()
+
+
+def check():
+
+    import index
+    from PIL import Image, ImageChops
+
+    index.loadPIL()
+    failures = 0
+    for mode in ('L', 'LA', 'P', 'PA', 'RGB', 'RGBA'):
+        for size, factor, rows in (((1003, 777), 2, 16), ((640, 481), 3, 7), ((257, 1000), 5, 256), ((99, 99), 4, 1)):
+            data = makePng(size, mode, seed=factor)
+            index.stripRows = rows
+            reduced = index.reduce_png_strips(io.BytesIO(data), factor)
+
+            with Image.open(io.BytesIO(data)) as image:
+                if image.mode == 'P':
+                    image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+                expected = image.reduce(factor)
+            same = reduced.mode == expected.mode and reduced.size == expected.size and \
+                ImageChops.difference(reduced, expected).getbbox() is None
+            failures += not same
+            print(f'{mode:>4} {size[0]:5d}x{size[1]:<5d} factor {factor} band {rows:3d} rows: '
+                  f'{"same" if same else "DIFFERENT"} ({reduced.mode} {reduced.size[0]}x{reduced.size[1]})')
+    if failures:
+        sys.exit(f'{failures} strip-wise reductions differ from Image.reduce')
+
+
+def peakRss():
+
+    # VmHWM, unlike ru_maxrss, isn't inherited from the parent interpreter that generated the PNG
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+
+
+def runMode(mode, path):
+
+    os.environ['STRIPWISE'] = mode
+    import index
+
+    index.loadPIL()
+    before = peakRss()
+    start = time.perf_counter()
+    with open(path, 'rb') as source:
+        thumbnails, phash, _ = index.resize_image_renditions(source)
+    elapsed = time.perf_counter() - start
+    peak = peakRss()
+
+    rendition, buffer, imageFormat = thumbnails[0]
+    print(f'STRIPWISE={mode:>3}: {elapsed * 1000:8.1f} ms  peak RSS {peak / 2 ** 20:7.1f} MB '
+          f'(+{(peak - before) / 2 ** 20:6.1f} MB while thumbnailing)  '
+          f'{imageFormat} {len(buffer.getvalue()) // 1024} KB  decode {index.decodeMetrics()}')
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', default='8000x6000')
+    parser.add_argument('--modes', default='on,off')
+    parser.add_argument('--png', help='PNG to thumbnail instead of a generated one')
+    parser.add_argument('--skip-check', action='store_true')
+    args = parser.parse_args()
+
+    if args.png and ',' not in args.modes:
+        return runMode(args.modes, args.png)
+
+    if not args.skip_check:
+        check()
+
+    path = args.png
+    if path is None:
+        size = tuple(int(x) for x in args.size.split('x'))
+        path = os.path.join('/tmp', f'strip_bench_{args.size}.png')
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.write(makePng(size, 'RGB'))
+    print(f'{path}: {os.path.getsize(path) / 2 ** 20:.1f} MB')
+
+    # Peak RSS only ever grows, so each mode gets a fresh interpreter
+    for mode in args.modes.split(','):
+        subprocess.run([sys.executable, __file__, '--modes', mode, '--png', path], check=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#
+# Sustained detectLabels throughput of the rekognition handler against a Rekognition stand-in that
+# throttles past an account TPS limit: without retries, with retries only, and with retries behind
+# the client-side token bucket
+#
+# Usage: python benchmarks/throttle_bench.py [--batches 10] [--batch 20] [--tps 10] [--modes none,retry,bucket]
+#
+
+import argparse
+import contextlib
+import io
+import os
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, '..', 'rekognitionLambda'))
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+os.environ.setdefault('RESIZEDBUCKET', 'resized')
+os.environ.setdefault('TABLE', 'labels')
+os.environ.setdefault('NEAR_DUP_DISTANCE', '0')
+
+BUCKET = 'images'
+
+# Environment of each mode; the controller is configured at import time
+MODES = {
+    'none': {'REKOGNITION_TPS': '0', 'REKOGNITION_ATTEMPTS': '1'},
+    'retry': {'REKOGNITION_TPS': '0'},
+    'bucket': {},
+}
+
+
+def runMode(mode, args):
+
+    os.environ.update(MODES[mode])
+    os.environ.setdefault('REKOGNITION_TPS', str(args.tps))
+    import fakes
+    import index
+
+    index.s3_client = s3 = fakes.FakeS3()
+    index.rekognition_client = rekognition = fakes.FakeRekognition(args.latency, tpsLimit=args.tps)
+    index.dynamodb = fakes.FakeDynamoDBClient(fakes.FakeDynamoDB())
+    index.sqs_client = fakes.FakeSQS()
+
+    events = []
+    for batch in range(args.batches):
+        keys = [f'private/user/photo{batch}-{i}.jpg' for i in range(args.batch)]
+        for i, key in enumerate(keys):
+            s3.put(BUCKET, key, fakes.makeJpeg(320, 240, seed=batch * args.batch + i))
+        events.append(fakes.makeSqsEvent(BUCKET, keys, s3=s3, prefix=f'batch{batch}'))
+
+    failed = 0
+    start = time.perf_counter()
+    for event in events:
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            response = index.handler(event, fakes.FakeContext(args.timeout))
+        failed += len(response['batchItemFailures'])
+    elapsed = time.perf_counter() - start
+
+    labelled = args.batches * args.batch - failed
+    print(f'{mode:>6}: {labelled / elapsed:6.1f} images/s  failed {failed:4d}  throttles {rekognition.throttles:5d}  '
+          f'concurrency limit {index.rekognitionConcurrency.limit:5.2f}')
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batches', type=int, default=10)
+    parser.add_argument('--batch', type=int, default=20)
+    parser.add_argument('--tps', type=int, default=10, help='account TPS limit of the stand-in')
+    parser.add_argument('--latency', type=float, default=0.05, help='detectLabels latency (s)')
+    parser.add_argument('--timeout', type=float, default=30.0, help='Lambda timeout (s)')
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--modes', default='none,retry,bucket')
+    args = parser.parse_args()
+
+    if ',' not in args.modes:
+        os.environ['MAX_WORKERS'] = str(args.workers)
+        return runMode(args.modes, args)
+
+    # Each mode gets a fresh interpreter
+    for mode in args.modes.split(','):
+        subprocess.run([sys.executable, __file__, '--modes', mode, '--batches', str(args.batches),
+                        '--batch', str(args.batch), '--tps', str(args.tps), '--latency', str(args.latency),
+                        '--timeout', str(args.timeout), '--workers', str(args.workers)],
+                       check=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#
+# Compare latency and peak RSS of the file-based and streaming thumbnail pipelines
+#
+# Usage: python benchmarks/thumbnail_bench.py [--images 20] [--size 4032x3024]
+#
+
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, '..', 'rekognitionLambda'))
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+os.environ.setdefault('RESIZEDBUCKET', 'resized')
+os.environ.setdefault('TABLE', 'labels')
+
+BUCKET = 'images'
+
+
+def runMode(mode, images, width, height):
+
+    os.environ['THUMB_MODE'] = mode
+    import fakes
+    import index
+
+    s3 = fakes.FakeS3()
+    index.s3_client = s3
+    keys = []
+    for i in range(images):
+        key = f'private/user/photo{i}.jpg'
+        s3.put(BUCKET, key, fakes.makeJpeg(width, height, seed=i))
+        keys.append(key)
+
+    timings = []
+    for key in keys:
+        start = time.perf_counter()
+        index.generateThumb(BUCKET, key)
+        timings.append(time.perf_counter() - start)
+
+    timings.sort()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f'{mode:>6}: p50 {timings[len(timings) // 2] * 1000:8.1f} ms  '
+          f'p99 {timings[int(len(timings) * 0.99)] * 1000:8.1f} ms  peak RSS {peak:8.1f} MB')
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--images', type=int, default=20)
+    parser.add_argument('--size', default='4032x3024')
+    parser.add_argument('--mode')
+    args = parser.parse_args()
+    width, height = (int(x) for x in args.size.split('x'))
+
+    if args.mode:
+        return runMode(args.mode, args.images, width, height)
+
+    # Each mode runs in its own process so peak RSS is not shared between them
+    for mode in ('file', 'stream'):
+        subprocess.run([sys.executable, __file__, '--mode', mode, '--images', str(args.images), '--size', args.size],
+                       check=True)
+
+
+if __name__ == '__main__':
+    main()
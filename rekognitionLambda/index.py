@@ -4,54 +4,693 @@
 
 import logging
 import boto3
-from botocore.exceptions import ClientError
+from botocore.exceptions import ClientError, ConnectionError as BotoConnectionError, HTTPClientError
+from botocore.config import Config
 import os
 from urllib.parse import unquote_plus
-from boto3.dynamodb.conditions import Key, Attr
-import uuid
-from PIL import Image
 import json
+import io
+import shutil
+import tempfile
+import time
+import random
+import struct
+import threading
+import warnings
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
 
 thumbBucket = os.environ['RESIZEDBUCKET']
 
-# Set the minimum confidence for Amazon Rekognition
+# Image formats we accept, recognised from the first 16 bytes of the upload. Pillow is imported on
+# the first resize rather than at cold start, and only the plugins of these formats are registered
+# instead of letting Image.init() import all of them. HEIF can't be decoded by our Pillow build, so
+# it is passed through to the resized bucket as it is. Anything else is rejected without decoding
+allowedFormats = os.environ.get('ALLOWED_FORMATS', 'JPEG,PNG,WEBP,GIF,HEIF').split(',')
+formatPlugins = {
+    'JPEG': ['JpegImagePlugin', 'MpoImagePlugin'],
+    'PNG': ['PngImagePlugin'],
+    'WEBP': ['WebPImagePlugin'],
+    'GIF': ['GifImagePlugin'],
+    'HEIF': [],
+}
+heifBrands = (b'heic', b'heix', b'heim', b'heis', b'hevc', b'hevx', b'mif1', b'msf1')
 
-minConfidence = 50
+# Images above this many pixels are rejected as decompression bombs, before any pixel is decoded
+maxImagePixels = int(os.environ.get('MAX_IMAGE_PIXELS', 64 * 1024 * 1024))
+
+# Before downloading an upload we fetch its first PROBE_BYTES with a ranged GET and read the header
+# (format, mode, size, EXIF orientation), to reject or route it. Uploads that fit in the probe are
+# not downloaded a second time
+probeBytes = int(os.environ.get('PROBE_BYTES', 64 * 1024))
+
+# Formats Amazon Rekognition can read from S3
+rekognitionFormats = ('JPEG', 'PNG')
+
+# Where detectLabels reads the image from: "s3" has Rekognition fetch and decode the original,
+# "bytes" sends the largest thumbnail inline instead, as long as it is no bigger than the 5 MB
+# API limit and its shorter edge has at least DETECT_MIN_EDGE pixels. Bounding boxes are relative
+# to the image, so they don't depend on its resolution. Anything else falls back to S3Object
+detectSource = os.environ.get('DETECT_SOURCE', 's3')
+detectMaxBytes = 5 * 1024 * 1024
+detectMinEdge = int(os.environ.get('DETECT_MIN_EDGE', 640))
+
+# Thumbnail pipeline mode: "stream" keeps the object in memory (spooling to /tmp only above
+# SPOOL_MAX_BYTES), "file" keeps the original download_file -> /tmp -> upload_file behaviour
+thumbMode = os.environ.get('THUMB_MODE', 'stream')
+spoolMaxBytes = int(os.environ.get('SPOOL_MAX_BYTES', 32 * 1024 * 1024))
+
+# Number of threads used to process the records of a batch; 1 processes them sequentially
+maxWorkers = int(os.environ.get('MAX_WORKERS', 8))
+
+# Label items of a batch are written with BatchWriteItem, 25 items per request, retrying
+# UnprocessedItems with exponential backoff
+batchWriteSize = 25
+batchWriteAttempts = int(os.environ.get('BATCH_WRITE_ATTEMPTS', 5))
+
+# JPEGs can be decoded straight at 1/2, 1/4 or 1/8 scale by the DCT (draft mode). We only draft down
+# to a scale that still leaves DRAFT_REDUCING_GAP times the thumbnail size (2, like Pillow's own
+# thumbnail()), so the final resize has enough pixels to filter and keeps output visually equivalent;
+# set DRAFT_MODE=off to always decode at full resolution
+draftMode = os.environ.get('DRAFT_MODE', 'on') == 'on'
+draftReducingGap = max(1.0, float(os.environ.get('DRAFT_REDUCING_GAP', 2.0)))
+
+# PNGs of more than STRIP_MIN_PIXELS are decoded in bands of about STRIP_ROWS rows, each box
+# filtered (Image.reduce) by the integer factor that still leaves the largest rendition, so only the
+# band and the reduced image are ever in memory instead of the full bitmap. PNGs that can be reduced
+# this way (8 bits per sample, not interlaced) are accepted up to STRIP_MAX_PIXELS rather than
+# MAX_IMAGE_PIXELS. STRIPWISE=off always decodes the full bitmap
+stripwise = os.environ.get('STRIPWISE', 'on') == 'on'
+stripMinPixels = int(os.environ.get('STRIP_MIN_PIXELS', 16 * 1024 * 1024))
+stripMaxPixels = int(os.environ.get('STRIP_MAX_PIXELS', 256 * 1024 * 1024)) if stripwise else maxImagePixels
+stripRows = int(os.environ.get('STRIP_ROWS', 256))
+pngSignature = b'\x89PNG\r\n\x1a\n'
+pngChannels = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+# Cameras and phones embed smaller copies of the picture in their JPEGs: a thumbnail in EXIF IFD1,
+# and in MPO files "large thumbnail" frames (VGA or Full HD). When one of them covers the largest
+# rendition, with the aspect ratio of the picture, it is decoded instead of the picture. An EXIF
+# thumbnail is within the probe, so then the upload isn't even downloaded. EMBEDDED_PREVIEWS=off
+# always decodes the picture
+embeddedPreviews = os.environ.get('EMBEDDED_PREVIEWS', 'on') == 'on'
+
+# Thumbnail renditions written to the resized bucket, as a JSON list of
+# {"name", "maxEdge" or "scale", "format", "quality", "maxBytes"}. The unnamed rendition is stored
+# under the original key; the others under "<key>.<name>.<ext>". Format defaults to THUMB_FORMAT
+renditions = json.loads(os.environ.get('RENDITIONS', '[{"name": "", "scale": 0.5}]'))
+
+# Thumbnail encoder policy. With format "auto", graphics (screenshots, logos: images where 64 colours
+# cover GRAPHIC_COVERAGE of the pixels) are encoded as 256 colour PNG, or lossless WebP when they
+# have transparency; photos as progressive JPEG with optimised Huffman tables, or as WebP when they
+# have transparency. Only the THUMB_FORMATS we may write are picked.
+# "source" keeps the format of the upload. Lossy encodes use THUMB_QUALITY; over a rendition's
+# "maxBytes" (THUMB_MAX_BYTES, 0 for none) the highest quality that fits is searched for, down to
+# THUMB_MIN_QUALITY and in at most THUMB_QUALITY_STEPS more encodes
+thumbFormat = os.environ.get('THUMB_FORMAT', 'auto')
+thumbFormats = os.environ.get('THUMB_FORMATS', 'JPEG,WEBP,PNG').split(',')
+thumbQuality = int(os.environ.get('THUMB_QUALITY', 75))
+thumbMinQuality = int(os.environ.get('THUMB_MIN_QUALITY', 40))
+thumbMaxBytes = int(os.environ.get('THUMB_MAX_BYTES', 0))
+thumbQualitySteps = int(os.environ.get('THUMB_QUALITY_STEPS', 4))
+graphicCoverage = float(os.environ.get('GRAPHIC_COVERAGE', 0.8))
+
+# Labels of at least INDEX_MIN_CONFIDENCE are also written to the LABELINDEXTABLE inverted index,
+# one item per owner, label and image, partitioned by "<identity id>#<label in lower case>" and
+# sorted by image key, so servicelambda can search a user's images by label with Queries
+indexMinConfidence = float(os.environ.get('INDEX_MIN_CONFIDENCE', 50))
+batchGetSize = 100
+
+# Labels already detected for identical content (S3 ETag + size) are reused instead of calling
+# Rekognition again: first from an in-process LRU, then from the CACHETABLE DynamoDB table
+labelCacheSize = int(os.environ.get('LABEL_CACHE_SIZE', 1024))
+
+# Near-duplicates (re-encodes, resized copies) are found with a 64 bit dHash of the thumbnail.
+# The hash is split in 4 bands of 16 bits: two hashes within 3 bits of each other share at least
+# one band exactly, so a lookup only has to compare the entries in 4 buckets. Labels of a match
+# within NEAR_DUP_DISTANCE bits (at most 3, 0 disables the lookup) are reused. The 4 partitions of
+# HASHTABLE are read side by side, at most HASH_PAGES_PER_BAND Query pages each, so a band value
+# shared by a great many images (flat rows of pixels) is only compared in part. Band items only
+# hold the hash and the image key; the labels are read from the label item of the match.
+# Images without detail to hash (solid colours, skies, gradients running top to bottom) all come out
+# at or near 0: a hash with fewer than MIN_HASH_BITS bits set, or taken from a 9x8 sample whose
+# brightest and darkest pixels are less than MIN_HASH_CONTRAST apart, is neither looked up nor stored
+hashBands = 4
+nearDupDistance = min(int(os.environ.get('NEAR_DUP_DISTANCE', 3)), hashBands - 1)
+hashPagesPerBand = int(os.environ.get('HASH_PAGES_PER_BAND', 4))
+nearDupIndexSize = int(os.environ.get('NEAR_DUP_INDEX_SIZE', 100000))
+minHashBits = int(os.environ.get('MIN_HASH_BITS', 8))
+minHashContrast = int(os.environ.get('MIN_HASH_CONTRAST', 16))
+
+# Set the minimum confidence and number of labels for Amazon Rekognition. We ask for a wide set once
+# and store it in full (names, confidences, parents, bounding boxes); servicelambda applies the
+# product thresholds at read time, so changing them doesn't need another paid detectLabels call
+
+minConfidence = float(os.environ.get('DETECT_MIN_CONFIDENCE', 20))
+maxLabels = int(os.environ.get('DETECT_MAX_LABELS', 100))
 
 """MinConfidence parameter (float) -- Specifies the minimum confidence level for the labels to return. 
 Amazon Rekognition doesn't return any labels with a confidence lower than this specified value. 
 If you specify a value of 0, all labels are returned, regardless of the default thresholds that the 
 model version applies."""
 
+# detectLabels calls are paced by a token bucket of REKOGNITION_TPS requests per second (0 disables
+# it) shared by all the workers of the container, and by an adaptive concurrency limit: it halves
+# when Rekognition throttles us and grows back by one call per round of successful calls, up to
+# REKOGNITION_MAX_CONCURRENCY. Throttled calls, and those failing with a 5xx or a connection error,
+# are retried with jittered exponential backoff, at most REKOGNITION_ATTEMPTS times and never past
+# the invocation deadline, which leaves DEADLINE_MARGIN_MS of the Lambda timeout for writing the results
+rekognitionTps = float(os.environ.get('REKOGNITION_TPS', 50))
+rekognitionBurst = float(os.environ.get('REKOGNITION_BURST', max(1.0, rekognitionTps)))
+rekognitionMaxConcurrency = int(os.environ.get('REKOGNITION_MAX_CONCURRENCY', maxWorkers))
+rekognitionAttempts = int(os.environ.get('REKOGNITION_ATTEMPTS', 8))
+throttleCodes = ('ThrottlingException', 'ProvisionedThroughputExceededException')
+transientCodes = ('InternalServerError', 'ServiceUnavailableException', 'ServiceUnavailable')
+deadlineMargin = int(os.environ.get('DEADLINE_MARGIN_MS', 2000)) / 1000
+
+# Rough cost model of an image, used to start the most expensive images of a batch first, and to
+# leave those that wouldn't be done before the deadline for their next delivery: COST_BASE seconds
+# of round-trips, plus COST_PER_MEGABYTE per MB downloaded and COST_PER_MEGAPIXEL per megapixel decoded
+costBase = float(os.environ.get('COST_BASE', 0.5))
+costPerMegabyte = float(os.environ.get('COST_PER_MEGABYTE', 0.05))
+costPerMegapixel = float(os.environ.get('COST_PER_MEGAPIXEL', 0.05))
+
+# A sample of TRACE_SAMPLE_RATE invocations logs the time spent in each stage, with byte counts and
+# image dimensions, as CloudWatch Embedded Metric Format lines in the METRICS_NAMESPACE namespace:
+# one line per image and one for the batch, which also carries the container's decode, probe route,
+# detect source and label cache counters. benchmarks/emf_report.py turns them into percentiles
+traceSampleRate = float(os.environ.get('TRACE_SAMPLE_RATE', 0.1))
+metricsNamespace = os.environ.get('METRICS_NAMESPACE', 'ImageRekognition')
+
+# Version of the label item layout: 1 is the original object1..objectN attributes, 2 stores the
+# full compact label list in "labels"
+labelsSchemaVersion = 2
+
 ## Instantiate service clients outside of handler for context reuse / performance
 
 # Constructor for our s3 client object
 s3_client = boto3.client('s3')
-# Constructor to create rekognition client object
-rekognition_client = boto3.client('rekognition')
-# Constructor for DynamoDB resource object
-dynamodb = boto3.resource('dynamodb')
+# Constructor to create rekognition client object. Retries are ours (see callDetectLabels), of server
+# and connection errors as well as throttling, so that throttling reaches the concurrency controller
+# instead of being retried blindly by botocore
+rekognition_client = boto3.client('rekognition', config=Config(retries={'mode': 'standard', 'max_attempts': 1}))
+# Constructor for DynamoDB client object; the low-level client is much cheaper to create than
+# the resource layer, at the cost of writing items as AttributeValues (see toAttributes)
+dynamodb = boto3.client('dynamodb')
+# SQS client, only created when messages have to be released early (see releaseMessages)
+sqs_client = None
+# Table names of our environment variables
+imageLabelsTable = os.environ['TABLE']
+labelCacheTable = os.environ.get('CACHETABLE')
+hashTable = os.environ.get('HASHTABLE')
+labelIndexTable = os.environ.get('LABELINDEXTABLE')
+
+# Pillow modules, and the Pillow formats Image.open may try, set by loadPIL()
+Image = ImageOps = ImageChops = None
+pilFormats = []
+pilLock = threading.Lock()
+
+# Shared thread pool, kept warm across invocations of the same container
+executor = ThreadPoolExecutor(max_workers=maxWorkers) if maxWorkers > 1 else None
+# Separate pool for rendition uploads, so record tasks never wait on their own pool. Each record
+# task uploads one rendition itself, so the pool carries the others of every worker
+uploadExecutor = ThreadPoolExecutor(max_workers=max(1, maxWorkers * (len(renditions) - 1)))
+# Pool for the band Queries of near-duplicate lookups, for the same reason
+hashExecutor = ThreadPoolExecutor(max_workers=maxWorkers * hashBands)
+
+# Per-format decode timings, probe routes and detectLabels image sources, accumulated for the
+# lifetime of the container
+decodeStats = {}
+probeRoutes = {}
+detectSources = {}
+decodeStatsLock = threading.Lock()
+
+# Monotonic time after which no new Rekognition call or retry is started, set per invocation
+deadline = None
+
+# Trace the stages running on the current thread are recorded in (see span), if any
+tracing = threading.local()
+
+# In-process tier of the label cache, and its hit/miss counters
+labelCache = OrderedDict()
+labelCacheLock = threading.Lock()
+labelCacheStats = {'memoryHits': 0, 'tableHits': 0, 'nearHits': 0, 'misses': 0}
 
 def handler(event, context):
 
     print("Lambda processing event: ", event)
 
-    # For each message (photo) get the bucket name and key
+    global deadline
+    deadline = None if context is None else (
+        time.monotonic() + context.get_remaining_time_in_millis() / 1000 - deadlineMargin)
+
+    # Stages of the batch as a whole are traced on this thread, those of each image in its tasks
+    sampled = random.random() < traceSampleRate
+    requestId = getattr(context, 'aws_request_id', None)
+    batchTrace = Trace(requestId=requestId, records=len(event['Records'])) if sampled else None
+    tracing.trace = batchTrace
+
+    # For each message (photo) get the bucket name and key, and probe its images
 
+    tasks = []
+    images = []
+    imageTraces = []
     for response in event['Records']:
-        formatted = json.loads(response['body']) ## this line added at the time of SQS to pick records from SQS
-        for record in formatted['Records']:
-            ourBucket = record['s3']['bucket']['name']
-            ourKey = record['s3']['object']['key']
+        try:
+            with span('parse'):
+                messageImages = parseMessage(response)
+        except (ValueError, KeyError) as e:
+            logging.error(e)
+            tasks.append((response['messageId'], [CompletedTask(error=e)]))
+            continue
+
+        recordTasks = []
+        for ourBucket, ourKey, contentKey in messageImages:
+            trace = Trace(requestId=requestId, image=replaceSubstringWithColon(ourKey)) if sampled else None
+            probeTask = submitTask(runTraced, trace, probeImage, ourBucket, ourKey)
+            recordTasks.append(probeTask)
+            images.append((recordTasks, ourBucket, ourKey, contentKey, trace, probeTask))
+            imageTraces.append(trace)
+        tasks.append((response['messageId'], recordTasks))
+
+    # Then start the thumbnail and label detection tasks of the most expensive images first, so
+    # the slowest one doesn't start last and hold up the batch. The label task may wait for the
+    # thumbnail; it is queued right after it, so the thumbnail is always running by then. Once the
+    # thumbnail is under way, the label task only needs time for its own round-trips. The perceptual
+    # hash is handed over as soon as the thumbnail task has it, before the renditions are encoded and
+    # uploaded, so the near-duplicate lookup doesn't wait for them
+    for cost, (recordTasks, ourBucket, ourKey, contentKey, trace, probeTask) in sorted(
+            ((estimateCost(image[-1]), image) for image in images), key=lambda entry: -entry[0]):
+        hashTask = Future()
+        thumbTask = submitTask(runTraced, trace, startInTime, cost, generateThumb, ourBucket, ourKey, probeTask,
+                               hashTask)
+        recordTasks.append(thumbTask)
+        recordTasks.append(submitTask(runTraced, trace, startInTime, costBase, detectLabels,
+                                      ourBucket, ourKey, contentKey, thumbTask, probeTask, hashTask))
+
+    # Gather results per record so one bad image doesn't stop the rest of the batch
+    results, labels = collectResults(tasks)
+
+    # Write the label items of the whole batch in as few round-trips as possible, and fail
+    # the records whose items could not be written
+    failedKeys = writeLabels([item for items in labels.values() for item in items])
+    for messageId, items in labels.items():
+        if results[messageId] is None and any(item['image'] in failedKeys for item in items):
+            results[messageId] = Exception("Failed to write labels")
+
+    # Records left for redelivery become visible again right away, rather than after the visibility timeout
+    releaseMessages([record for record in event['Records']
+                     if isinstance(results.get(record['messageId']), DeadlineExceededError)])
+
+    tracing.trace = None
+    if sampled:
+        # The container's running counters go out with the sampled batch line, not on every invocation
+        batchTrace.set(decode=decodeMetrics())
+        with decodeStatsLock:
+            batchTrace.set(probeRoutes=dict(probeRoutes), detectSources=dict(detectSources))
+        with labelCacheLock:
+            batchTrace.set(labelCache=dict(labelCacheStats))
+        for trace in imageTraces + [batchTrace]:
+            print(trace.toEmf())
+
+    # Report only the failed messages back to SQS (ReportBatchItemFailures), so the records that
+    # succeeded are deleted from the queue instead of being thumbnailed and labelled again
+    return {
+        'batchItemFailures': [
+            {'itemIdentifier': messageId} for messageId, error in results.items() if error is not None
+        ]
+    }
+
+
+def releaseMessages(records):
+
+    global sqs_client
+    if not records:
+        return
+    if sqs_client is None:
+        sqs_client = boto3.client('sqs')
+
+    # The queue URL follows from the queue ARN, "arn:aws:sqs:<region>:<account>:<name>"
+    for i in range(0, len(records), 10):
+        chunk = records[i:i + 10]
+        region, account, name = chunk[0]['eventSourceARN'].split(':')[3:6]
+        try:
+            sqs_client.change_message_visibility_batch(
+                QueueUrl='https://sqs.{}.amazonaws.com/{}/{}'.format(region, account, name),
+                Entries=[{'Id': str(j), 'ReceiptHandle': record['receiptHandle'], 'VisibilityTimeout': 0}
+                         for j, record in enumerate(chunk)])
+        except ClientError as e:
+            logging.error(e)
+
+
+def parseMessage(response):
+
+    formatted = json.loads(response['body']) ## this line added at the time of SQS to pick records from SQS
+    return [(record['s3']['bucket']['name'], record['s3']['object']['key'], contentKeyOf(record['s3']['object']))
+            for record in formatted.get('Records', [])]
+
+
+def contentKeyOf(s3Object):
+
+    # The ETag of a single-part upload is the MD5 of its bytes; together with the size it
+    # identifies the content well enough to share labels between uploads
+    if not s3Object.get('eTag') or 'size' not in s3Object:
+        return None
+    return '{}-{}'.format(s3Object['eTag'].strip('"'), s3Object['size'])
+
+
+def estimateCost(probeTask):
+
+    # Rough seconds to thumbnail and label an image: downloading grows with its bytes, decoding
+    # with its pixels (a quarter of them when drafting). Images the probe rejected cost nothing
+    try:
+        probe = probeTask.result()
+    except Exception:
+        return 0.0
+
+    if probe['size'] is not None:
+        megapixels = probe['size'][0] * probe['size'][1] / 1e6
+    else:
+        megapixels = probe['length'] * 4 / 1e6
+    if probe['route'] == 'draft':
+        megapixels /= 4
+    elif probe['route'] == 'passthrough':
+        megapixels = 0.0
+    return costBase + costPerMegabyte * probe['length'] / 1e6 + costPerMegapixel * megapixels
+
+
+def startInTime(cost, fn, *args):
+
+    # Work that wouldn't be done before the deadline isn't started; the record fails right away
+    # and is redelivered by SQS instead of timing out along with the rest of the batch
+    if deadline is not None and time.monotonic() + cost > deadline:
+        raise DeadlineExceededError("Not started, {:.1f}s needed".format(cost))
+    return fn(*args)
+
+
+def submitTask(fn, *args):
+
+    if executor is None:
+        # Sequential mode: run now, and hand back something that looks like a future
+        try:
+            return CompletedTask(fn(*args))
+        except Exception as e:
+            return CompletedTask(error=e)
+    return executor.submit(fn, *args)
+
+
+class UnsupportedImageError(Exception):
+
+    # Raised for uploads we can never process (not an allowed format, corrupt, decompression bomb);
+    # their records are dropped instead of being retried
+    pass
+
+
+class DeadlineExceededError(Exception):
+
+    # Raised when there is no time left in the invocation to start a call; the record fails and
+    # is redelivered by SQS
+    pass
+
+
+class Trace:
+
+    # Durations of the stages of one image (or of the batch), and the byte counts attached to them,
+    # as lists of values per metric, plus properties (key, format, dimensions) to tell them apart
+
+    def __init__(self, **properties):
+        self.properties = {name: value for name, value in properties.items() if value is not None}
+        self.metrics = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds, values):
+        with self.lock:
+            self.metrics.setdefault(stage + 'Ms', []).append(round(seconds * 1000, 3))
+            for name, value in values.items():
+                self.metrics.setdefault(stage + name[0].upper() + name[1:], []).append(value)
+
+    def set(self, **properties):
+        with self.lock:
+            self.properties.update(properties)
+
+    def toEmf(self):
+        units = {'Ms': 'Milliseconds', 'Bytes': 'Bytes'}
+        with self.lock:
+            document = {
+                '_aws': {
+                    'Timestamp': int(time.time() * 1000),
+                    'CloudWatchMetrics': [{
+                        'Namespace': metricsNamespace,
+                        'Dimensions': [[]],
+                        'Metrics': [
+                            {'Name': name, 'Unit': next((unit for suffix, unit in units.items() if name.endswith(suffix)), 'Count')}
+                            for name in self.metrics
+                        ],
+                    }],
+                },
+            }
+            document.update(self.properties)
+            document.update(self.metrics)
+        return json.dumps(document, separators=(',', ':'))
+
+
+def runTraced(trace, fn, *args):
+
+    # Run fn with its stages recorded in trace
+    previous = getattr(tracing, 'trace', None)
+    tracing.trace = trace
+    try:
+        return fn(*args)
+    finally:
+        tracing.trace = previous
+
+
+def currentTrace():
+
+    return getattr(tracing, 'trace', None)
+
+
+@contextmanager
+def span(stage):
+
+    # Time the block as a stage of the current trace; the block may add values (bytes, items) to
+    # the dict it gets. Without a trace (invocation not sampled) this only hands out a dict
+    trace = currentTrace()
+    values = {}
+    start = time.perf_counter()
+    try:
+        yield values
+    finally:
+        if trace is not None:
+            trace.add(stage, time.perf_counter() - start, values)
+
+
+def traceProperties(**properties):
+
+    trace = currentTrace()
+    if trace is not None:
+        trace.set(**properties)
+
+
+class CompletedTask:
+
+    def __init__(self, value=None, error=None):
+        self.value = value
+        self.error = error
+
+    def result(self):
+        if self.error is not None:
+            raise self.error
+        return self.value
 
-        # For each bucket/key, retrieve labels
-        generateThumb(ourBucket, ourKey)
-        rekFunction(ourBucket, ourKey)
 
-    return
+def collectResults(tasks):
 
+    # Map each messageId to None on success, or the first exception raised by its tasks,
+    # along with the label items returned by its tasks
+    results = {}
+    labels = {}
+    for messageId, recordTasks in tasks:
+        results[messageId] = None
+        labels[messageId] = []
+        skipped = False
+        for task in recordTasks:
+            try:
+                item = task.result()
+            except UnsupportedImageError as e:
+                if not skipped:
+                    logging.warning("Record %s skipped: %s", messageId, e)
+                skipped = True
+                continue
+            except DeadlineExceededError as e:
+                if results[messageId] is None:
+                    logging.warning("Record %s left for redelivery: %s", messageId, e)
+                    results[messageId] = e
+                continue
+            except Exception as e:
+                logging.exception("Record %s failed", messageId)
+                if results[messageId] is None:
+                    results[messageId] = e
+                continue
+            # Probe tasks return the probe, thumbnail tasks the perceptual hash of the image and
+            # the image to send to Rekognition, and label tasks the item to write
+            if isinstance(item, dict) and 'image' in item:
+                labels[messageId].append(item)
 
-def rekFunction(ourBucket, ourKey):
+        # Retrying an image we can't process won't help, so the record counts as done
+        if skipped:
+            results[messageId] = None
+            labels[messageId] = []
+
+    return results, labels
+
+
+def writeLabels(items):
+
+    # Duplicate keys aren't allowed in one BatchWriteItem request; the latest item wins
+    items = list({item['image']: item for item in items}.values())
+    requests = [(imageLabelsTable, {'PutRequest': {'Item': toAttributes(item)}}) for item in items]
+
+    # Label index entries go in the same requests as the label items, along with the removal of
+    # those of labels an image no longer has (when it was uploaded again under the same key)
+    if labelIndexTable is not None and items:
+        previous = indexedLabelsOf([item['image'] for item in items])
+        for item in items:
+            requests.extend((labelIndexTable, request) for request in labelIndexRequests(item, previous.get(item['image'], {})))
+
+    chunks = [requests[i:i + batchWriteSize] for i in range(0, len(requests), batchWriteSize)]
+
+    # Flush the chunks side by side, and collect the keys of the images whose items never made it
+    failedKeys = set()
+    tasks = [submitTask(runTraced, currentTrace(), writeLabelsChunk, chunk) for chunk in chunks]
+    for chunk, task in zip(chunks, tasks):
+        try:
+            failedKeys.update(task.result())
+        except Exception as e:
+            logging.error(e)
+            failedKeys.update(requestImage(request) for tableName, request in chunk)
+
+    return failedKeys
+
+
+def writeLabelsChunk(chunk):
+
+    # chunk is a list of (table name, write request), across the label, label index and hash tables
+    for attempt in range(batchWriteAttempts):
+        requestItems = {}
+        for tableName, request in chunk:
+            requestItems.setdefault(tableName, []).append(request)
+        try:
+            with span('dynamodbPut') as values:
+                values['items'] = len(chunk)
+                response = dynamodb.batch_write_item(RequestItems=requestItems)
+        except ClientError as e:
+            logging.error(e)
+            return [requestImage(request) for tableName, request in chunk]
+
+        chunk = [(tableName, request) for tableName, requests in response.get('UnprocessedItems', {}).items()
+                 for request in requests]
+        if not chunk:
+            return []
+
+        # Exponential backoff with full jitter before retrying the unprocessed items
+        time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+
+    logging.error("Unprocessed items after %d attempts", batchWriteAttempts)
+    return [requestImage(request) for tableName, request in chunk]
+
+
+def requestImage(request):
+
+    # Key of the image a label item or label index entry write is for
+    if 'PutRequest' in request:
+        return request['PutRequest']['Item']['image']['S']
+    return request['DeleteRequest']['Key']['image']['S']
+
+
+def labelIndexRequests(item, previous):
+
+    owner = keyOwner(item['image'])
+    current = indexedLabels(item)
+    requests = [
+        {'PutRequest': {'Item': toAttributes({
+            'ownerLabel': owner + '#' + label, 'image': item['image'], 'label': name, 'confidence': confidence,
+        })}}
+        for label, (name, confidence) in current.items()
+    ]
+    requests.extend(
+        {'DeleteRequest': {'Key': toAttributes({'ownerLabel': owner + '#' + label, 'image': item['image']})}}
+        for label in previous if label not in current
+    )
+    return requests
+
+
+def indexedLabels(item):
+
+    # {label in lower case: (label, confidence)} of the labels an item is indexed under. Items
+    # written before schemaVersion 2 only have names, all of which were indexed
+    if 'labels' not in item:
+        return {value.lower(): (value, None) for name, value in item.items() if name.startswith('object')}
+    return {
+        label[0].lower(): (label[0], label[1])
+        for label in json.loads(item['labels']) if label[1] >= indexMinConfidence
+    }
+
+
+def indexedLabelsOf(keys):
+
+    # Labels the stored items of these images are indexed under, read with BatchGetItem. If they
+    # can't be read, no index entries are removed: a search may then still find the image under
+    # a label it lost, rather than the write failing
+    previous = {}
+    for i in range(0, len(keys), batchGetSize):
+        requestKeys = [{'image': {'S': key}} for key in keys[i:i + batchGetSize]]
+        for attempt in range(batchWriteAttempts):
+            try:
+                with span('dynamodbGet') as values:
+                    values['items'] = len(requestKeys)
+                    response = dynamodb.batch_get_item(RequestItems={imageLabelsTable: {'Keys': requestKeys}})
+            except ClientError as e:
+                logging.error(e)
+                break
+            for item in response['Responses'].get(imageLabelsTable, []):
+                item = fromAttributes(item)
+                previous[item['image']] = indexedLabels(item)
+            requestKeys = response.get('UnprocessedKeys', {}).get(imageLabelsTable, {}).get('Keys', [])
+            if not requestKeys:
+                break
+            time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+    return previous
+
+
+def keyOwner(key):
+
+    # Uploads are stored under "private/<identity id>/..." (or "protected/"); anything else is public
+    parts = key.split('/')
+    if len(parts) > 2 and parts[0] in ('private', 'protected'):
+        return parts[1]
+    return 'public'
+
+
+def toAttributes(item):
+
+    # Our items only hold strings and numbers, so this is all the serialisation the client needs
+    return {
+        name: {'N': str(value)} if isinstance(value, (int, float)) else {'S': value}
+        for name, value in item.items() if value is not None
+    }
+
+
+def fromAttributes(item):
+
+    return {
+        name: (float(value['N']) if '.' in value['N'] else int(value['N'])) if 'N' in value else value['S']
+        for name, value in item.items() if 'N' in value or 'S' in value
+    }
+
+
+def detectLabels(ourBucket, ourKey, contentKey=None, thumbTask=None, probeTask=None, hashTask=None):
     
     # Clean the string to add the colon back into requested name which was substitued by Amplify Library.
     safeKey = replaceSubstringWithColon(ourKey)
@@ -59,49 +698,459 @@ def rekFunction(ourBucket, ourKey):
     print('Currently processing the following image')
     print('Bucket: ' + ourBucket + ' key name: ' + safeKey)
 
-    detectLabelsResults = {}
+    # Uploads Rekognition can't read (GIF, HEIF, ...) are still stored, with their thumbnails and no
+    # labels, so that they are listed and can be deleted like the others. Only when neither the probe
+    # nor the thumbnail made an image of it is the upload skipped
+    imageFormat = probeTask.result()['format'] if probeTask is not None else None
+    try:
+        detectLabelsResults = findLabels(ourBucket, safeKey, contentKey, thumbTask, hashTask, imageFormat)
+        labelled = True
+    except UnsupportedImageError as e:
+        if imageFormat is None and thumbnailResult(thumbTask) is None:
+            raise
+        logging.warning("Storing %s without labels: %s", safeKey, e)
+        detectLabelsResults = {'Labels': []}
+        labelled = False
+
+    # Create our dict for our label construction, with all of our labels from response['Labels']
+    # in compact form. It's a JSON string so Rekognition's floats don't need DynamoDB's Decimal type
+
+    imageLabels = {
+        'image': safeKey,
+        'schemaVersion': labelsSchemaVersion,
+        'labels': json.dumps(compactLabels(detectLabelsResults['Labels']), separators=(',', ':')),
+    }
+
+    # A new version every time the image is labelled, which servicelambda's read cache checks its
+    # entries against once they expire
+    imageLabels['version'] = '{:x}'.format(time.time_ns())
+
+    # The owner and upload time are the keys of the byOwner index servicelambda lists a user's images
+    # with, and the thumbnail keys (by rendition name) save it from listing the resized bucket
+    imageLabels['owner'] = keyOwner(safeKey)
+    imageLabels['uploaded'] = probeTask.result()['uploaded'] if probeTask is not None else uploadTime()
+    thumb = thumbnailResult(thumbTask)
+    if thumb is not None:
+        imageLabels['thumbnails'] = json.dumps(thumb['thumbnails'], separators=(',', ':'))
+
+    # Keep the perceptual hash alongside the labels, and make them findable for later near-duplicates
+    # (but not the empty labels of an image Rekognition couldn't read)
+    phash = imageHash(hashTask)
+    if phash is not None:
+        imageLabels['phash'] = '{:016x}'.format(phash)
+        if labelled:
+            indexHash(phash, detectLabelsResults, safeKey)
+
+    return imageLabels
+
+
+def findLabels(ourBucket, safeKey, contentKey, thumbTask, hashTask, imageFormat):
+
+    # Don't pay for detectLabels on uploads the probe rejected, or that Rekognition can't read.
+    # When sending thumbnails inline, Rekognition gets a JPEG or PNG whatever the upload was
+    if imageFormat is not None and imageFormat not in rekognitionFormats and detectSource != 'bytes':
+        raise UnsupportedImageError("Amazon Rekognition can't read {} images".format(imageFormat))
+
+    detectLabelsResults = cachedLabels(contentKey)
+
+    # On a miss, wait for the perceptual hash of the thumbnail and look for a near-duplicate.
+    # The thumbnail task was queued before this one, so it is already running or done, and it
+    # hands the hash over before encoding and uploading the renditions
+    if detectLabelsResults is None and nearDupDistance > 0:
+        detectLabelsResults = nearDuplicateLabels(imageHash(hashTask))
+        if detectLabelsResults is not None:
+            cacheLabels(contentKey, detectLabelsResults)
 
     # Try and retrieve labels from Amazon Rekognition, using the confidence level we set in minConfidence var
+    if detectLabelsResults is None:
+        imageBytes = thumbnailBytes(thumbTask) if detectSource == 'bytes' else None
+        if imageBytes is not None:
+            try:
+                detectLabelsResults = callDetectLabels({'Bytes': imageBytes})
+                countDetectSource('bytes')
+            except UnsupportedImageError:
+                # Let Rekognition have a go at the original instead
+                pass
+
+        if detectLabelsResults is None:
+            if imageFormat is not None and imageFormat not in rekognitionFormats:
+                raise UnsupportedImageError("Amazon Rekognition can't read {} images".format(imageFormat))
+            detectLabelsResults = callDetectLabels({'S3Object': {'Bucket':ourBucket, 'Name':safeKey}})
+            countDetectSource('s3')
+
+        cacheLabels(contentKey, detectLabelsResults)
+
+    return detectLabelsResults
+
+
+def callDetectLabels(image):
+
+    with span('detectLabels') as values:
+        if 'Bytes' in image:
+            values['bytes'] = len(image['Bytes'])
+        attempt = 0
+        while True:
+            # Wait for a token and a concurrency slot, unless the deadline comes first
+            if rekognitionLimiter is not None and not rekognitionLimiter.acquire(deadline):
+                raise DeadlineExceededError("No Rekognition token left before the deadline")
+            if not rekognitionConcurrency.acquire(deadline):
+                raise DeadlineExceededError("No Rekognition slot left before the deadline")
+
+            # The slot is given back however the call ends; only throttling shrinks the limit
+            throttled = False
+            try:
+                detectLabelsResults = rekognition_client.detect_labels(Image=image,
+                MaxLabels=maxLabels,
+                MinConfidence=minConfidence)
+                values['attempts'] = attempt + 1
+                return detectLabelsResults
+
+            except ClientError as e:
+                code = e.response['Error']['Code']
+                throttled = code in throttleCodes
+                if code in ('InvalidImageFormatException', 'ImageTooLargeException'):
+                    logging.error(e)
+                    raise UnsupportedImageError(str(e))
+                status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+                retryable = throttled or code in transientCodes or status >= 500
+                error = e
+
+            except (BotoConnectionError, HTTPClientError) as e:
+                retryable = True
+                error = e
+
+            finally:
+                rekognitionConcurrency.release(throttled=throttled)
+
+            # Retry with exponential backoff and full jitter, while there's time
+            attempt += 1
+            backoff = random.uniform(0, min(2.0, 0.1 * 2 ** attempt))
+            if (not retryable or attempt >= rekognitionAttempts
+                    or (deadline is not None and time.monotonic() + backoff > deadline)):
+                logging.error(error)
+                raise error
+            time.sleep(backoff)
+
+
+class TokenBucket:
+
+    # Allows rate calls per second on average, and bursts of up to burst calls
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, deadline=None):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+class AdaptiveConcurrency:
+
+    # AIMD limit on calls in flight: every successful call adds 1/limit (one per round of calls),
+    # a throttled call halves it. It is halved at most once a second, so the throttles of calls
+    # already in flight don't collapse it all the way down to one
+
+    def __init__(self, maxLimit):
+        self.maxLimit = maxLimit
+        self.limit = float(maxLimit)
+        self.inFlight = 0
+        self.decreased = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self, deadline=None):
+        with self.condition:
+            while self.inFlight >= int(self.limit):
+                timeout = None if deadline is None else deadline - time.monotonic()
+                if timeout is not None and timeout <= 0:
+                    return False
+                self.condition.wait(timeout)
+            self.inFlight += 1
+            return True
+
+    def release(self, throttled=False):
+        with self.condition:
+            self.inFlight -= 1
+            now = time.monotonic()
+            if not throttled:
+                self.limit = min(self.maxLimit, self.limit + 1 / self.limit)
+            elif now - self.decreased > 1.0:
+                self.limit = max(1.0, self.limit / 2)
+                self.decreased = now
+            self.condition.notify_all()
+
+
+rekognitionLimiter = TokenBucket(rekognitionTps, rekognitionBurst) if rekognitionTps > 0 else None
+rekognitionConcurrency = AdaptiveConcurrency(rekognitionMaxConcurrency)
+
+
+def countDetectSource(source):
+
+    with decodeStatsLock:
+        detectSources[source] = detectSources.get(source, 0) + 1
+
+
+def compactLabels(labels):
+
+    # Each label becomes [name, confidence, [parent names], [[left, top, width, height, confidence], ...]],
+    # sorted by confidence, with confidences rounded to 0.1 and boxes to 4 decimals
+    compact = []
+    for label in sorted(labels, key=lambda label: -label['Confidence']):
+        boxes = [
+            [round(instance['BoundingBox'][edge], 4) for edge in ('Left', 'Top', 'Width', 'Height')]
+            + [round(instance['Confidence'], 1)]
+            for instance in label.get('Instances', []) if 'BoundingBox' in instance
+        ]
+        parents = [parent['Name'] for parent in label.get('Parents', [])]
+        compact.append([label['Name'], round(label['Confidence'], 1), parents, boxes])
+
+    return compact
+
+
+def thumbnailResult(thumbTask):
+
+    if thumbTask is None:
+        return None
     try:
-        detectLabelsResults = rekognition_client.detect_labels(Image={'S3Object': {'Bucket':ourBucket, 'Name':safeKey}},
-        MaxLabels=10,
-        MinConfidence=minConfidence)
+        return thumbTask.result()
+    except Exception:
+        # The thumbnail failure is reported by its own task
+        return None
 
-    except ClientError as e:
-        logging.error(e)
 
-    # Create our array and dict for our label construction
+def imageHash(hashTask):
 
-    objectsDetected = []
+    # The thumbnail task settles it whatever happens, with None when it has no hash
+    return hashTask.result() if hashTask is not None else None
 
-    imageLabels = {
-        'image': safeKey
-    }
 
+def thumbnailBytes(thumbTask):
 
-    # Add all of our labels into imageLabels by iterating over response['Labels']
-    
-    for label in detectLabelsResults['Labels']:
-        newItem = label['Name']
-        objectsDetected.append(newItem)
-        objectNum = len(objectsDetected)
-        itemAtt = f"object{objectNum}"
+    thumb = thumbnailResult(thumbTask)
+    return thumb['detectBytes'] if thumb is not None else None
+
+
+def hashBandKeys(phash):
+
+    return ['{}:{:04x}'.format(band, (phash >> (16 * band)) & 0xffff) for band in range(hashBands)]
+
+
+def nearDuplicateLabels(phash):
+
+    if phash is None:
+        return None
 
-        # We now have our shiny new item ready to put into DynamoDB
-        imageLabels[itemAtt] = newItem
+    match = nearDupIndex.nearest(phash, nearDupDistance)
+    if match is None and hashTable is not None:
+        match = nearestStoredHash(phash)
+        if match is not None:
+            nearDupIndex.add(*match)
+    if match is None:
+        return None
 
+    with labelCacheLock:
+        labelCacheStats['nearHits'] += 1
+    return match[1]
 
-    # Instantiate a table resource object of our environment variable
-    imageLabelsTable = os.environ['TABLE']
-    table = dynamodb.Table(imageLabelsTable)
 
-    # Put item into table
+def nearestStoredHash(phash):
+
+    # Any hash within the distance shares a band with ours, so only those 4 partitions are read
+    candidates = {}
+    for items in hashExecutor.map(readHashBand, hashBandKeys(phash)):
+        for item in items:
+            candidate = int(item['phash']['S'], 16)
+            distance = bin(phash ^ candidate).count('1')
+            # Entries written before band items carried the image key can't be followed
+            if distance <= nearDupDistance and 'image' in item:
+                candidates[candidate] = (distance, item['image']['S'])
+
+    # Closest first; an image deleted (or left without labels) since it was indexed is passed over
+    for candidate, (distance, image) in sorted(candidates.items(), key=lambda entry: entry[1][0]):
+        labels = storedLabels(image)
+        if labels is not None:
+            return candidate, labels
+    return None
+
+
+def readHashBand(bandKey):
+
+    items = []
+    options = {}
+    for page in range(hashPagesPerBand):
+        try:
+            response = dynamodb.query(TableName=hashTable, KeyConditionExpression='band = :band',
+                                      ExpressionAttributeValues={':band': {'S': bandKey}},
+                                      ProjectionExpression='phash, image', **options)
+        except ClientError as e:
+            logging.error(e)
+            break
+        items.extend(response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            break
+        options['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return items
+
+
+def storedLabels(image):
+
     try:
-        table.put_item(Item=imageLabels)
+        item = dynamodb.get_item(TableName=imageLabelsTable, Key={'image': {'S': image}},
+                                 ProjectionExpression='labels').get('Item')
     except ClientError as e:
         logging.error(e)
-        
-    return
+        return None
+    if item is None or 'labels' not in item:
+        return None
+    labels = json.loads(item['labels']['S'])
+    return {'Labels': expandLabels(labels)} if labels else None
+
+
+def expandLabels(compact):
+
+    # The Rekognition label list back from compactLabels' form
+    return [
+        {
+            'Name': name,
+            'Confidence': confidence,
+            'Parents': [{'Name': parent} for parent in parents],
+            'Instances': [
+                {'BoundingBox': dict(zip(('Left', 'Top', 'Width', 'Height'), box[:4])), 'Confidence': box[4]}
+                for box in boxes
+            ],
+        }
+        for name, confidence, parents, boxes in compact
+    ]
+
+
+def indexHash(phash, detectLabelsResults, safeKey):
+
+    nearDupIndex.add(phash, detectLabelsResults)
+
+    if hashTable is not None:
+        requests = [
+            (hashTable, {'PutRequest': {'Item': toAttributes({'band': bandKey, 'phash': '{:016x}'.format(phash),
+                                                              'image': safeKey})}})
+            for bandKey in hashBandKeys(phash)
+        ]
+
+        # Unprocessed band items are retried like label items. A hash missing some of its bands is
+        # only found through the others, so the image is still labelled either way
+        if writeLabelsChunk(requests):
+            logging.error("Hash of %s only partly indexed", safeKey)
+
+
+class HammingIndex:
+
+    # In-process multi-index of perceptual hashes: one dict per band, mapping the band value to
+    # the hashes having it. Oldest entries are dropped once the index is full
+
+    def __init__(self, maxEntries):
+        self.maxEntries = maxEntries
+        self.entries = OrderedDict()
+        self.bands = [{} for _ in range(hashBands)]
+        self.lock = threading.Lock()
+
+    def add(self, phash, value):
+        with self.lock:
+            if phash not in self.entries:
+                for band, bucket in zip(self.bandValues(phash), self.bands):
+                    bucket.setdefault(band, set()).add(phash)
+            self.entries[phash] = value
+            self.entries.move_to_end(phash)
+            while len(self.entries) > self.maxEntries:
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, oldest):
+        del self.entries[oldest]
+        for band, bucket in zip(self.bandValues(oldest), self.bands):
+            bucket[band].discard(oldest)
+            if not bucket[band]:
+                del bucket[band]
+
+    def nearest(self, phash, maxDistance):
+        with self.lock:
+            best = None
+            for band, bucket in zip(self.bandValues(phash), self.bands):
+                for candidate in bucket.get(band, ()):
+                    distance = bin(phash ^ candidate).count('1')
+                    if distance <= maxDistance and (best is None or distance < best[0]):
+                        best = (distance, candidate)
+            if best is None:
+                return None
+            return best[1], self.entries[best[1]]
+
+    @staticmethod
+    def bandValues(phash):
+        return [(phash >> (16 * band)) & 0xffff for band in range(hashBands)]
+
+
+nearDupIndex = HammingIndex(nearDupIndexSize)
+
+
+def cachedLabels(contentKey):
+
+    if contentKey is None:
+        return None
+
+    with labelCacheLock:
+        if contentKey in labelCache:
+            labelCache.move_to_end(contentKey)
+            labelCacheStats['memoryHits'] += 1
+            return labelCache[contentKey]
+
+    detectLabelsResults = None
+    if labelCacheTable is not None:
+        try:
+            item = dynamodb.get_item(TableName=labelCacheTable, Key={'contentHash': {'S': contentKey}}).get('Item')
+            if item is not None:
+                detectLabelsResults = {'Labels': json.loads(item['labels']['S'])}
+        except ClientError as e:
+            logging.error(e)
+
+    with labelCacheLock:
+        if detectLabelsResults is None:
+            labelCacheStats['misses'] += 1
+            return None
+        labelCacheStats['tableHits'] += 1
+    rememberLabels(contentKey, detectLabelsResults)
+    return detectLabelsResults
+
+def cacheLabels(contentKey, detectLabelsResults):
+
+    if contentKey is None:
+        return
+
+    rememberLabels(contentKey, detectLabelsResults)
+
+    # Labels are stored as a JSON string, which keeps Rekognition's floats out of DynamoDB's Decimal type
+    if labelCacheTable is not None:
+        try:
+            dynamodb.put_item(TableName=labelCacheTable, Item=toAttributes(
+                {'contentHash': contentKey, 'labels': json.dumps(detectLabelsResults['Labels'])}))
+        except ClientError as e:
+            logging.error(e)
+
+def rememberLabels(contentKey, detectLabelsResults):
+
+    with labelCacheLock:
+        labelCache[contentKey] = {'Labels': detectLabelsResults['Labels']}
+        labelCache.move_to_end(contentKey)
+        while len(labelCache) > labelCacheSize:
+            labelCache.popitem(last=False)
 
 
 # Clean the string to add the colon back into requested name
@@ -109,11 +1158,181 @@ def replaceSubstringWithColon(txt):
 
     return txt.replace("%3A", ":")
 
-def generateThumb(ourBucket, ourKey):
+def probeImage(ourBucket, ourKey):
+
+    # Clean the string to add the colon back into requested name
+    key = unquote_plus(replaceSubstringWithColon(ourKey))
+
+    try:
+        with span('probe') as values:
+            response = s3_client.get_object(Bucket=ourBucket, Key=key, Range='bytes=0-{}'.format(probeBytes - 1))
+            data = response['Body'].read()
+            values['bytes'] = len(data)
+    except ClientError as e:
+        # S3 answers a ranged GET of an empty object with InvalidRange; there's no image to retry for
+        if e.response['Error']['Code'] == 'InvalidRange':
+            raise UnsupportedImageError("Empty object")
+        logging.error(e)
+        raise
+    if not data:
+        raise UnsupportedImageError("Empty object")
+
+    # Content-Range is "bytes 0-65535/<object size>"
+    length = int(response.get('ContentRange', '/{}'.format(len(data))).rsplit('/', 1)[1])
+    probe = {
+        'format': sniffFormat(data[:16]),
+        'length': length,
+        'data': data if len(data) >= length else None,
+        'head': data,
+        'uploaded': uploadTime(response.get('LastModified')),
+        'mode': None,
+        'size': None,
+        'orientation': None,
+    }
+
+    if probe['format'] != 'HEIF':
+        # Only the header is parsed here (Image.open doesn't decode pixels); it also runs Pillow's
+        # decompression bomb check on the declared size
+        loadPIL()
+        try:
+            with Image.open(io.BytesIO(data), formats=pilFormats) as image:
+                probe.update(mode=image.mode, size=image.size, orientation=exifOrientation(image))
+                checkPixels(image)
+        except (Image.DecompressionBombError, Image.DecompressionBombWarning) as e:
+            raise UnsupportedImageError(str(e))
+        except OSError as e:
+            # A header that doesn't fit in the probe is left for the full decode to judge (WebP
+            # reads the whole stream when opened, so truncation shows up as an OSError there)
+            if probe['data'] is not None:
+                raise UnsupportedImageError(str(e))
+
+    probe['route'] = probeRoute(probe)
+    traceProperties(format=probe['format'], route=probe['route'], length=length,
+                    width=probe['size'] and probe['size'][0], height=probe['size'] and probe['size'][1])
+    with decodeStatsLock:
+        probeRoutes[probe['route']] = probeRoutes.get(probe['route'], 0) + 1
+    return probe
+
+def uploadTime(lastModified=None):
+
+    # ISO 8601 in UTC, so upload times sort as strings
+    if lastModified is None:
+        return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    return lastModified.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def probeRoute(probe):
+
+    if probe['format'] == 'HEIF':
+        return 'passthrough'
+    if probe['data'] is not None:
+        return 'small'
+    if probe['size'] is None:
+        return 'full'
+    largest = max(renditionSize(probe['size'], rendition) for rendition in renditions)
+    if draftMode and probe['format'] == 'JPEG' and \
+            min(x / y for x, y in zip(probe['size'], largest)) >= 2 * draftReducingGap:
+        return 'draft'
+    return 'full'
+
+def generateThumb(ourBucket, ourKey, probeTask=None, hashTask=None):
+
+    try:
+        if thumbMode == 'file':
+            return generateThumbFile(ourBucket, ourKey)
+        return generateThumbStream(ourBucket, ourKey, probeTask, hashTask)
+    finally:
+        # Images without a hash (HEIF, file mode, failures) must not keep the label task waiting
+        if hashTask is not None and not hashTask.done():
+            hashTask.set_result(None)
+
+def generateThumbStream(ourBucket, ourKey, probeTask=None, hashTask=None):
+
+    # Clean the string to add the colon back into requested name
+    safeKey = replaceSubstringWithColon(ourKey)
+    key = unquote_plus(safeKey)
+
+    probe = probeTask.result() if probeTask is not None else probeImage(ourBucket, ourKey)
+
+    # A JPEG whose EXIF thumbnail is large enough is thumbnailed from the probe alone. The probe must
+    # have reached the frame header; when it couldn't (APP segments larger than the probe), or the
+    # head doesn't open after all, the whole object is downloaded as usual
+    result = None
+    if probe['data'] is None and probe['format'] == 'JPEG' and probe['size'] is not None and embeddedPreviews:
+        try:
+            result = resize_image_renditions(io.BytesIO(probe['head']), previewOnly=True, hashTask=hashTask)
+        except (UnsupportedImageError, OSError):
+            result = None
+
+    # Otherwise read the object body into memory, only spilling over to /tmp for very large uploads.
+    # Small uploads were already read whole by the probe
+    if result is None:
+        with tempfile.SpooledTemporaryFile(max_size=spoolMaxBytes, dir='/tmp') as source:
+            if probe['data'] is not None:
+                source.write(probe['data'])
+            else:
+                try:
+                    with span('download') as values:
+                        response = s3_client.get_object(Bucket=ourBucket, Key=key)
+                        shutil.copyfileobj(response['Body'], source, 1024 * 1024)
+                        values['bytes'] = source.tell()
+                except ClientError as e:
+                    logging.error(e)
+                    raise
+            source.seek(0)
+
+            # HEIF uploads go to the resized bucket unchanged, since we can't decode them
+            if probe['format'] == 'HEIF':
+                uploadThumb(safeKey, source, 'HEIF')
+                return {'phash': None, 'detectBytes': None, 'thumbnails': {'': safeKey}}
+
+            # Create our thumbnails using Pillow library, encoded straight into buffers
+            result = resize_image_renditions(source, hashTask=hashTask)
+    thumbnails, phash, detectBytes = result
+
+    # Upload the thumbnails to the thumbnail bucket, all at once: the first one from this thread,
+    # the others from the upload pool
+    thumbKeys = {rendition.get('name', ''): renditionKey(safeKey, rendition, imageFormat)
+                 for rendition, thumbnail, imageFormat in thumbnails}
+    uploads = [
+        uploadExecutor.submit(runTraced, currentTrace(), uploadThumb, thumbKeys[rendition.get('name', '')],
+                              thumbnail, imageFormat)
+        for rendition, thumbnail, imageFormat in thumbnails[1:]
+    ]
+    if thumbnails:
+        rendition, thumbnail, imageFormat = thumbnails[0]
+        uploadThumb(thumbKeys[rendition.get('name', '')], thumbnail, imageFormat)
+    for upload in uploads:
+        upload.result()
+
+    return {'phash': phash, 'detectBytes': detectBytes, 'thumbnails': thumbKeys}
+
+def uploadThumb(thumbKey, thumbnail, imageFormat):
+
+    contentType = 'image/heif' if imageFormat == 'HEIF' else Image.MIME.get(imageFormat, 'application/octet-stream')
+    thumbnail.seek(0)
+    try:
+        with span('upload') as values:
+            body = thumbnail.read()
+            values['bytes'] = len(body)
+            s3_client.put_object(Bucket=thumbBucket, Key=thumbKey, Body=body, ContentType=contentType)
+    except ClientError as e:
+        logging.error(e)
+        raise
+
+def renditionKey(safeKey, rendition, imageFormat):
+
+    if not rendition.get('name'):
+        return safeKey
+    extension = {'JPEG': 'jpg'}.get(imageFormat, imageFormat.lower())
+    return '{}.{}.{}'.format(safeKey, rendition['name'], extension)
+
+def generateThumbFile(ourBucket, ourKey):
 
     # Clean the string to add the colon back into requested name
     safeKey = replaceSubstringWithColon(ourKey)
 
+    import uuid
+
     # Define upload and download paths
     key = unquote_plus(safeKey)
     tmpkey = key.replace('/', '')
@@ -122,7 +1341,9 @@ def generateThumb(ourBucket, ourKey):
 
     # Download file from s3 and store it in Lambda /tmp storage (512MB avail)
     try:
-        s3_client.download_file(ourBucket, key, download_path)
+        with span('download') as values:
+            s3_client.download_file(ourBucket, key, download_path)
+            values['bytes'] = os.path.getsize(download_path)
     except ClientError as e:
         logging.error(e)
     # Create our thumbnail using Pillow library
@@ -130,7 +1351,9 @@ def generateThumb(ourBucket, ourKey):
 
     # Upload the thumbnail to the thumbnail bucket
     try:
-        s3_client.upload_file(upload_path, thumbBucket, safeKey)
+        with span('upload') as values:
+            values['bytes'] = os.path.getsize(upload_path)
+            s3_client.upload_file(upload_path, thumbBucket, safeKey)
     except ClientError as e:
         logging.error(e)
 
@@ -138,9 +1361,573 @@ def generateThumb(ourBucket, ourKey):
     os.remove(upload_path)
     os.remove(download_path)
 
-    return
+    return {'phash': None, 'detectBytes': None, 'thumbnails': {'': safeKey}}
+
+def sniffFormat(prefix):
+
+    # Recognise the allowed formats from the magic bytes at the start of the file
+    if prefix.startswith(b'\xff\xd8\xff'):
+        imageFormat = 'JPEG'
+    elif prefix.startswith(b'\x89PNG\r\n\x1a\n'):
+        imageFormat = 'PNG'
+    elif prefix[:4] == b'RIFF' and prefix[8:12] == b'WEBP':
+        imageFormat = 'WEBP'
+    elif prefix[:6] in (b'GIF87a', b'GIF89a'):
+        imageFormat = 'GIF'
+    elif prefix[4:8] == b'ftyp' and prefix[8:12] in heifBrands:
+        imageFormat = 'HEIF'
+    else:
+        imageFormat = None
+
+    if imageFormat not in allowedFormats:
+        raise UnsupportedImageError("Unsupported image format (starts with {!r})".format(prefix))
+    return imageFormat
+
+def loadPIL():
+
+    global Image, ImageOps, ImageChops
+    with pilLock:
+        if Image is not None:
+            return
+
+        import importlib
+        from PIL import Image as pilImage, ImageOps as pilImageOps, ImageChops as pilImageChops
+
+        # Register our plugins ourselves and mark Pillow as initialised, so neither preinit()
+        # nor init() go and import the plugins we don't use
+        for imageFormat in set(allowedFormats + thumbFormats):
+            for plugin in formatPlugins.get(imageFormat, []):
+                importlib.import_module('PIL.' + plugin)
+        pilImage._initialized = 2
+
+        # Phone JPEGs may open as MPO, depending on the Pillow version
+        candidates = allowedFormats + (['MPO'] if 'JPEG' in allowedFormats else [])
+        pilFormats.extend(pilFormat for pilFormat in candidates if pilFormat in pilImage.OPEN)
+
+        # Oversized images raise instead of only warning. Pillow only knows the higher limit of
+        # PNGs reduced strip by strip; checkPixels() applies MAX_IMAGE_PIXELS to everything else
+        pilImage.MAX_IMAGE_PIXELS = max(maxImagePixels, stripMaxPixels)
+        warnings.simplefilter('error', pilImage.DecompressionBombWarning)
+
+        ImageOps, ImageChops = pilImageOps, pilImageChops
+        Image = pilImage
+
+def openImage(source):
+
+    # Only the allowed formats are tried; anything Pillow can't open is never going to work
+    try:
+        image = Image.open(source, formats=pilFormats)
+    except (Image.UnidentifiedImageError, Image.DecompressionBombError, Image.DecompressionBombWarning) as e:
+        raise UnsupportedImageError(str(e))
+    try:
+        checkPixels(image)
+    except UnsupportedImageError:
+        image.close()
+        raise
+    return image
+
+def exifOrientation(image):
+
+    # PngImageFile.getexif() decodes the whole image to look for an eXIf chunk after the image
+    # data; one written before it (where it belongs) is already in info when the header is read
+    if image.format == 'PNG' and 'exif' not in image.info:
+        return None
+    return image.getexif().get(0x0112)
+
+def checkPixels(image):
+
+    pixels = image.width * image.height
+    if pixels > maxImagePixels and not (stripEligible(image) and pixels <= stripMaxPixels):
+        raise UnsupportedImageError("Image size ({} pixels) exceeds limit of {} pixels".format(pixels, maxImagePixels))
 
 def resize_image(image_path, resized_path):
-    with Image.open(image_path) as image:
-        image.thumbnail(tuple(x / 2 for x in image.size))
-        image.save(resized_path)
+    loadPIL()
+    with open(image_path, 'rb') as f:
+        sniffFormat(f.read(16))
+    with openImage(image_path) as image:
+        imageFormat = image.format
+        thumbnail = make_thumbnail(image, tuple(x / 2 for x in image.size))
+        thumbnail.save(resized_path, format=imageFormat)
+
+def resize_image_renditions(source, previewOnly=False, hashTask=None):
+
+    # Decode once at the size of the largest rendition, then derive each smaller rendition
+    # from the previous one, so every step only resizes an already small image. With previewOnly
+    # the source may be truncated, and None is returned unless an EXIF thumbnail will do. The
+    # perceptual hash is set on hashTask as soon as it is known
+    loadPIL()
+    thumbnails = []
+    with openImage(source) as image:
+        # MPO (multi-picture JPEG from phones) can only be written back as a plain JPEG
+        sourceFormat = 'JPEG' if image.format == 'MPO' else image.format
+
+        # Rendition sizes are in upright (display) orientation, like the thumbnails themselves
+        orientation = exifOrientation(image)
+        transposed = orientation in (5, 6, 7, 8)
+        displaySize = image.size[::-1] if transposed else image.size
+        ordered = sorted(
+            ((renditionSize(displaySize, rendition), rendition) for rendition in renditions),
+            key=lambda entry: entry[0][0] * entry[0][1],
+            reverse=True,
+        )
+        largest = ordered[0][0]
+        target = largest[::-1] if transposed else largest
+
+        # Start from the smallest embedded preview that decodes, if any is large enough. Previews
+        # don't carry the orientation of the picture, so it is passed along
+        current = None
+        if embeddedPreviews:
+            for kind, preview in embeddedPreviewImages(image, target, None if previewOnly else source):
+                try:
+                    current = make_thumbnail(preview, target, orientation or 1)
+                except OSError as e:
+                    logging.warning("Unusable %s preview: %s", kind, e)
+                    continue
+                traceProperties(preview=kind)
+                break
+        if current is None:
+            if previewOnly:
+                return None
+            if stripEligible(image) and image.width * image.height > stripMinPixels:
+                current = strip_thumbnail(image, source, target, orientation or 1)
+            else:
+                current = make_thumbnail(image, target)
+        phash = dhash(current)
+        if hashTask is not None and not hashTask.done():
+            hashTask.set_result(phash)
+
+        detectBytes = None
+        for size, rendition in ordered:
+            if current.size[0] > size[0] or current.size[1] > size[1]:
+                with span('resize'):
+                    current.thumbnail(size, Image.BICUBIC, reducing_gap=2.0)
+            buffer, imageFormat = encodeThumbnail(current, rendition, sourceFormat)
+            thumbnails.append((rendition, buffer, imageFormat))
+
+            # The largest rendition is what Rekognition gets when detecting labels from bytes
+            if detectSource == 'bytes' and len(thumbnails) == 1:
+                detectBytes = detectImage(current, *thumbnails[0][1:])
+
+    return thumbnails, phash, detectBytes
+
+def detectImage(image, buffer, imageFormat):
+
+    # Too small and labels get worse; re-encode as JPEG if Rekognition can't read the rendition
+    if min(image.size) < detectMinEdge:
+        return None
+    if imageFormat not in rekognitionFormats:
+        buffer = encode_image(image, 'JPEG', 90)
+    data = buffer.getvalue()
+    return data if len(data) <= detectMaxBytes else None
+
+def embeddedPreviewImages(image, size, source=None):
+
+    # Opened (not yet decoded) previews of the picture at least size large and of the same aspect
+    # ratio, smallest first. MPO frames are only looked for when the whole file is in source
+    encoded = []
+    thumbnail = exifThumbnail(image.info.get('exif'))
+    if thumbnail is not None:
+        encoded.append(('exif', thumbnail))
+    if image.format == 'MPO' and source is not None:
+        encoded.extend(('mpo', frame) for frame in mpoPreviews(image, source))
+
+    # Previews are held to the same pixel limit as pictures; one that doesn't open, or claims to be
+    # larger than that, is passed over
+    previews = []
+    for kind, data in encoded:
+        try:
+            preview = Image.open(io.BytesIO(data), formats=['JPEG'])
+            checkPixels(preview)
+        except (OSError, UnsupportedImageError, Image.DecompressionBombError, Image.DecompressionBombWarning) as e:
+            logging.warning("Unusable %s preview: %s", kind, e)
+            continue
+        width, height = preview.size
+        if (width >= size[0] and height >= size[1]
+                and abs(width * image.height - height * image.width) <= 0.01 * height * image.width):
+            previews.append((width * height, kind, preview))
+    return [(kind, preview) for area, kind, preview in sorted(previews, key=lambda entry: entry[0])]
+
+def exifThumbnail(exif):
+
+    # The thumbnail is described by IFD1, the IFD after the main one: JPEGInterchangeFormat (0x0201)
+    # is its offset in the TIFF structure of the EXIF block, JPEGInterchangeFormatLength (0x0202) its length
+    if not exif:
+        return None
+    from PIL import TiffImagePlugin
+
+    data = exif[6:] if exif.startswith(b'Exif\x00\x00') else exif
+    try:
+        fp = io.BytesIO(data)
+        ifd0 = TiffImagePlugin.ImageFileDirectory_v2(data[:8])
+        fp.seek(ifd0.next)
+        ifd0.load(fp)
+        if not ifd0.next:
+            return None
+        ifd1 = TiffImagePlugin.ImageFileDirectory_v2(data[:8])
+        fp.seek(ifd0.next)
+        ifd1.load(fp)
+    except (OSError, SyntaxError, ValueError, struct.error):
+        return None
+
+    offset, length = ifd1.get(0x0201), ifd1.get(0x0202)
+    if not offset or not length or offset + length > len(data):
+        return None
+    return data[offset:offset + length]
+
+def mpoPreviews(image, source):
+
+    # The large thumbnail frames of an MPO file, as JPEG bytes. They are read through an image of
+    # their own, so the picture itself stays on its first frame
+    frames = [frame for frame, entry in enumerate(image.mpinfo[0xB002])
+              if frame and str(entry['Attribute']['MPType']).startswith('Large Thumbnail')]
+    if not frames:
+        return []
+
+    previews = []
+    position = source.tell()
+    try:
+        with Image.open(source, formats=pilFormats) as reader:
+            for frame in frames:
+                reader.seek(frame)
+                reader.fp.seek(reader.offset)
+                previews.append(reader.fp.read(image.mpinfo[0xB002][frame]['Size']))
+    except (OSError, ValueError, EOFError) as e:
+        logging.warning("Unreadable MPO frames: %s", e)
+    source.seek(position)
+    return previews
+
+def dhash(image):
+
+    # Difference hash: shrink to 9x8 greyscale and set a bit wherever a pixel is brighter than its
+    # right neighbour. The comparison is done on whole images (subtract clips at 0, then threshold to
+    # mode "1"), whose 8 packed bytes are the 64 bit hash. None for images too flat to tell apart
+    small = image.convert('L').resize((9, 8), Image.BILINEAR)
+    darkest, brightest = small.getextrema()
+    if brightest - darkest < minHashContrast:
+        return None
+    brighter = ImageChops.subtract(small.crop((0, 0, 8, 8)), small.crop((1, 0, 9, 8)))
+    bits = brighter.point([0] + [255] * 255, '1')
+    phash = int.from_bytes(bits.tobytes(), 'big')
+    if bin(phash).count('1') < minHashBits:
+        return None
+    return phash
+
+def renditionSize(size, rendition):
+
+    if 'maxEdge' in rendition:
+        ratio = min(1.0, rendition['maxEdge'] / max(size))
+    else:
+        ratio = rendition.get('scale', 0.5)
+    return tuple(max(1, int(x * ratio)) for x in size)
+
+def encodeThumbnail(image, rendition, sourceFormat):
+
+    imageFormat = rendition.get('format', thumbFormat)
+    if imageFormat == 'source':
+        imageFormat = sourceFormat
+    alpha = hasAlpha(image)
+    lossless = imageFormat == 'PNG'
+    if imageFormat == 'auto':
+        graphic = isGraphic(image)
+        imageFormat, lossless = encodings(alpha, graphic)[0]
+        if graphic and imageFormat == 'PNG' and not alpha:
+            # Flat colours survive a 256 colour palette, at a fraction of the size of RGB pixels
+            image = image.convert('RGB').convert('P', palette=Image.ADAPTIVE, colors=256)
+
+    quality = rendition.get('quality', thumbQuality)
+    maxBytes = rendition.get('maxBytes', thumbMaxBytes)
+    buffer = encode_image(image, imageFormat, quality, lossless)
+    if not maxBytes or buffer.tell() <= maxBytes:
+        return buffer, imageFormat
+
+    # Over budget: lossless encodes fall back to the preferred lossy format, then the quality is
+    # brought down until it fits
+    highest = quality - 1
+    if lossless:
+        lossy = [encoding for encoding in encodings(alpha, graphic=False) if not encoding[1]]
+        if not lossy:
+            return buffer, imageFormat
+        imageFormat, highest = lossy[0][0], quality
+    return searchQuality(image, imageFormat, highest, maxBytes), imageFormat
+
+def encodings(alpha, graphic):
+
+    # (format, lossless) we would encode an image in, preferred first, among those we may write
+    if graphic and alpha:
+        preferred = [('WEBP', True), ('PNG', True)]
+    elif graphic:
+        preferred = [('PNG', True), ('WEBP', True)]
+    else:
+        preferred = []
+    if alpha:
+        preferred += [('WEBP', False), ('PNG', True), ('JPEG', False)]
+    else:
+        preferred += [('JPEG', False), ('WEBP', False), ('PNG', True)]
+    return [encoding for encoding in preferred if encoding[0] in thumbFormats] or [('JPEG', False)]
+
+def isGraphic(image):
+
+    # Graphics are mostly flat areas, so a few colours cover most of the image, where the colours
+    # of a photo are spread out. Counted on a nearest-neighbour sample, which keeps colours intact
+    sample = image
+    if image.width * image.height > 256 * 256:
+        ratio = 256 / max(image.size)
+        sample = image.resize((max(1, int(image.width * ratio)), max(1, int(image.height * ratio))), Image.NEAREST)
+    pixels = sample.width * sample.height
+    colors = sorted((count for count, color in sample.getcolors(pixels)), reverse=True)
+    return sum(colors[:64]) >= graphicCoverage * pixels
+
+def hasAlpha(image):
+
+    if image.mode in ('RGBA', 'LA', 'PA'):
+        return image.getchannel('A').getextrema()[0] < 255
+    return image.mode == 'P' and 'transparency' in image.info
+
+def searchQuality(image, imageFormat, highest, maxBytes):
+
+    # Binary search for the highest quality that fits. If even the lowest doesn't, keep that one
+    low, high = thumbMinQuality, highest
+    best = None
+    for _ in range(thumbQualitySteps):
+        if low > high:
+            break
+        middle = (low + high + 1) // 2
+        buffer = encode_image(image, imageFormat, middle)
+        if buffer.tell() <= maxBytes:
+            best, low = buffer, middle + 1
+        else:
+            high = middle - 1
+    return best if best is not None else encode_image(image, imageFormat, thumbMinQuality)
+
+def encode_image(image, imageFormat, quality=None, lossless=False):
+
+    if imageFormat == 'JPEG' and image.mode not in ('RGB', 'L', 'CMYK'):
+        image = image.convert('RGB')
+    options = {'quality': quality} if quality and not lossless else {}
+    if imageFormat == 'JPEG':
+        # Optimised Huffman tables and progressive scans make smaller files, which also render
+        # early on slow connections
+        options.update(optimize=True, progressive=True)
+    elif imageFormat == 'WEBP' and lossless:
+        # Fastest lossless effort; higher ones save a little more for 10 to 30 times the time
+        options.update(lossless=True, quality=0, method=0)
+    elif imageFormat == 'PNG' and image.mode == 'RGB' and image.getcolors(256) is not None:
+        # An exact palette is a fraction of the size of RGB pixels
+        image = image.convert('P', palette=Image.ADAPTIVE, colors=256)
+    buffer = io.BytesIO()
+    with span('encode') as values:
+        image.save(buffer, format=imageFormat, **options)
+        values['bytes'] = buffer.tell()
+    return buffer
+
+def make_thumbnail(image, size, orientation=None):
+
+    # size is given in stored pixel orientation; the returned thumbnail is rotated upright
+    # according to its EXIF orientation (or the orientation given), since the EXIF block isn't
+    # carried over on save
+    start = time.perf_counter()
+    box = None
+    with span('decode'):
+        if draftMode and image.format == 'JPEG':
+            originalSize = image.size
+            box = draft_image(image, size)
+        image.load()
+    recordDecode(image.format, time.perf_counter() - start, box is not None)
+
+    with span('resize'):
+        if box is None:
+            image.thumbnail(size)
+        else:
+            # A drafted JPEG is decoded in whole blocks, so its last row and column may be only partly
+            # picture: only the box draft() returned is resized, to the size of the original's thumbnail
+            image = image.resize(fitSize(originalSize, size), Image.BICUBIC, box=box, reducing_gap=2.0)
+        return orient(image, orientation)
+
+def fitSize(imageSize, size):
+
+    # The largest size within size with the aspect ratio of imageSize, never larger than imageSize
+    scale = min(1.0, size[0] / imageSize[0], size[1] / imageSize[1])
+    return tuple(max(1, round(x * scale)) for x in imageSize)
+
+def orient(image, orientation=None):
+
+    if orientation is None:
+        return ImageOps.exif_transpose(image)
+    method = {
+        2: Image.FLIP_LEFT_RIGHT, 3: Image.ROTATE_180, 4: Image.FLIP_TOP_BOTTOM, 5: Image.TRANSPOSE,
+        6: Image.ROTATE_270, 7: Image.TRANSVERSE, 8: Image.ROTATE_90,
+    }.get(orientation)
+    return image.transpose(method) if method is not None else image
+
+def strip_thumbnail(image, source, size, orientation=None):
+
+    # Like make_thumbnail, but the PNG is never decoded whole: it is box filtered by the integer
+    # factor that keeps it at least size large while decoding band by band, and only that reduced
+    # image is resized
+    start = time.perf_counter()
+    factor = max(1, min(image.width // size[0], image.height // size[1]))
+    with span('decode'):
+        reduced = reduce_png_strips(source, factor)
+    recordDecode(image.format, time.perf_counter() - start, False, stripped=True)
+
+    with span('resize'):
+        reduced.thumbnail(size)
+        return orient(reduced, orientation)
+
+def stripEligible(image):
+
+    # 8 bit samples, which Pillow stores just as PNG does: the last row of a decoded band can then
+    # be handed back as the unfiltered predecessor of the next band
+    if not stripwise or image.format != 'PNG' or image.info.get('interlace'):
+        return False
+    return (len(image.tile) == 1 and image.tile[0][0] == 'zip' and image.tile[0][3] == image.mode
+            and image.mode in ('L', 'LA', 'P', 'RGB', 'RGBA'))
+
+def reduce_png_strips(source, factor):
+
+    # The IDAT stream is inflated at most a band at a time; the result is Image.reduce(factor) of
+    # the whole image (palette images are converted to RGB or RGBA first, as they can't be reduced)
+    source.seek(0)
+    header, palette, reducer = None, b'', None
+    decompressor = zlib.decompressobj()
+    for kind, data in pngChunks(source):
+        if kind == b'IHDR':
+            header = data
+        elif kind in (b'PLTE', b'tRNS'):
+            palette += pngChunk(kind, data)
+        elif kind == b'IDAT':
+            if reducer is None:
+                reducer = PngStripReducer(header, palette, factor)
+            while data:
+                reducer.feed(decompressor.decompress(data, reducer.bandBytes))
+                data = decompressor.unconsumed_tail
+    if reducer is None:
+        raise OSError("PNG file without image data")
+    reducer.feed(decompressor.flush())
+    return reducer.finish()
+
+def pngChunks(source, pieceSize=1024 * 1024):
+
+    # (type, data) of each chunk up to IEND, long chunks (a single IDAT can hold the whole image) in
+    # pieces of at most pieceSize bytes
+    if source.read(8) != pngSignature:
+        raise OSError("Not a PNG file")
+    while True:
+        chunkHeader = source.read(8)
+        if len(chunkHeader) < 8:
+            raise OSError("Truncated PNG file")
+        length, kind = struct.unpack('>I4s', chunkHeader)
+        crc = zlib.crc32(kind)
+        while True:
+            piece = source.read(min(length, pieceSize))
+            if len(piece) < min(length, pieceSize):
+                raise OSError("Truncated PNG file")
+            crc = zlib.crc32(piece, crc)
+            length -= len(piece)
+            yield kind, piece
+            if not length:
+                break
+        if source.read(4) != struct.pack('>I', crc & 0xffffffff):
+            raise OSError("Broken PNG file (bad CRC in {!r} chunk)".format(kind))
+        if kind == b'IEND':
+            return
+
+def pngChunk(kind, data):
+
+    crc = zlib.crc32(data, zlib.crc32(kind)) & 0xffffffff
+    return b''.join((struct.pack('>I', len(data)), kind, data, struct.pack('>I', crc)))
+
+class PngStripReducer:
+
+    # Collects the inflated (still filtered) scanlines of a PNG and reduces them a band at a time.
+    # Bands are a multiple of factor rows high, so reducing them one by one gives the same pixels as
+    # reducing the whole image. Each band is wrapped in a PNG of its own, stored rather than
+    # compressed again, for Pillow to undo the filters; its first row is the last row of the previous
+    # band, unfiltered, which the Up, Average and Paeth filters of the band's first scanline refer to
+
+    def __init__(self, header, palette, factor):
+        self.width, self.height = struct.unpack('>II', header[:8])
+        self.header = header
+        self.palette = palette
+        self.factor = factor
+        self.rowBytes = 1 + self.width * pngChannels[header[9]]
+        self.bandRows = factor * max(1, stripRows // factor)
+        self.bandBytes = self.bandRows * self.rowBytes
+        self.scanlines = bytearray()
+        self.previous = None
+        self.y = 0
+        self.image = None
+
+    def feed(self, data):
+        self.scanlines += data
+        while len(self.scanlines) >= self.bandBytes and self.y < self.height:
+            self.reduceBand(self.bandRows)
+
+    def finish(self):
+        if self.scanlines and self.y < self.height:
+            self.reduceBand(len(self.scanlines) // self.rowBytes)
+        if self.y < self.height:
+            raise OSError("Truncated PNG file")
+        return self.image
+
+    def reduceBand(self, rows):
+        rows = min(rows, self.height - self.y)
+        first = 0 if self.previous is None else 1
+        compressor = zlib.compressobj(0)
+        with memoryview(self.scanlines) as scanlines:
+            data = b''.join((
+                compressor.compress(b'\0' + self.previous) if first else b'',
+                compressor.compress(scanlines[:rows * self.rowBytes]),
+                compressor.flush(),
+            ))
+        del self.scanlines[:rows * self.rowBytes]
+
+        header = struct.pack('>II', self.width, rows + first) + self.header[8:]
+        png = b''.join((pngSignature, pngChunk(b'IHDR', header), self.palette, pngChunk(b'IDAT', data),
+                        pngChunk(b'IEND', b'')))
+        with Image.open(io.BytesIO(png), formats=['PNG']) as band:
+            band.load()
+            self.previous = band.crop((0, rows + first - 1, self.width, rows + first)).tobytes()
+            if first:
+                band = band.crop((0, first, self.width, rows + first))
+            if band.mode == 'P':
+                band = band.convert('RGBA' if 'transparency' in band.info else 'RGB')
+            strip = band.reduce(self.factor)
+
+        if self.image is None:
+            self.image = Image.new(strip.mode, (-(-self.width // self.factor), -(-self.height // self.factor)))
+        self.image.paste(strip, (0, self.y // self.factor))
+        self.y += rows
+
+def draft_image(image, size):
+
+    # Only worth it when the target allows at least a 1/2 scale; draft() then picks the
+    # largest of 1/8, 1/4 and 1/2 that keeps the decoded image above the requested size. Returns
+    # the box of the decoded image the picture fills, or None when the image wasn't drafted
+    target = tuple(int(x * draftReducingGap) for x in size)
+    if image.width < 2 * target[0] or image.height < 2 * target[1]:
+        return None
+    result = image.draft(image.mode, target)
+    return result[1] if result is not None else None
+
+def recordDecode(imageFormat, seconds, drafted, stripped=False):
+
+    with decodeStatsLock:
+        stats = decodeStats.setdefault(imageFormat, {'count': 0, 'seconds': 0.0, 'drafted': 0, 'stripped': 0})
+        stats['count'] += 1
+        stats['seconds'] += seconds
+        stats['drafted'] += int(drafted)
+        stats['stripped'] += int(stripped)
+
+def decodeMetrics():
+
+    with decodeStatsLock:
+        return {
+            imageFormat: {
+                'count': stats['count'],
+                'drafted': stats['drafted'],
+                'stripped': stats['stripped'],
+                'avgDecodeMs': round(stats['seconds'] * 1000 / stats['count'], 2),
+            }
+            for imageFormat, stats in decodeStats.items()
+        }
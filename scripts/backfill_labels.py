@@ -0,0 +1,121 @@
+#
+# Migrate the label items written before schemaVersion 2, which only hold the object1..objectN names,
+# to the current layout. Each item's names become its compact label list (the confidences weren't
+# kept, so every label gets --confidence, the MinConfidence they were detected with), along with the
+# owner, the upload time (the LastModified of the original) and the thumbnail key servicelambda lists
+# images with; its label index entries are written with it, by rekognitionLambda's writeLabels.
+# Items already in the current layout are left alone, so the script can be run again after a partial
+# run. Items whose original is gone are reported and left as they are, for deleteImages to clear
+#
+# Usage: TABLE=<labels table> LABELINDEXTABLE=<label index table> BUCKET=<upload bucket> \
+#        RESIZEDBUCKET=<thumbnail bucket> python scripts/backfill_labels.py [--dry-run] [--workers 16]
+#
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'rekognitionLambda'))
+
+import index
+from botocore.exceptions import ClientError
+
+
+def legacyItems(tableName):
+
+    # Scan the label table for items without a schemaVersion, page by page
+    options = {}
+    while True:
+        response = index.dynamodb.scan(TableName=tableName, FilterExpression='attribute_not_exists(schemaVersion)',
+                                       **options)
+        for item in response['Items']:
+            yield index.fromAttributes(item)
+        if 'LastEvaluatedKey' not in response:
+            return
+        options['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def migrateItem(item, bucketName, confidence):
+
+    # The item in the current layout, or None when the original is gone
+    names = [item[f'object{n}'] for n in range(1, len(item) + 1) if f'object{n}' in item]
+    try:
+        response = index.s3_client.head_object(Bucket=bucketName, Key=item['image'])
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+
+    return {
+        'image': item['image'],
+        'schemaVersion': index.labelsSchemaVersion,
+        'labels': json.dumps([[name, confidence, [], []] for name in names], separators=(',', ':')),
+        'version': '{:x}'.format(time.time_ns()),
+        'owner': index.keyOwner(item['image']),
+        'uploaded': index.uploadTime(response['LastModified']),
+        'thumbnails': json.dumps({'': item['image']}, separators=(',', ':')),
+    }
+
+
+def backfill(bucketName, confidence=50.0, workers=16, batchSize=500, dryRun=False):
+
+    # Migrate the legacy items batch by batch: the originals' metadata is read side by side, then
+    # the batch is written with its label index entries. Returns the keys migrated, missing and failed
+    results = {'migrated': [], 'missing': [], 'failed': []}
+    items = legacyItems(index.imageLabelsTable)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            batch = [item for _, item in zip(range(batchSize), items)]
+            if not batch:
+                return results
+
+            migrated = []
+            tasks = [executor.submit(migrateItem, item, bucketName, confidence) for item in batch]
+            for item, task in zip(batch, tasks):
+                try:
+                    result = task.result()
+                except ClientError as e:
+                    logging.error(e)
+                    results['failed'].append(item['image'])
+                    continue
+                if result is None:
+                    results['missing'].append(item['image'])
+                else:
+                    migrated.append(result)
+
+            failedKeys = set()
+            if migrated and not dryRun:
+                failedKeys = index.writeLabels(migrated)
+            results['failed'].extend(item['image'] for item in migrated if item['image'] in failedKeys)
+            results['migrated'].extend(item['image'] for item in migrated if item['image'] not in failedKeys)
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--confidence', type=float, default=50.0,
+                        help='confidence given to the legacy labels (the MinConfidence they were detected with)')
+    parser.add_argument('--workers', type=int, default=16, help='originals whose metadata is read side by side')
+    parser.add_argument('--dry-run', action='store_true', help='only report what would be migrated')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    results = backfill(os.environ['BUCKET'], args.confidence, args.workers, dryRun=args.dry_run)
+    print(f'{"would migrate" if args.dry_run else "migrated"} {len(results["migrated"])} items in '
+          f'{time.perf_counter() - start:.1f} s; {len(results["missing"])} without an original, '
+          f'{len(results["failed"])} failed')
+    for key in results['missing']:
+        print(f'  no original: {key}')
+    for key in results['failed']:
+        print(f'  failed: {key}')
+    if results['failed']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
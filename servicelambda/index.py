@@ -6,20 +6,104 @@ import logging
 import boto3
 from botocore.exceptions import ClientError
 import os
+import json
+import base64
+import collections
+import random
+import threading
+import time
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
 
+# Label thresholds applied at read time; rekognitionLambda stores the full label list, so these
+# can change (or be overridden per request) without calling Amazon Rekognition again
+minConfidence = float(os.environ.get('MIN_CONFIDENCE', 50))
+maxLabels = int(os.environ.get('MAX_LABELS', 10))
+
+# getLabelsBatch reads up to MAX_BATCH_KEYS images in BatchGetItem calls of 100 keys, BATCH_GET_WORKERS
+# of them at a time, retrying UnprocessedKeys with exponential backoff up to BATCH_GET_ATTEMPTS times
+maxBatchKeys = int(os.environ.get('MAX_BATCH_KEYS', 500))
+batchGetSize = 100
+batchGetWorkers = int(os.environ.get('BATCH_GET_WORKERS', 8))
+batchGetAttempts = int(os.environ.get('BATCH_GET_ATTEMPTS', 5))
+
+# searchByLabel reads the LABELINDEXTABLE partitions ("<identity id>#<label>", sorted by image key)
+# of the labels searched for, SEARCH_PAGE_SIZE entries per Query, and returns at most that many
+# images per request. After SEARCH_MAX_QUERIES Queries it returns what it has found with a token to
+# carry on from, so a request costs the same however large the library is. At most SEARCH_MAX_LABELS
+# labels can be searched for at once, their first pages read SEARCH_WORKERS at a time
+labelIndexTable = os.environ.get('LABELINDEXTABLE')
+searchPageSize = int(os.environ.get('SEARCH_PAGE_SIZE', 100))
+searchMaxQueries = int(os.environ.get('SEARCH_MAX_QUERIES', 40))
+searchMaxLabels = int(os.environ.get('SEARCH_MAX_LABELS', 10))
+searchWorkers = int(os.environ.get('SEARCH_WORKERS', 8))
+
+# listImages pages through a user's label items, newest upload first, with a Query of the
+# OWNERINDEX global secondary index (partition "owner", the identity id of the image key, sorted by
+# "uploaded"), at most LIST_PAGE_SIZE items per request
+ownerIndex = os.environ.get('OWNERINDEX', 'byOwner')
+listPageSize = int(os.environ.get('LIST_PAGE_SIZE', 50))
+
+# deleteImages removes up to MAX_DELETE_KEYS images per request: originals and thumbnails with S3
+# DeleteObjects calls of up to 1000 keys, label items and label index entries with BatchWriteItem
+# calls of 25 deletes, DELETE_WORKERS calls at a time (the label items are read the same way first),
+# retrying what is handed back with exponential backoff up to DELETE_ATTEMPTS times
+maxDeleteKeys = int(os.environ.get('MAX_DELETE_KEYS', 1000))
+deleteObjectsSize = 1000
+batchWriteSize = 25
+deleteWorkers = int(os.environ.get('DELETE_WORKERS', 8))
+deleteAttempts = int(os.environ.get('DELETE_ATTEMPTS', 5))
+
+# Label items read by getLabels and getLabelsBatch are kept in a per-container LRU cache of at most
+# READ_CACHE_SIZE items and READ_CACHE_BYTES bytes, and served from it for READ_CACHE_TTL seconds.
+# After that getLabels reads only the item's "version", which rekognitionLambda rewrites every time
+# it labels the image, and keeps the entry if it is unchanged; so a deleted or re-labelled image is
+# never served more than READ_CACHE_TTL seconds stale. READ_CACHE_SIZE=0 turns the cache off
+readCacheSize = int(os.environ.get('READ_CACHE_SIZE', 2048))
+readCacheBytes = int(os.environ.get('READ_CACHE_BYTES', 32 * 2 ** 20))
+readCacheTtl = float(os.environ.get('READ_CACHE_TTL', 60))
+
+# listImages and searchByLabel only return the caller's own images. The caller's identity id (the
+# "<identity id>" of "private/<identity id>/...") is looked up in the IDENTITYPOOLID identity pool
+# with the ID token API Gateway's Cognito authorizer accepted, once per user and container, and a
+# request for any other identityId is refused. Without IDENTITYPOOLID (the function invoked directly,
+# not through the API) the identityId of the request is taken as it is
+identityPoolId = os.environ.get('IDENTITYPOOLID')
+identityProvider = os.environ.get('IDENTITYPROVIDER')
 
 # Constructors for Amazon DynamoDB and S3 resource object
 dynamodb = boto3.resource('dynamodb')
 s3 = boto3.resource('s3')
+# Cognito Identity client, only created when callers are checked (see callerIdentity)
+cognito_identity = None
+
+# Identity ids of the callers, by the "sub" of their user pool claims
+identityIds = {}
+
+# Table resource objects, built once per container rather than on every request
+tables = {}
+
+# Read cache: image key -> (item, size in bytes, expiry time), least recently used first
+readCache = collections.OrderedDict()
+readCacheLock = threading.Lock()
+readCacheStats = {'hits': 0, 'revalidated': 0, 'misses': 0, 'evictions': 0, 'bytes': 0}
 
 def handler(event, context):
 
     # Detect requested action from the Amazon API Gateway Event
     action = event['action']
-    image = event['key']
     
     imageRequest = {
-    "key": image
+    "key": event.get('key'),
+    "keys": event.get('keys'),
+    "identityId": event.get('identityId'),
+    "labels": event.get('labels'),
+    "match": (event.get('match') or "and").lower(),
+    "limit": int(event.get('limit') or 0),
+    "nextToken": event.get('nextToken') or None,
+    "minConfidence": float(event.get('minConfidence') or minConfidence),
+    "maxLabels": int(event.get('maxLabels') or maxLabels),
+    "stats": event.get('stats') in ("1", "true"),
     }
     
     # GET Request from API
@@ -30,6 +114,32 @@ def handler(event, context):
         else:
             return "No Results"
 
+    # Images are only read in batches, or deleted, by their owner
+    if action in ("getLabelsBatch", "deleteImages"):
+        checkKeys(event, imageRequest['keys'])
+    if action == "deleteImage":
+        checkKeys(event, [imageRequest['key']])
+
+    # POST Request from API with the keys of a whole gallery
+    if action == "getLabelsBatch":
+        return getLabelsBatch(imageRequest)
+
+    # The user listed or searched is the caller
+    if action in ("listImages", "searchByLabel"):
+        imageRequest['identityId'] = callerIdentity(event)
+
+    # GET Request from API for a page of the images of a user, with their labels and thumbnails
+    if action == "listImages":
+        return listImages(imageRequest)
+
+    # GET Request from API for the images of a user having some (or all) of the labels
+    if action == "searchByLabel":
+        return searchByLabel(imageRequest)
+
+    # POST Request from API with the keys of the images to delete
+    if action == "deleteImages":
+        return deleteImages(imageRequest)
+
     # DELETE Request from API
     if action == "deleteImage":
         delResults = deleteImage(imageRequest)
@@ -37,51 +147,590 @@ def handler(event, context):
     else:
         raise Exception("Action not detected or recognised")
 
+def callerIdentity(event):
+
+    global cognito_identity
+
+    identityId = event.get('identityId') or None
+    if identityPoolId is None:
+        return identityId
+
+    # "sub" and "idToken" are set by the request template from the authorizer's claims and the
+    # Authorization header, never from the query string
+    sub = event.get('sub')
+    token = (event.get('idToken') or '').split(' ')[-1]
+    if not sub or not token:
+        raise Exception("Forbidden: the request has no authenticated caller")
+
+    caller = identityIds.get(sub)
+    if caller is None:
+        if cognito_identity is None:
+            cognito_identity = boto3.client('cognito-identity')
+        try:
+            response = cognito_identity.get_id(IdentityPoolId=identityPoolId, Logins={identityProvider: token})
+        except ClientError as e:
+            logging.error(e)
+            raise Exception("Forbidden: the caller's identity could not be resolved")
+        if len(identityIds) >= 4096:
+            identityIds.clear()
+        caller = identityIds[sub] = response['IdentityId']
+
+    if identityId is not None and identityId != caller:
+        raise Exception("Forbidden: identityId must be the caller's")
+    return caller
+
+def checkKeys(event, keys):
+
+    if identityPoolId is None:
+        return
+
+    # Every key must be under the caller's private/<identity id>/ prefix. Malformed key lists are
+    # left for the action to reject
+    prefix = "private/{}/".format(callerIdentity(dict(event, identityId=None)))
+    if isinstance(keys, list) and any(not isinstance(key, str) or not key.startswith(prefix) for key in keys):
+        raise Exception("Forbidden: keys must be the caller's own images")
+
 def getLabelsFunction(image):
 
     key = image['key']
 
-    # Instantiate a table resource object
-    imageLabelsTable = os.environ['TABLE']
-    table = dynamodb.Table(imageLabelsTable)
-
-    # Get item from table
+    # Get item from the read cache, or from the table
+    table = getTable(os.environ['TABLE'])
 
     try:
-        response = table.get_item(Key={'image': key})
-        item = response['Item']
-        return item
-        
+        item = cachedItem(table, key)
+        if item is None:
+            return "No Results"
+        result = filterLabels(item, image['minConfidence'], image['maxLabels'], details=False)
+
+        # The read cache's stats only when asked for with stats=1: the front end joins every value
+        # of the item into its label list
+        if image['stats']:
+            result['cache'] = readCacheReport()
+        return result
+
     except ClientError as e:
         logging.error(e)
         return "No labels or error"
 
-def deleteImage(image):
+def getLabelsBatch(image):
 
-    key = image['key']
+    keys = image['keys']
+    if not isinstance(keys, list) or not all(isinstance(key, str) for key in keys):
+        raise Exception("keys must be a list of image keys")
+
+    # BatchGetItem rejects duplicate keys
+    keys = list(dict.fromkeys(keys))
+    if len(keys) > maxBatchKeys:
+        raise Exception(f"At most {maxBatchKeys} keys per request")
 
-    # Instantiate a table resource object
     imageLabelsTable = os.environ['TABLE']
-    table = dynamodb.Table(imageLabelsTable)
 
-    # Delete item from table
+    # Items still fresh in the read cache are served from it; expired ones are read again with the rest
+    cached = freshItems(keys)
+    images = {key: filterLabels(item, image['minConfidence'], image['maxLabels']) for key, item in cached.items()}
+    toRead = [key for key in keys if key not in cached]
+    chunks = [toRead[i:i + batchGetSize] for i in range(0, len(toRead), batchGetSize)]
+
+    # Read the chunks side by side. Images without labels map to "No Results", like for getLabels;
+    # keys that couldn't be read are listed apart, so the caller can ask for them again
+    unprocessed = []
+    if chunks:
+        with ThreadPoolExecutor(max_workers=min(batchGetWorkers, len(chunks))) as executor:
+            for items, failedKeys in executor.map(lambda chunk: getLabelsChunk(imageLabelsTable, chunk), chunks):
+                images.update(
+                    (item['image'], filterLabels(item, image['minConfidence'], image['maxLabels'])) for item in items)
+                cacheItems(items)
+                unprocessed.extend(failedKeys)
+
+    failed = set(unprocessed)
+    for key in keys:
+        if key not in images and key not in failed:
+            images[key] = "No Results"
+    forgetItems(key for key in toRead if images.get(key) == "No Results")
+    return {"images": images, "unprocessed": unprocessed, "cache": readCacheReport()}
+
+def getTable(name):
+
+    table = tables.get(name)
+    if table is None:
+        table = tables[name] = dynamodb.Table(name)
+    return table
+
+def cachedItem(table, key):
+
+    now = time.monotonic()
+    with readCacheLock:
+        entry = readCache.get(key)
+        if entry is not None and entry[2] > now:
+            readCache.move_to_end(key)
+            readCacheStats['hits'] += 1
+            return entry[0]
+
+    # An expired entry with a version is checked against the version stored now, which spares reading
+    # and parsing the labels again when the image hasn't changed
+    if entry is not None and 'version' in entry[0]:
+        response = table.get_item(Key={'image': key}, ProjectionExpression="#version",
+                                  ExpressionAttributeNames={"#version": "version"})
+        current = response.get('Item')
+        if current is None:
+            forgetItems([key])
+            return None
+        if current.get('version') == entry[0]['version']:
+            with readCacheLock:
+                readCacheStats['revalidated'] += 1
+            cacheItems([entry[0]])
+            return entry[0]
+
+    response = table.get_item(Key={'image': key})
+    item = response.get('Item')
+    with readCacheLock:
+        readCacheStats['misses'] += 1
+    if item is None:
+        forgetItems([key])
+    else:
+        cacheItems([item])
+    return item
+
+def freshItems(keys):
+
+    now = time.monotonic()
+    items = {}
+    with readCacheLock:
+        for key in keys:
+            entry = readCache.get(key)
+            if entry is not None and entry[2] > now:
+                readCache.move_to_end(key)
+                items[key] = entry[0]
+        readCacheStats['hits'] += len(items)
+        readCacheStats['misses'] += len(keys) - len(items)
+    return items
+
+def cacheItems(items):
+
+    if readCacheSize <= 0:
+        return
+    expires = time.monotonic() + readCacheTtl
+    with readCacheLock:
+        for item in items:
+            # The size of the item as JSON stands in for the memory it takes
+            size = len(json.dumps(item, default=str))
+            if size > readCacheBytes:
+                continue
+            old = readCache.pop(item['image'], None)
+            if old is not None:
+                readCacheStats['bytes'] -= old[1]
+            readCache[item['image']] = (item, size, expires)
+            readCacheStats['bytes'] += size
+
+        while len(readCache) > readCacheSize or readCacheStats['bytes'] > readCacheBytes:
+            key, (item, size, expires) = readCache.popitem(last=False)
+            readCacheStats['bytes'] -= size
+            readCacheStats['evictions'] += 1
+
+def forgetItems(keys):
+
+    with readCacheLock:
+        for key in keys:
+            entry = readCache.pop(key, None)
+            if entry is not None:
+                readCacheStats['bytes'] -= entry[1]
+
+def readCacheReport():
+
+    # Returned with the labels, so the front end (and the benchmarks) can see how the cache does
+    with readCacheLock:
+        report = dict(readCacheStats, entries=len(readCache))
+    reads = report['hits'] + report['revalidated'] + report['misses']
+    report['hitRate'] = round((report['hits'] + report['revalidated']) / reads, 3) if reads else 0.0
+    return report
+
+def getLabelsChunk(imageLabelsTable, keys):
+
+    items = []
+    requestKeys = [{'image': key} for key in keys]
+    for attempt in range(batchGetAttempts):
+        try:
+            response = dynamodb.batch_get_item(RequestItems={imageLabelsTable: {'Keys': requestKeys}})
+        except ClientError as e:
+            logging.error(e)
+            return items, [key['image'] for key in requestKeys]
+
+        items.extend(response['Responses'].get(imageLabelsTable, []))
+        requestKeys = response.get('UnprocessedKeys', {}).get(imageLabelsTable, {}).get('Keys', [])
+        if not requestKeys:
+            return items, []
+
+        # Exponential backoff with full jitter before retrying the unprocessed keys
+        time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+
+    logging.error("Unprocessed keys after %d attempts", batchGetAttempts)
+    return items, [key['image'] for key in requestKeys]
+
+def searchByLabel(image):
+
+    labels = image['labels']
+    if isinstance(labels, str):
+        labels = labels.split(',')
+    labels = list(dict.fromkeys(label.strip().lower() for label in labels or [] if label.strip()))
+    if not image['identityId'] or not labels:
+        raise Exception("identityId and labels are required")
+    if len(labels) > searchMaxLabels:
+        raise Exception(f"At most {searchMaxLabels} labels per search")
+    if image['match'] not in ("and", "or"):
+        raise Exception("match must be \"and\" or \"or\"")
+    limit = max(1, min(image['limit'] or searchPageSize, searchPageSize))
+
+    # The first page of every label is read side by side; these Queries come out of the budget up front
+    table = getTable(labelIndexTable)
+    budget = [max(0, searchMaxQueries - len(labels))]
+    cursors = [LabelCursor(table, image['identityId'] + '#' + label, image['minConfidence'], budget)
+               for label in labels]
+    search = LabelSearch(cursors, image['match'], *(decodeToken(image['nextToken']) or (None, False)))
+    with ThreadPoolExecutor(max_workers=searchWorkers) as executor:
+        list(executor.map(lambda cursor: cursor.read(search.lower, search.inclusive), cursors))
+
+    # An intersection is led by the smallest partition, which the others then skip ahead to; short of
+    # counts, partitions read in full by their first Query go first
+    cursors.sort(key=lambda cursor: (not cursor.exhausted, -len(cursor.items) if cursor.exhausted else 0))
 
+    images = []
     try:
-        table.delete_item(Key={'image': key})
+        while len(images) < limit:
+            found = search.next()
+            if found is None:
+                return {"images": images, "nextToken": None}
+            images.append(found)
+    except SearchBudgetExceeded:
+        pass
+    return {"images": images, "nextToken": encodeToken([search.lower, search.inclusive])}
 
+class SearchBudgetExceeded(Exception):
+
+    # Raised when a search has used up its Queries
+    pass
+
+class LabelSearch:
+
+    # Sorted merge of label index partitions, which are all in image key order: the union of their
+    # images for "or", and for "and" their intersection, each partition skipping ahead to the image
+    # another one is at. The next image is looked for from lower (inclusive or not)
+
+    def __init__(self, cursors, match, lower=None, inclusive=False):
+        self.cursors = cursors
+        self.match = match
+        self.lower = lower
+        self.inclusive = inclusive
+
+    def next(self):
+        if self.match == "or":
+            heads = [head for head in (cursor.head(self.lower, self.inclusive) for cursor in self.cursors) if head]
+            if not heads:
+                return None
+            key = min(head['image'] for head in heads)
+            found = [head for head in heads if head['image'] == key]
+        else:
+            while True:
+                head = self.cursors[0].head(self.lower, self.inclusive)
+                if head is None:
+                    return None
+                # No image before the head of a partition can be in all of them
+                self.lower, self.inclusive = head['image'], True
+                found = [head]
+                for cursor in self.cursors[1:]:
+                    head = cursor.head(self.lower, True)
+                    if head is None:
+                        return None
+                    if head['image'] != self.lower:
+                        self.lower = head['image']
+                        break
+                    found.append(head)
+                else:
+                    break
+
+        self.lower, self.inclusive = found[0]['image'], False
+        return {
+            "image": found[0]['image'],
+            "labels": {head['label']: float(head['confidence']) for head in found},
+        }
+
+class LabelCursor:
+
+    # One label index partition, read a Query at a time. Entries below the bound asked for are
+    # skipped, by starting the next Query at the bound when it is past what has been read
+
+    def __init__(self, table, partition, minConfidence, budget):
+        self.table = table
+        self.partition = partition
+        self.minConfidence = Decimal(str(minConfidence))
+        self.budget = budget
+        self.items = collections.deque()
+        self.position = None
+        self.exhausted = False
+
+    def head(self, lower, inclusive):
+        while True:
+            while self.items and lower is not None and (
+                    self.items[0]['image'] < lower or (self.items[0]['image'] == lower and not inclusive)):
+                self.items.popleft()
+            if self.items or self.exhausted:
+                return self.items[0] if self.items else None
+            if self.budget[0] <= 0:
+                raise SearchBudgetExceeded()
+            self.budget[0] -= 1
+            self.read(lower, inclusive)
+
+    def read(self, lower, inclusive):
+        condition = "ownerLabel = :partition"
+        values = {":partition": self.partition, ":minConfidence": self.minConfidence}
+        options = {}
+        start = self.position
+        if lower is not None and (start is None or lower > start):
+            if inclusive:
+                condition += " AND #image >= :lower"
+                values[":lower"] = lower
+                options['ExpressionAttributeNames'] = {"#image": "image"}
+                start = None
+            else:
+                start = lower
+        if start is not None:
+            options['ExclusiveStartKey'] = {"ownerLabel": self.partition, "image": start}
+
+        try:
+            response = self.table.query(
+                KeyConditionExpression=condition,
+                FilterExpression="confidence >= :minConfidence",
+                ExpressionAttributeValues=values,
+                Limit=searchPageSize,
+                **options
+            )
+        except ClientError as e:
+            logging.error(e)
+            raise
+
+        self.items.extend(response['Items'])
+        if 'LastEvaluatedKey' in response:
+            self.position = response['LastEvaluatedKey']['image']
+        else:
+            self.exhausted = True
+
+def listImages(image):
+
+    if not image['identityId']:
+        raise Exception("identityId is required")
+    limit = max(1, min(image['limit'] or listPageSize, listPageSize))
+
+    # Only the attributes the gallery shows are read; the token is the LastEvaluatedKey of the page
+    options = {}
+    start = decodeToken(image['nextToken'])
+    if start is not None:
+        options['ExclusiveStartKey'] = start
+
+    table = getTable(os.environ['TABLE'])
+    try:
+        response = table.query(
+            IndexName=ownerIndex,
+            KeyConditionExpression="#owner = :owner",
+            ProjectionExpression="#image, uploaded, labels, thumbnails",
+            ExpressionAttributeNames={"#owner": "owner", "#image": "image"},
+            ExpressionAttributeValues={":owner": image['identityId']},
+            ScanIndexForward=False,
+            Limit=limit,
+            **options
+        )
     except ClientError as e:
         logging.error(e)
+        raise
 
-    bucketName = os.environ["BUCKET"]
-    resizedBucketName = os.environ["RESIZEDBUCKET"]
+    images = [filterLabels(item, image['minConfidence'], image['maxLabels']) for item in response['Items']]
+    return {"images": images, "nextToken": encodeToken(response.get('LastEvaluatedKey'))}
+
+def encodeToken(position):
 
-    # Delete Photo and Thumbnail from Amazon S3
+    # Opaque pagination token, None when there is nothing more to read
+    if position is None:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
 
+def decodeToken(token):
+
+    if token is None:
+        return None
     try:
-        s3.Object(bucketName, key).delete()
-        s3.Object(resizedBucketName, key).delete()
+        return json.loads(base64.urlsafe_b64decode(token.encode()))
+    except ValueError:
+        raise Exception("Invalid nextToken")
 
-    except ClientError as e:
-        logging.error(e)
+def filterLabels(item, minConfidence, maxLabels, details=True):
+
+    # getLabelsBatch and listImages return the item with the full details of its labels in
+    # "labels"; getLabels only the image key and the object1..objectN names, as the front end joins
+    # every other value of its item into the label list
+    if not details:
+        item = {key: value for key, value in item.items() if key in ('image', 'labels') or key.startswith('object')}
+
+    # Items written before schemaVersion 2 only have the object1..objectN names, without
+    # confidences; they are returned as they are
+    if 'labels' not in item:
+        return dict(item)
+
+    # Expand the compact [name, confidence, parents, boxes] list back into the object1..objectN
+    # layout the front end reads
+    labels = [label for label in json.loads(item['labels']) if label[1] >= minConfidence][:maxLabels]
+    result = {key: value for key, value in item.items() if key not in ('labels', 'schemaVersion', 'version')}
+    if 'thumbnails' in item:
+        result['thumbnails'] = json.loads(item['thumbnails'])
+    for objectNum, label in enumerate(labels, 1):
+        result[f"object{objectNum}"] = label[0]
+    if details:
+        result['labels'] = [
+            {'name': name, 'confidence': confidence, 'parents': parents, 'instances': boxes}
+            for name, confidence, parents, boxes in labels
+        ]
+    return result
+
+def deleteImage(image):
 
+    # One image through the same path as deleteImages, so its thumbnails and index entries go too
+    results = deleteImages(dict(image, keys=[image['key']]))
+    if results['unprocessed']:
+        logging.error("Delete of %s incomplete: %s", image['key'], results['images'][image['key']])
     return "Delete request successfully processed"
+
+def deleteImages(image):
+
+    keys = image['keys']
+    if not isinstance(keys, list) or not all(isinstance(key, str) for key in keys):
+        raise Exception("keys must be a list of image keys")
+    keys = list(dict.fromkeys(keys))
+    if len(keys) > maxDeleteKeys:
+        raise Exception(f"At most {maxDeleteKeys} keys per request")
+
+    imageLabelsTable = os.environ['TABLE']
+    bucketName = os.environ["BUCKET"]
+    resizedBucketName = os.environ["RESIZEDBUCKET"]
+
+    # Read the label items first: they name the thumbnails and the label index entries to delete.
+    # Images whose item can't be read are left alone, so nothing of theirs is lost track of
+    failures = {}
+    items = {}
+    chunks = [keys[i:i + batchGetSize] for i in range(0, len(keys), batchGetSize)]
+    if chunks:
+        with ThreadPoolExecutor(max_workers=min(deleteWorkers, len(chunks))) as executor:
+            for found, failedKeys in executor.map(lambda chunk: getLabelsChunk(imageLabelsTable, chunk), chunks):
+                items.update((item['image'], item) for item in found)
+                failures.update((key, "Labels could not be read") for key in failedKeys)
+    keys = [key for key in keys if key not in failures]
+
+    # Originals, thumbnails and index entries are deleted side by side. Each part records the image
+    # it belongs to, so a failure is reported against that image only
+    originals = [(key, key) for key in keys]
+    thumbnails = [(key, thumbKey) for key in keys for thumbKey in thumbnailKeys(key, items.get(key))]
+    writes = []
+    if labelIndexTable is not None:
+        writes = [(key, labelIndexTable, {'ownerLabel': partition, 'image': key})
+                  for key in keys if key in items for partition in indexPartitions(items[key])]
+
+    tasks = [(deleteObjectsChunk, (bucketName, originals[i:i + deleteObjectsSize]))
+             for i in range(0, len(originals), deleteObjectsSize)]
+    tasks += [(deleteObjectsChunk, (resizedBucketName, thumbnails[i:i + deleteObjectsSize]))
+              for i in range(0, len(thumbnails), deleteObjectsSize)]
+    tasks += [(deleteItemsChunk, (writes[i:i + batchWriteSize],)) for i in range(0, len(writes), batchWriteSize)]
+    runDeletes(tasks, failures)
+
+    # The label item goes last: while it is there, asking again for the delete of an image that
+    # failed part way finds everything that is left of it
+    rows = [(key, imageLabelsTable, {'image': key}) for key in keys if key in items and key not in failures]
+    runDeletes([(deleteItemsChunk, (rows[i:i + batchWriteSize],)) for i in range(0, len(rows), batchWriteSize)],
+               failures)
+
+    forgetItems(keys)
+    images = {key: failures.get(key, "Deleted") for key in image['keys']}
+    return {"images": images, "unprocessed": [key for key in images if key in failures]}
+
+def runDeletes(tasks, failures):
+
+    if not tasks:
+        return
+    with ThreadPoolExecutor(max_workers=min(deleteWorkers, len(tasks))) as executor:
+        for failed in executor.map(lambda task: task[0](*task[1]), tasks):
+            for key, reason in failed:
+                failures.setdefault(key, reason)
+
+def deleteObjectsChunk(bucketName, objects):
+
+    # objects are (image key, object key) pairs. Deleting a missing object succeeds, so a retry
+    # of the whole request is harmless
+    owners = collections.defaultdict(list)
+    for key, objectKey in objects:
+        owners[objectKey].append(key)
+    pending = list(owners)
+    bucket = s3.Bucket(bucketName)
+    for attempt in range(deleteAttempts):
+        try:
+            response = bucket.delete_objects(
+                Delete={'Objects': [{'Key': objectKey} for objectKey in pending], 'Quiet': True})
+        except ClientError as e:
+            logging.error(e)
+            return [(key, "Objects could not be deleted") for objectKey in pending for key in owners[objectKey]]
+
+        errors = {error['Key']: error for error in response.get('Errors', [])}
+        pending = [objectKey for objectKey in pending if objectKey in errors]
+        if not pending:
+            return []
+        time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+
+    logging.error("Objects left in %s after %d attempts", bucketName, deleteAttempts)
+    return [(key, "Object could not be deleted: " + errors[objectKey].get('Code', ''))
+            for objectKey in pending for key in owners[objectKey]]
+
+def deleteItemsChunk(deletes):
+
+    # deletes are (image key, table name, item key) triples, at most 25 to a BatchWriteItem call
+    requests = collections.defaultdict(list)
+    for key, tableName, itemKey in deletes:
+        requests[tableName].append({'DeleteRequest': {'Key': itemKey}})
+    for attempt in range(deleteAttempts):
+        try:
+            response = dynamodb.batch_write_item(RequestItems=requests)
+        except ClientError as e:
+            logging.error(e)
+            break
+
+        requests = response.get('UnprocessedItems', {})
+        if not requests:
+            return []
+        time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+    else:
+        logging.error("Unprocessed deletes after %d attempts", deleteAttempts)
+
+    left = {(tableName, json.dumps(request['DeleteRequest']['Key'], sort_keys=True))
+            for tableName, tableRequests in requests.items() for request in tableRequests}
+    return [(key, "Labels could not be deleted") for key, tableName, itemKey in deletes
+            if (tableName, json.dumps(itemKey, sort_keys=True)) in left]
+
+def thumbnailKeys(key, item):
+
+    # Items written before thumbnail keys were recorded have one thumbnail, under the image's key
+    if item is None or 'thumbnails' not in item:
+        return [key]
+    return list(dict.fromkeys(json.loads(item['thumbnails']).values()))
+
+def indexPartitions(item):
+
+    # Every label of an item is deleted from the index, whatever confidence it was indexed from;
+    # deleting an entry that isn't there is harmless
+    owner = keyOwner(item['image'])
+    if 'labels' in item:
+        names = [label[0] for label in json.loads(item['labels'])]
+    else:
+        names = [value for name, value in item.items() if name.startswith('object')]
+    return [owner + '#' + name for name in dict.fromkeys(name.lower() for name in names)]
+
+def keyOwner(key):
+
+    # Uploads are stored under "private/<identity id>/..." (or "protected/"); anything else is public
+    parts = key.split('/')
+    if len(parts) > 2 and parts[0] in ('private', 'protected'):
+        return parts[1]
+    return 'public'
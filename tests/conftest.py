@@ -0,0 +1,15 @@
+#
+# The rekognition handler's module is imported as "index", like in the benchmarks, with the
+# environment it needs at import time; the benchmarks' image makers are shared with the tests
+#
+
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'benchmarks'))
+sys.path.insert(0, os.path.join(HERE, '..', 'rekognitionLambda'))
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+os.environ.setdefault('RESIZEDBUCKET', 'resized')
+os.environ.setdefault('TABLE', 'labels')
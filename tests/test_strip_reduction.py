@@ -0,0 +1,43 @@
+#
+# Reducing a PNG band by band must give exactly the pixels of Image.reduce on the whole image, for
+# every PNG colour type reduce_png_strips accepts and awkward sizes, factors and band heights (the
+# same cases as benchmarks/strip_bench.py)
+#
+
+import io
+
+import pytest
+
+import index
+from strip_bench import makePng
+
+MODES = ['L', 'LA', 'P', 'PA', 'RGB', 'RGBA']
+CASES = [((1003, 777), 2, 16), ((640, 481), 3, 7), ((257, 1000), 5, 256), ((99, 99), 4, 1)]
+
+
+@pytest.fixture
+def stripRows():
+
+    index.loadPIL()
+    previous = index.stripRows
+    yield
+    index.stripRows = previous
+
+
+@pytest.mark.parametrize('size,factor,rows', CASES)
+@pytest.mark.parametrize('mode', MODES)
+def testStripsMatchReduce(stripRows, mode, size, factor, rows):
+
+    from PIL import Image, ImageChops
+
+    data = makePng(size, mode, seed=factor)
+    index.stripRows = rows
+    reduced = index.reduce_png_strips(io.BytesIO(data), factor)
+
+    with Image.open(io.BytesIO(data)) as image:
+        if image.mode == 'P':
+            image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+        expected = image.reduce(factor)
+    assert reduced.mode == expected.mode
+    assert reduced.size == expected.size
+    assert ImageChops.difference(reduced, expected).getbbox() is None
@@ -106,6 +106,46 @@ class BackendStack(cdk.Stack):
         )
         # below line brings the output back to cloudformation and to log files, basically dynamodb table name
         cdk.CfnOutput(self, "ddbTable", value=table.table_name)
+
+        # index of each user's images by upload time, for listing them a page at a time; it only
+        # carries what the gallery shows (labels and thumbnail keys)
+        table.add_global_secondary_index(
+            index_name="byOwner",
+            partition_key=dynamodb.Attribute(name="owner", type=dynamodb.AttributeType.STRING),
+            sort_key=dynamodb.Attribute(name="uploaded", type=dynamodb.AttributeType.STRING),
+            projection_type=dynamodb.ProjectionType.INCLUDE,
+            non_key_attributes=["labels", "thumbnails"],
+        )
+
+        # table caching Rekognition labels by image content (S3 ETag + size), so duplicate
+        # uploads reuse earlier labels instead of calling detectLabels again
+        label_cache_table = dynamodb.Table(
+            self,
+            "LabelCache",
+            partition_key=dynamodb.Attribute(name="contentHash", type=dynamodb.AttributeType.STRING),
+            removal_policy=cdk.RemovalPolicy.DESTROY,
+        )
+
+        # table of perceptual image hashes, split into bands so near-duplicate images can be found
+        # by querying a few partitions; each entry only holds the hash and the image key, whose
+        # labels are read from the labels table
+        hash_table = dynamodb.Table(
+            self,
+            "ImageHashes",
+            partition_key=dynamodb.Attribute(name="band", type=dynamodb.AttributeType.STRING),
+            sort_key=dynamodb.Attribute(name="phash", type=dynamodb.AttributeType.STRING),
+            removal_policy=cdk.RemovalPolicy.DESTROY,
+        )
+
+        # inverted label index: one item per user, label and image, partitioned by
+        # "<identity id>#<label>" and sorted by image key, so searching by label is a Query
+        label_index_table = dynamodb.Table(
+            self,
+            "LabelIndex",
+            partition_key=dynamodb.Attribute(name="ownerLabel", type=dynamodb.AttributeType.STRING),
+            sort_key=dynamodb.Attribute(name="image", type=dynamodb.AttributeType.STRING),
+            removal_policy=cdk.RemovalPolicy.DESTROY,
+        )
         
         ## =====================================================================================
         ## Building A layer to enable the PIL library in our Rekognition Lambda function
@@ -135,6 +175,9 @@ class BackendStack(cdk.Stack):
             layers=[layer],
             environment={
                 "TABLE": table.table_name,
+                "CACHETABLE": label_cache_table.table_name,
+                "HASHTABLE": hash_table.table_name,
+                "LABELINDEXTABLE": label_index_table.table_name,
                 "BUCKET": image_bucket.bucket_name,
                 "RESIZEDBUCKET": resized_image_bucket.bucket_name,
             },
@@ -152,8 +195,14 @@ class BackendStack(cdk.Stack):
         # below line gives write permission to lambda function to write resized images to resized S3 bucket
         resized_image_bucket.grant_put(rek_fn)
         
-        # below line gives write permission to lambda function to write images details to dynamodb table
-        table.grant_write_data(rek_fn)
+        # below line gives read and write permission to lambda function on the images details dynamodb
+        # table; the labels an image had before are read to update the label index
+        table.grant_read_write_data(rek_fn)
+        label_index_table.grant_write_data(rek_fn)
+
+        # below line gives read and write permission to lambda function on the label cache table
+        label_cache_table.grant_read_write_data(rek_fn)
+        hash_table.grant_read_write_data(rek_fn)
         
         ## below line defines IAM role policy for lambda function to perform "detectLabels" task on reKognition service 
         rek_fn.add_to_role_policy(
@@ -177,6 +226,8 @@ class BackendStack(cdk.Stack):
             handler="index.handler",  ## file name and function name
             environment={
                 "TABLE": table.table_name,
+                "LABELINDEXTABLE": label_index_table.table_name,
+                "OWNERINDEX": "byOwner",
                 "BUCKET": image_bucket.bucket_name,
                 "RESIZEDBUCKET": resized_image_bucket.bucket_name,
             },
@@ -185,6 +236,7 @@ class BackendStack(cdk.Stack):
         image_bucket.grant_write(serviceFn)
         resized_image_bucket.grant_write(serviceFn)
         table.grant_read_write_data(serviceFn)
+        label_index_table.grant_read_write_data(serviceFn)
         
         ## =====================================================================================
         ## Creating the API Gateway resource and connecting to lambda function - Episode 3
@@ -225,6 +277,17 @@ class BackendStack(cdk.Stack):
             {
                 "action": "$util.escapeJavaScript($input.params('action'))",
                 "key": "$util.escapeJavaScript($input.params('key'))",
+                "minConfidence": "$util.escapeJavaScript($input.params('minConfidence'))",
+                "maxLabels": "$util.escapeJavaScript($input.params('maxLabels'))",
+                "identityId": "$util.escapeJavaScript($input.params('identityId'))",
+                "labels": "$util.escapeJavaScript($input.params('labels'))",
+                "match": "$util.escapeJavaScript($input.params('match'))",
+                "limit": "$util.escapeJavaScript($input.params('limit'))",
+                "nextToken": "$util.escapeJavaScript($input.params('nextToken'))",
+                "stats": "$util.escapeJavaScript($input.params('stats'))",
+                # The caller as the Cognito authorizer saw it, which servicelambda checks identityId against
+                "sub": "$context.authorizer.claims.sub",
+                "idToken": "$util.escapeJavaScript($input.params('Authorization'))",
             }
         )
 
@@ -234,11 +297,59 @@ class BackendStack(cdk.Stack):
             request_parameters={
                 "integration.request.querystring.action": "method.request.querystring.action",
                 "integration.request.querystring.key": "method.request.querystring.key",
+                "integration.request.querystring.minConfidence": "method.request.querystring.minConfidence",
+                "integration.request.querystring.maxLabels": "method.request.querystring.maxLabels",
+                "integration.request.querystring.identityId": "method.request.querystring.identityId",
+                "integration.request.querystring.labels": "method.request.querystring.labels",
+                "integration.request.querystring.match": "method.request.querystring.match",
+                "integration.request.querystring.limit": "method.request.querystring.limit",
+                "integration.request.querystring.nextToken": "method.request.querystring.nextToken",
+                "integration.request.querystring.stats": "method.request.querystring.stats",
             },
             request_templates={"application/json": request_template},
             passthrough_behavior=apigw.PassthroughBehavior.WHEN_NO_TEMPLATES,
             integration_responses=[success_response, error_response],
         )
+
+        # The gallery asks for the labels of all its images at once: the key list comes in the JSON
+        # body of a POST (it wouldn't fit in a query string), and is passed on to the Lambda as a list
+        batch_request_template = (
+            '{"action": "getLabelsBatch", '
+            '"keys": $input.json(\'$.keys\'), '
+            '"minConfidence": "$util.escapeJavaScript($input.params(\'minConfidence\'))", '
+            '"maxLabels": "$util.escapeJavaScript($input.params(\'maxLabels\'))", '
+            '"sub": "$context.authorizer.claims.sub", '
+            '"idToken": "$util.escapeJavaScript($input.params(\'Authorization\'))"}'
+        )
+
+        batch_integration = apigw.LambdaIntegration(
+            serviceFn,
+            proxy=False,
+            request_parameters={
+                "integration.request.querystring.minConfidence": "method.request.querystring.minConfidence",
+                "integration.request.querystring.maxLabels": "method.request.querystring.maxLabels",
+            },
+            request_templates={"application/json": batch_request_template},
+            passthrough_behavior=apigw.PassthroughBehavior.NEVER,
+            integration_responses=[success_response, error_response],
+        )
+
+        # Clearing an album is one DELETE of /images/batch, with the keys in the JSON body too. Both
+        # batch templates pass on the caller, as servicelambda only lets owners read or delete images
+        delete_batch_request_template = (
+            '{"action": "deleteImages", '
+            '"keys": $input.json(\'$.keys\'), '
+            '"sub": "$context.authorizer.claims.sub", '
+            '"idToken": "$util.escapeJavaScript($input.params(\'Authorization\'))"}'
+        )
+
+        delete_batch_integration = apigw.LambdaIntegration(
+            serviceFn,
+            proxy=False,
+            request_templates={"application/json": delete_batch_request_template},
+            passthrough_behavior=apigw.PassthroughBehavior.NEVER,
+            integration_responses=[success_response, error_response],
+        )
         
 
         ## =====================================================================================
@@ -288,6 +399,11 @@ class BackendStack(cdk.Stack):
             type="COGNITO_USER_POOLS",
             ## something is wrong over here, its not working currently
         )
+
+        # servicelambda resolves the identity id of the caller from the ID token the authorizer
+        # accepted, to only list and search the caller's own images
+        serviceFn.add_environment("IDENTITYPOOLID", identity_pool.ref)
+        serviceFn.add_environment("IDENTITYPROVIDER", user_pool.user_pool_provider_name)
         
         ## =====================================================================================
         ## Creating IAM role that provides necessary permissions to cognito - Episode 4
@@ -385,7 +501,15 @@ class BackendStack(cdk.Stack):
             authorization_type=apigw.AuthorizationType.COGNITO,
             request_parameters={
                 "method.request.querystring.action": True,
-                "method.request.querystring.key": True,
+                "method.request.querystring.key": False,
+                "method.request.querystring.minConfidence": False,
+                "method.request.querystring.maxLabels": False,
+                "method.request.querystring.identityId": False,
+                "method.request.querystring.labels": False,
+                "method.request.querystring.match": False,
+                "method.request.querystring.limit": False,
+                "method.request.querystring.nextToken": False,
+                "method.request.querystring.stats": False,
             },
             method_responses=[success_resp, error_resp],
         )
@@ -400,6 +524,25 @@ class BackendStack(cdk.Stack):
             },
             method_responses=[success_resp, error_resp],
         )
+        # this is POST method for /images/batch resource, with {"keys": [...]} as body
+        batch_resource = imageAPI.add_resource("batch")
+        batch_method = batch_resource.add_method(
+            "POST",
+            batch_integration,
+            authorization_type=apigw.AuthorizationType.COGNITO,
+            request_parameters={
+                "method.request.querystring.minConfidence": False,
+                "method.request.querystring.maxLabels": False,
+            },
+            method_responses=[success_resp, error_resp],
+        )
+        # this is DELETE method for /images/batch resource, with {"keys": [...]} as body
+        delete_batch_method = batch_resource.add_method(
+            "DELETE",
+            delete_batch_integration,
+            authorization_type=apigw.AuthorizationType.COGNITO,
+            method_responses=[success_resp, error_resp],
+        )
         
         # Override the authorizer id because it doesn't work when defininting it as a param
         # in above add_method
@@ -407,6 +550,10 @@ class BackendStack(cdk.Stack):
         get_method_resource.add_property_override("AuthorizerId", auth.ref)
         delete_method_resource = delete_method.node.find_child("Resource")
         delete_method_resource.add_property_override("AuthorizerId", auth.ref)
+        batch_method_resource = batch_method.node.find_child("Resource")
+        batch_method_resource.add_property_override("AuthorizerId", auth.ref)
+        delete_batch_method_resource = delete_batch_method.node.find_child("Resource")
+        delete_batch_method_resource.add_property_override("AuthorizerId", auth.ref)
         
         
         ## =====================================================================================
@@ -420,7 +567,9 @@ class BackendStack(cdk.Stack):
             queue_name="ImageDLQueue",
         )
 
-        dl_queue_opts = sqs.DeadLetterQueue(max_receive_count=2, queue=dl_queue)
+        # Records the handler leaves for redelivery near its deadline count as receives too, so
+        # allow a few before a message is considered poison
+        dl_queue_opts = sqs.DeadLetterQueue(max_receive_count=5, queue=dl_queue)
 
         queue = sqs.Queue(
             self,
@@ -444,4 +593,13 @@ class BackendStack(cdk.Stack):
         ## Allow Lambda(Rekognition) to consume messages from SQS
         ## =====================================================================================
         rek_fn.add_event_source(event_sources.SqsEventSource(queue=queue))
+
+        # Let the handler return "batchItemFailures" so only the failed messages of a batch become
+        # visible again. The property isn't exposed by SqsEventSource in this CDK version, so we
+        # override it on the underlying CfnEventSourceMapping
+        for child in rek_fn.node.children:
+            if isinstance(child, lb.EventSourceMapping):
+                child.node.default_child.add_property_override(
+                    "FunctionResponseTypes", ["ReportBatchItemFailures"]
+                )
         